@@ -0,0 +1,338 @@
+#!/bin/python3
+
+import sys
+import argparse
+from argparse import RawTextHelpFormatter
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# How far apart the expected barcodes of a lane are.
+#
+# split_barcodes_aviti.py --max_mismatches corrects each index read separately (see
+# barcode_matching.py), so a read from one sample can only end up in another if both of its
+# index reads could be corrected to the other sample's - ie. the I1 barcodes of the two samples
+# are within 2 x max_mismatches of each other, and so are their I2 barcodes.  For each pair of
+# samples this works out
+#
+#   conflict distance  - the larger of the I1 and I2 Hamming distances (just the I1 distance for
+#                        single indexed lanes).  Allowing m mismatches is safe when every pair of
+#                        samples has a conflict distance of more than 2m.
+#   combined distance  - the total number of differences across both index reads
+#
+# The splitter prints the report before it starts, and it can be run on a barcode sheet in the
+# --sample_sheet format (First_barcode, Second_barcode, Description, Lane, tab delimited):
+#
+#   ~/illuminaprocessing/barcode_distances.py --lane 1 --max_mismatches 1 barcodes.txt
+#
+# With numpy the barcodes are packed 2 bits a base into 64 bit words, so each distance is an
+# XOR and a bit count, and the whole distance matrix is worked out at once - quick enough for a
+# 1536 sample plate.  Without numpy, or for barcodes with anything other than A, C, G or T in
+# them, the distances are counted a pair at a time in python.
+
+# barcodes of different lengths can never be mistaken for each other, as every index read is
+# cut to the same length, so they are given a distance larger than any real one
+different_lengths = 1000
+
+# the --max_mismatches choices of the splitter
+largest_tolerance = 2
+
+max_pairs_listed = 20
+
+
+#----------------------------------------------
+#  Hamming distances
+#----------------------------------------------
+def python_distances(sequences):
+    """Return the Hamming distances between every pair of sequences as a list of lists."""
+
+    distances = [[different_lengths] * len(sequences) for sequence in sequences]
+
+    for i, first in enumerate(sequences):
+        distances[i][i] = 0
+        for j in range(i + 1, len(sequences)):
+            second = sequences[j]
+            if len(first) == len(second):
+                distances[i][j] = distances[j][i] = sum(a != b for a, b in zip(first, second))
+
+    return distances
+
+
+def pack_2bit(sequences):
+    """Return the equal length sequences packed 2 bits a base into rows of 64 bit words, or None if
+    any of them has a base other than A, C, G or T."""
+
+    codes = np.full(256, 255, dtype=np.uint8)
+    codes[list(b"ACGT")] = [0, 1, 2, 3]
+
+    length = len(sequences[0])
+    bases = codes[np.frombuffer(b"".join(sequences), dtype=np.uint8).reshape(len(sequences), length)]
+    if (bases == 255).any():
+        return None
+
+    # 32 bases to a word, padded with A which matches in every sequence
+    n_words = (length + 31) // 32
+    padded = np.zeros((len(sequences), n_words * 32), dtype=np.uint64)
+    padded[:, :length] = bases
+    shifts = np.arange(0, 64, 2, dtype=np.uint64)
+
+    return (padded.reshape(len(sequences), n_words, 32) << shifts).sum(axis=2, dtype=np.uint64)
+
+
+def numpy_distances(sequences):
+    """Return the Hamming distances between every pair of sequences as a numpy array, or None if
+    they can't all be packed into 2 bits a base."""
+
+    # bits set in each byte, to count the differences
+    popcount = np.array([bin(byte).count("1") for byte in range(256)], dtype=np.uint8)
+    low_bits = np.uint64(0x5555555555555555)
+
+    distances = np.full((len(sequences), len(sequences)), different_lengths, dtype=np.int16)
+
+    by_length = {}
+    for n, sequence in enumerate(sequences):
+        by_length.setdefault(len(sequence), []).append(n)
+
+    for rows in by_length.values():
+        packed = pack_2bit([sequences[n] for n in rows])
+        if packed is None:
+            return None
+
+        # a base differs if either of its 2 bits does - fold them onto the low bit and count those
+        diff = packed[:, None, :] ^ packed[None, :, :]
+        diff = (diff | (diff >> np.uint64(1))) & low_bits
+        counts = popcount[diff.view(np.uint8)].reshape(len(rows), len(rows), -1).sum(axis=2)
+
+        distances[np.ix_(rows, rows)] = counts
+
+    return distances
+
+
+def distance_matrix(sequences):
+    """Return the Hamming distances between every pair of sequences (bytes), using numpy if it's installed."""
+
+    if np is not None and sequences:
+        distances = numpy_distances(sequences)
+        if distances is not None:
+            return distances
+
+    return python_distances(sequences)
+
+
+#----------------------------------------------
+#  the expected barcodes of a lane
+#----------------------------------------------
+class BarcodeDistances:
+    """The pairwise distances between the expected barcodes of a lane."""
+
+    def __init__(self, expected_barcodes):
+        """expected_barcodes maps 'I1' or 'I1_I2' barcodes to sample names, as the splitter builds them."""
+
+        self.barcodes = list(expected_barcodes)
+        self.names = [expected_barcodes[barcode] for barcode in self.barcodes]
+        self.double_coded = any("_" in barcode for barcode in self.barcodes)
+
+        pairs = [barcode.upper().split("_") + [""] for barcode in self.barcodes]
+        first = [pair[0].encode() for pair in pairs]
+        second = [pair[1].encode() for pair in pairs]
+
+        # the distances are worked out between the distinct barcodes of each index read, then
+        # looked up for each pair of samples
+        self.first = sorted(set(first))
+        self.second = sorted(set(second))
+        self.first_distances = distance_matrix(self.first)
+        self.second_distances = distance_matrix(self.second)
+
+        first_rows = {sequence: n for n, sequence in enumerate(self.first)}
+        second_rows = {sequence: n for n, sequence in enumerate(self.second)}
+        self.first_row = [first_rows[sequence] for sequence in first]
+        self.second_row = [second_rows[sequence] for sequence in second]
+
+        self.vectorised = not isinstance(self.first_distances, list) and not isinstance(self.second_distances, list)
+        self.pair_i, self.pair_j, self.pair_first, self.pair_second = self.sample_pairs()
+
+    def sample_pairs(self):
+        """Return the sample numbers i and j, and the I1 and I2 distances, for every pair of samples i < j."""
+
+        n = len(self.barcodes)
+
+        if self.vectorised:
+            first_rows = np.array(self.first_row)
+            second_rows = np.array(self.second_row)
+            i, j = np.triu_indices(n, k=1)
+            return i, j, self.first_distances[first_rows[i], first_rows[j]], self.second_distances[second_rows[i], second_rows[j]]
+
+        i = [i for i in range(n) for j in range(i + 1, n)]
+        j = [j for i in range(n) for j in range(i + 1, n)]
+        first = [self.first_distances[self.first_row[a]][self.first_row[b]] for a, b in zip(i, j)]
+        second = [self.second_distances[self.second_row[a]][self.second_row[b]] for a, b in zip(i, j)]
+
+        return i, j, first, second
+
+    def conflict_distances(self):
+        """Return the larger of the I1 and I2 distances for every pair of samples."""
+
+        if self.vectorised:
+            return np.maximum(self.pair_first, self.pair_second)
+
+        return [max(first, second) for first, second in zip(self.pair_first, self.pair_second)]
+
+    def combined_distances(self):
+        """Return the total of the I1 and I2 distances for every pair of samples."""
+
+        if self.vectorised:
+            return self.pair_first.astype(np.int32) + self.pair_second
+
+        return [first + second for first, second in zip(self.pair_first, self.pair_second)]
+
+    def min_distance(self, index):
+        """Return the smallest distance between two different barcodes of "I1" or "I2", or None if there's only one."""
+
+        distances = self.first_distances if index == "I1" else self.second_distances
+        n = len(distances)
+
+        if n < 2:
+            return None
+
+        if not isinstance(distances, list):
+            return int(distances[np.triu_indices(n, k=1)].min())
+
+        return min(distances[i][j] for i in range(n) for j in range(i + 1, n))
+
+    def min_conflict_distance(self):
+        """Return the smallest conflict distance between two samples, or None if there's only one sample."""
+
+        if len(self.barcodes) < 2:
+            return None
+
+        distances = self.conflict_distances()
+        return int(distances.min()) if self.vectorised else min(distances)
+
+    def min_combined_distance(self):
+        """Return the smallest total distance across both index reads between two samples."""
+
+        if len(self.barcodes) < 2:
+            return None
+
+        distances = self.combined_distances()
+        return int(distances.min()) if self.vectorised else min(distances)
+
+    def safe_mismatches(self):
+        """Return the largest number of mismatches per index read that can't move a read to another sample."""
+
+        smallest = self.min_conflict_distance()
+        if smallest is None:
+            return largest_tolerance
+
+        return max(0, min(largest_tolerance, (smallest - 1) // 2))
+
+    def conflicting_pairs(self, max_mismatches):
+        """Return [(barcode, name, barcode, name, I1 distance, I2 distance)] for the pairs of samples a read
+        could be moved between with max_mismatches per index read, closest first."""
+
+        conflict = self.conflict_distances()
+
+        if self.vectorised:
+            pairs = np.nonzero(conflict <= 2 * max_mismatches)[0].tolist()
+        else:
+            pairs = [n for n, distance in enumerate(conflict) if distance <= 2 * max_mismatches]
+
+        pairs.sort(key=lambda n: (int(conflict[n]), int(self.pair_first[n] + self.pair_second[n]), n))
+
+        return [(self.barcodes[i], self.names[i], self.barcodes[j], self.names[j], first, second)
+                for i, j, first, second in ((int(self.pair_i[n]), int(self.pair_j[n]), int(self.pair_first[n]), int(self.pair_second[n])) for n in pairs)]
+
+    def report(self, max_mismatches):
+        """Return lines describing the distances between the barcodes and any conflicts at max_mismatches."""
+
+        def shown(distance):
+            return "different lengths" if distance is None or distance >= different_lengths else distance
+
+        lines = [f"Distances between the {len(self.barcodes)} expected barcodes:"]
+
+        for index, sequences in (("I1", self.first), ("I2", self.second)):
+            if index == "I2" and not self.double_coded:
+                continue
+            if len(sequences) > 1:
+                lines.append(f"  {index}: {len(sequences)} distinct barcodes, closest {shown(self.min_distance(index))} apart")
+            else:
+                lines.append(f"  {index}: 1 distinct barcode")
+
+        if len(self.barcodes) < 2:
+            return lines
+
+        if self.double_coded:
+            lines.append(f"  samples: closest {shown(self.min_combined_distance())} apart over both index reads, conflict distance {shown(self.min_conflict_distance())}")
+        else:
+            lines.append(f"  samples: closest {shown(self.min_conflict_distance())} apart")
+
+        safe = self.safe_mismatches()
+        lines.append(f"  up to {safe} mismatch(es) per index read can be allowed without moving reads between samples")
+
+        conflicts = self.conflicting_pairs(max_mismatches)
+        if conflicts:
+            lines.append(f"  !! with {max_mismatches} mismatch(es) {len(conflicts)} pair(s) of samples conflict !!")
+            for bc1, name1, bc2, name2, first, second in conflicts[:max_pairs_listed]:
+                distances = f"I1 {first}, I2 {second}" if self.double_coded else f"I1 {first}"
+                lines.append(f"    {bc1} ({name1}) and {bc2} ({name2}): {distances}")
+            if len(conflicts) > max_pairs_listed:
+                lines.append(f"    ... and {len(conflicts) - max_pairs_listed} more")
+
+        return lines
+
+
+def read_sample_sheet(sample_sheet, lane):
+    """Return a dictionary of barcode to sample name from a --sample_sheet format barcode sheet.
+
+    Barcodes given for more than one sample are returned separately as [(barcode, name, name)].
+    """
+
+    expected_barcodes = {}
+    duplicates = []
+
+    with open(sample_sheet) as ss:
+        ss.readline()
+        for line in ss:
+            row = [field.strip() for field in line.rstrip("\n").split("\t")]
+            if len(row) < 3 or row[0] == "":
+                continue
+            if lane and len(row) > 3 and row[3] != lane:
+                continue
+
+            barcode = f"{row[0]}_{row[1]}" if row[1] != "" else row[0]
+            # the splitter keeps the last sample given for a barcode
+            if barcode in expected_barcodes:
+                duplicates.append((barcode, expected_barcodes[barcode], row[2]))
+            expected_barcodes[barcode] = row[2]
+
+    return expected_barcodes, duplicates
+
+
+def main():
+
+    parser = argparse.ArgumentParser(formatter_class=RawTextHelpFormatter, description = '''Reports how far apart the barcodes in a barcode sheet are, and how many mismatches can safely be allowed when splitting''')
+    parser.add_argument('sample_sheet', type=str, help='Tab delimited barcode sheet "First_barcode\\tSecond_barcode\\tDescription\\tLane", as for split_barcodes_aviti.py --sample_sheet')
+    parser.add_argument('--lane', type=str, default="", help='Only check the barcodes for this lane. Default: all of them')
+    parser.add_argument('--max_mismatches', type=int, default=1, help='Number of mismatches per index read to list the conflicting samples for. Default: 1')
+    args = parser.parse_args()
+
+    expected_barcodes, duplicates = read_sample_sheet(args.sample_sheet, args.lane)
+
+    if not expected_barcodes:
+        print(f"!! No barcodes found in {args.sample_sheet}, exiting... !!\n")
+        sys.exit(1)
+
+    for barcode, name1, name2 in duplicates:
+        print(f"!! {barcode} is given for both {name1} and {name2}, only {name2} will be kept !!")
+
+    for line in BarcodeDistances(expected_barcodes).report(args.max_mismatches):
+        print(line)
+
+    if duplicates:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+#!/bin/python3
+
+# Mismatch tolerant barcode matching for the python splitting scripts.
+#
+# At startup every sequence within the allowed number of mismatches of each
+# expected barcode (substituting A, C, G, T or N at each position) is put
+# into a dictionary which points back to the barcode it came from, so looking
+# up an observed index read stays a single dictionary lookup.
+#
+# Mismatches are allowed separately for each index read, as bcl2fastq does
+# with --barcode-mismatches.  If a sequence is the same distance from two
+# different expected barcodes then it is ambiguous - it's left out of the
+# index (so those reads stay unassigned) and reported as a collision.
+
+from collections import OrderedDict
+from itertools import combinations, product
+
+bases = b"ACGTN"
+
+
+def barcode_variants(barcode, max_mismatches):
+    """Yield (variant, n_mismatches) for every sequence within max_mismatches of barcode, including itself."""
+
+    yield barcode, 0
+
+    for n_mismatches in range(1, max_mismatches + 1):
+        for positions in combinations(range(len(barcode)), n_mismatches):
+            # every other base at each of the chosen positions
+            choices = [[b for b in bases if b != barcode[pos]] for pos in positions]
+
+            for replacement in product(*choices):
+                variant = bytearray(barcode)
+                for pos, base in zip(positions, replacement):
+                    variant[pos] = base
+                yield bytes(variant), n_mismatches
+
+
+def build_mismatch_index(barcodes, max_mismatches):
+    """Map every variant of the given barcodes to the barcode it is closest to.
+
+    Returns the index and a dictionary of ambiguous variants, which are left out
+    of the index, mapped to the barcodes they could have come from.
+    """
+
+    closest = {}   # variant -> [distance, set of barcodes at that distance]
+
+    for barcode in barcodes:
+        for variant, distance in barcode_variants(barcode, max_mismatches):
+            if variant not in closest or distance < closest[variant][0]:
+                closest[variant] = [distance, {barcode}]
+            elif distance == closest[variant][0]:
+                closest[variant][1].add(barcode)
+
+    index = {}
+    collisions = {}
+
+    for variant, (distance, matches) in closest.items():
+        if len(matches) == 1:
+            index[variant] = next(iter(matches))
+        else:
+            collisions[variant] = sorted(matches)
+
+    return index, collisions
+
+
+class MismatchIndex:
+    """Correct observed index sequences back to the expected barcodes they are closest to."""
+
+    def __init__(self, expected_barcodes, max_mismatches):
+        """expected_barcodes are bytes, either 'I1' or 'I1_I2' in the order the splitter builds them."""
+
+        self.max_mismatches = max_mismatches
+        self.double_coded = any(b"_" in barcode for barcode in expected_barcodes)
+
+        first = set()
+        second = set()
+
+        for barcode in expected_barcodes:
+            parts = barcode.split(b"_")
+            first.add(parts[0])
+            if self.double_coded:
+                second.add(parts[1])
+
+        self.first_index, self.first_collisions = build_mismatch_index(first, max_mismatches)
+        self.second_index, self.second_collisions = build_mismatch_index(second, max_mismatches)
+
+    def correct(self, first, second=None):
+        """Return the expected barcode for the observed first (and second) index, or None."""
+
+        corrected = self.first_index.get(first)
+
+        if corrected is None or not self.double_coded:
+            return corrected
+
+        corrected_second = self.second_index.get(second)
+
+        if corrected_second is None:
+            return None
+
+        return corrected + b"_" + corrected_second
+
+    def collision_report(self):
+        """Return lines describing the ambiguous sequences which were left out of the index."""
+
+        lines = []
+
+        for label, collisions in (("first", self.first_collisions), ("second", self.second_collisions)):
+            for variant, matches in sorted(collisions.items()):
+                matched = ", ".join(m.decode() for m in matches)
+                lines.append(f"{label} index {variant.decode()} is ambiguous between {matched}")
+
+        return lines
+
+
+class ResolutionCache:
+    """Remember the result of resolve(*key) for the most recently used keys.
+
+    A lane only has a few thousand distinct raw index sequences, so most reads
+    are answered from the cache.  The oldest entries are dropped once there are
+    more than max_size of them so that a noisy run can't use unlimited memory.
+    """
+
+    def __init__(self, resolve, max_size):
+        self.resolve = resolve
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+
+        if entry is not None:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry
+
+        self.misses += 1
+        entry = self.resolve(*key)
+        self.entries[key] = entry
+
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+        return entry
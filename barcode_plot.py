@@ -0,0 +1,265 @@
+#!/bin/python3
+
+import sys
+import argparse
+from argparse import RawTextHelpFormatter
+
+try:
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+except ImportError:
+    plt = None
+
+# Barcode plots drawn in python rather than by starting R.
+#
+# check_barcodes.py used to write found_barcodes.txt and run barcode_ggplot.R, and the perl
+# split_barcodes scripts write barcode_L00N_data.txt and run barcode_graph.r.  Loading dplyr,
+# readr, tidyr and ggplot2 takes longer than drawing the plot, so this does the same here:
+#
+#   barcode_report()       - the barcode_ggplot.R plot, from the counts check_barcodes.py has
+#                            in memory.  Writes barcode_L00N_plot_data.txt and barcode_L00N_plot.png
+#                            with the same present/PhiX/unexpected/missing classification.
+#   plot_barcode_data()    - the barcode_graph.r plot from a barcode_L00N_data.txt file, which the
+#                            perl scripts run as:
+#
+#   ~/illuminaprocessing/barcode_plot.py barcode_L001_data.txt barcode_L001_graph.png
+#
+# The plots need matplotlib.  Without it the plot data is still written, plot_barcodes() and
+# plot_barcode_data() return False and the callers run the R scripts as before.
+
+phiX_barcodes = {
+    "ATGTCGCT", "GCACATAG", "TGTGTCGA", "CACAGATC",
+    "ATGTCG", "GCACAT", "TGTGTC", "CACAGA",
+    "ATGTCGCT_CTAGCTCG", "GCACATAG_GACTACTA", "TGTGTCGA_TGTCTGAC", "CACAGATC_ACGAGAGT",
+    "ATGTCG_CTAGCT", "GCACAT_GACTAC", "TGTGTC_TGTCTG", "CACAGA_ACGAGA",
+    "ATGTCG_CTAGCTCG", "GCACAT_GACTACTA", "TGTGTC_TGTCTGAC", "CACAGA_ACGAGAGT"
+}
+
+bar_colours = {"present": "#0aa192", "PhiX": "#a655fb", "unexpected": "#f57600", "missing": "grey"}
+bar_outer = {"present": "#0aa192", "PhiX": "#a655fb", "unexpected": "#f57600", "missing": "#e6308a"}
+
+# RColorBrewer's Set1, used by barcode_graph.r to colour multi-barcode samples
+set1_colours = ["#E41A1C", "#377EB8", "#4DAF4A", "#984EA3", "#FF7F00", "#FFFF33", "#A65628", "#F781BF"]
+
+
+#----------------------------------------------
+#  check_barcodes.py plot (barcode_ggplot.R)
+#----------------------------------------------
+def read_expected_barcodes(exp_bc_file):
+    """Return a list of (bc1, bc2, name) from expected_barcodes.txt, with bc2 "" for single indexed runs."""
+
+    expected = []
+
+    with open(exp_bc_file) as bc:
+        for line in bc:
+            fields = [field.strip() for field in line.rstrip("\n").split(",")]
+            if len(fields) < 2 or fields[0] == "":
+                continue
+            bc2 = "" if fields[1] == "None" else fields[1]
+            expected.append((fields[0], bc2, fields[2] if len(fields) > 2 else ""))
+
+    return expected
+
+
+def classify_barcodes(expected, found, n_seqs_checked):
+    """Return a row for each expected and found barcode, as barcode_ggplot.R makes them.
+
+    expected is a list of (bc1, bc2, name) and found a list of (barcode, count) for the most
+    frequent barcodes.  Each row is a dictionary of bc, name, count, percentage and status, with
+    None where R would have NA, in order of decreasing percentage and missing barcodes last.
+    """
+
+    dual_coded = any(bc2 for bc1, bc2, name in expected)
+    if dual_coded and not all(bc2 for bc1, bc2, name in expected):
+        raise ValueError("Some (but not all) of the expected 2nd barcodes are empty - check the sample sheet in Sierra")
+
+    # a full join of the expected and found barcodes on the barcode
+    rows = []
+    rows_by_bc = {}
+    for bc1, bc2, name in expected:
+        bc = f"{bc1}_{bc2}" if dual_coded else bc1
+        row = {"bc": bc, "name": name, "count": None, "percentage": None}
+        rows.append(row)
+        rows_by_bc.setdefault(bc, []).append(row)
+
+    for bc, count in found:
+        matches = rows_by_bc.get(bc)
+        if matches is None:
+            rows.append({"bc": bc, "name": None, "count": count, "percentage": None})
+            matches = [rows[-1]]
+        for row in matches:
+            row["count"] = count
+
+    for row in rows:
+        if row["count"] is not None:
+            row["percentage"] = 100 * (row["count"] / n_seqs_checked)
+
+    rows.sort(key=lambda row: (row["percentage"] is None, -(row["percentage"] or 0)))
+
+    for row in rows:
+        if row["percentage"] is None:
+            row["status"] = "missing"
+            row["percentage"] = 0
+        elif row["name"] is not None:
+            row["status"] = "present"
+        elif row["bc"] in phiX_barcodes:
+            row["status"] = "PhiX"
+        else:
+            row["status"] = "unexpected"
+
+    return rows
+
+
+def r_number(value):
+    """Format a number the way readr writes a double - shortest form, no trailing .0, R style exponents."""
+
+    if value is None:
+        return "NA"
+
+    text = repr(float(value))
+    if text.endswith(".0"):
+        text = text[:-2]
+
+    if "e" in text:
+        mantissa, exponent = text.split("e")
+        text = f"{mantissa}e{int(exponent)}"
+
+    return text
+
+
+def write_plot_data(plot_data_file, rows):
+    """Write barcode_L00N_plot_data.txt as barcode_ggplot.R does, before the rows are filtered for the plot."""
+
+    with open(plot_data_file, "w") as out:
+        out.write("bc\tname\tcount\tpercentage\tstatus\n")
+        for row in rows:
+            name = row["name"] if row["name"] is not None else "NA"
+            out.write(f"{row['bc']}\t{name}\t{r_number(row['count'])}\t{r_number(row['percentage'])}\t{row['status']}\n")
+
+
+def plot_barcodes(plot_file, rows, n_seqs_checked, n_windows=0):
+    """Draw the barcode_ggplot.R bar chart.  Returns False if matplotlib isn't available.
+
+    n_windows is the number of windows through the files the reads were sampled from, or 0 for the first reads.
+    """
+
+    if plt is None:
+        return False
+
+    # leave out the unexpected barcodes less frequent than every expected one
+    lowest_present = min((row["percentage"] for row in rows if row["status"] == "present"), default=float("inf"))
+    shown = [row for row in rows if not (row["status"] == "unexpected" and row["percentage"] < lowest_present)]
+
+    percentage_shown = round(sum(row["percentage"] for row in shown))
+    n_seqs_text = "10 million" if n_seqs_checked == 10000000 else n_seqs_checked
+
+    # smallest at the bottom, as coord_flip draws them, with ties in order of their labels as reorder() leaves them
+    labels = {id(row): row["bc"] + (f"\n{row['name']}" if row["name"] is not None else "") for row in shown}
+    shown = sorted(shown, key=lambda row: (row["percentage"], labels[id(row)]))
+    labels = [labels[id(row)] for row in shown]
+
+    dpi = 300
+    figure, axes = plt.subplots(figsize=(2000 / dpi, (100 + 100 * len(rows)) / dpi), dpi=dpi)
+    axes.barh(range(len(shown)), [row["percentage"] for row in shown], height=0.9,
+              color=[bar_colours[row["status"]] for row in shown], edgecolor=[bar_outer[row["status"]] for row in shown])
+
+    axes.set_yticks(range(len(shown)), labels, fontsize=3)
+    axes.tick_params(axis="x", labelsize=4)
+    axes.set_ylim(-0.5, len(shown) - 0.5)
+    axes.set_xlim(left=0)
+    axes.set_xlabel("Percentage of reads", fontsize=5)
+    if n_windows > 0:
+        title = f"Barcodes shown explain {percentage_shown}% of {n_seqs_text} reads sampled from {n_windows} windows"
+    else:
+        title = f"Barcodes shown explain {percentage_shown}% of first {n_seqs_text} reads"
+    axes.set_title(title, fontsize=6, pad=8)
+    axes.grid(axis="x", linewidth=0.3, color="#ebebeb")
+    axes.set_axisbelow(True)
+
+    # a legend in place of ggplot's fill/colour guide
+    statuses = [status for status in bar_colours if any(row["status"] == status for row in shown)]
+    handles = [plt.Rectangle((0, 0), 1, 1, facecolor=bar_colours[status], edgecolor=bar_outer[status]) for status in statuses]
+    axes.legend(handles, statuses, title="status", fontsize=4, title_fontsize=4, loc="center left", bbox_to_anchor=(1.01, 0.5), frameon=False)
+
+    figure.tight_layout()
+    figure.savefig(plot_file, dpi=dpi)
+    plt.close(figure)
+
+    return True
+
+
+def barcode_report(barcode_folder, lane, expected, found, n_seqs_checked, n_windows=0):
+    """Write barcode_L00N_plot_data.txt and barcode_L00N_plot.png to barcode_folder.
+
+    Returns False if the plot couldn't be drawn because matplotlib isn't available.
+    """
+
+    rows = classify_barcodes(expected, found, n_seqs_checked)
+    write_plot_data(f"{barcode_folder}/barcode_L00{lane}_plot_data.txt", rows)
+
+    return plot_barcodes(f"{barcode_folder}/barcode_L00{lane}_plot.png", rows, n_seqs_checked, n_windows)
+
+
+#----------------------------------------------
+#  split_barcodes plot (barcode_graph.r)
+#----------------------------------------------
+def plot_barcode_data(data_file, plot_file):
+    """Draw the barcode_graph.r bar chart from a Code/Freq/Name file.  Returns False if matplotlib isn't available."""
+
+    if plt is None:
+        return False
+
+    data = []
+    with open(data_file) as fh:
+        header = fh.readline().rstrip("\n").split("\t")
+        for line in fh:
+            fields = dict(zip(header, line.rstrip("\n").split("\t")))
+            data.append((fields["Code"], float(fields["Freq"]), fields.get("Name", "")))
+
+    data.sort(key=lambda row: row[1])
+
+    all_names = [name for code, freq, name in data if name != ""]
+    multi_barcode = len(all_names) != len(set(all_names))
+    if multi_barcode:
+        data.sort(key=lambda row: row[2])
+
+    total_explained = int(sum(freq * 100 for code, freq, name in data))
+
+    colours = ["red" if name != "" else "grey" for code, freq, name in data]
+
+    # colour multi-barcode samples by sample if there are few enough of them
+    unique_names = list(dict.fromkeys(all_names))
+    if multi_barcode and len(unique_names) < 9:
+        colours = [set1_colours[unique_names.index(name)] if name != "" else "grey" for code, freq, name in data]
+
+    dpi = 100
+    longest_name = max((len(text) for code, freq, name in data for text in (code, name)), default=0)
+    figure, axes = plt.subplots(figsize=(600 / dpi, (100 + 50 * len(data)) / dpi), dpi=dpi)
+    axes.barh(range(len(data)), [freq * 100 for code, freq, name in data], color=colours, edgecolor="black", linewidth=0.5)
+    axes.set_yticks(range(len(data)), [f"{code}\n{name}" for code, freq, name in data], fontsize=8)
+    axes.set_xlabel("Percentage of reads")
+    axes.set_title(f"Barcodes shown explain {total_explained}% of the data", fontweight="bold")
+
+    # room on the left for the labels, as barcode_graph.r widens the margin
+    figure.subplots_adjust(left=min(0.1 + longest_name * 0.012, 0.6), right=0.95)
+    figure.savefig(plot_file, dpi=dpi)
+    plt.close(figure)
+
+    return True
+
+
+def main():
+
+    parser = argparse.ArgumentParser(formatter_class=RawTextHelpFormatter, description = '''Draws the barcode plot from a barcode_L00N_data.txt file written by the split_barcodes scripts, in place of barcode_graph.r''')
+    parser.add_argument('data_file', type=str, help='barcode_L00N_data.txt file with Code, Freq and Name columns')
+    parser.add_argument('plot_file', type=str, help='png file to write')
+    args = parser.parse_args()
+
+    if not plot_barcode_data(args.data_file, args.plot_file):
+        print("matplotlib isn't installed, can't draw the barcode plot", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+#!/bin/python3
+
+# Approximate counting of the most frequent unassigned barcodes during a split.
+#
+# A bad run can have millions of different unassigned index sequences, so rather
+# than counting all of them the splitter keeps a Space-Saving sketch (Metwally,
+# Agrawal and El Abbadi, 2005) with a fixed number of slots.  When a barcode
+# turns up which isn't in the sketch and every slot is taken, it replaces the
+# barcode with the smallest count and takes over that count as its possible
+# overcount.  This means that:
+#
+#   - every barcode seen more than total/capacity times is in the sketch
+#   - a reported count is never below the true count, and at most max_overcount above it
+#
+# which is plenty to see which barcodes the unassigned reads have, e.g. a sample
+# missing from the sample sheet or an index read that needs reverse complementing.
+
+import heapq
+
+
+class SpaceSaving:
+    """Approximate counts for the most frequent items of a stream, in at most capacity slots."""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = {}   # item -> [count, max_overcount]
+        self.heap = []     # (count, item) with out of date entries, the smallest count is found lazily
+        self.total = 0
+
+    def update(self, item, count=1):
+        """Add count occurrences of item."""
+
+        self.total += count
+        entry = self.counts.get(item)
+
+        if entry is not None:
+            entry[0] += count
+            heapq.heappush(self.heap, (entry[0], item))
+
+        elif len(self.counts) < self.capacity:
+            self.counts[item] = [count, 0]
+            heapq.heappush(self.heap, (count, item))
+
+        else:
+            smallest_count, smallest_item = self._pop_smallest()
+            del self.counts[smallest_item]
+            self.counts[item] = [smallest_count + count, smallest_count]
+            heapq.heappush(self.heap, (smallest_count + count, item))
+
+        # old entries are only dropped when they reach the top, so tidy up now and again
+        if len(self.heap) > 4 * self.capacity:
+            self.heap = [(entry[0], item) for item, entry in self.counts.items()]
+            heapq.heapify(self.heap)
+
+    def _pop_smallest(self):
+        while True:
+            count, item = heapq.heappop(self.heap)
+            entry = self.counts.get(item)
+
+            if entry is not None and entry[0] == count:
+                return count, item
+
+    def top(self, n=None):
+        """Return up to n (item, count, max_overcount) tuples, most frequent first."""
+
+        ranked = sorted(self.counts.items(), key=lambda item_entry: (-item_entry[1][0], item_entry[0]))
+        return [(item, count, overcount) for item, (count, overcount) in ranked[:n]]
+
+    def guaranteed_threshold(self):
+        """Any item seen more than this many times is sure to be in the sketch."""
+        return self.total // self.capacity
+
+    def to_state(self):
+        """Return the contents as JSON-friendly lists, for checkpoints.  Items have to be bytes."""
+        return {"total": self.total, "counts": [[item.decode(), count, overcount] for item, (count, overcount) in self.counts.items()]}
+
+    def load_state(self, state):
+        self.total = state["total"]
+        self.counts = {item.encode(): [count, overcount] for item, count, overcount in state["counts"]}
+        self.heap = [(entry[0], item) for item, entry in self.counts.items()]
+        heapq.heapify(self.heap)
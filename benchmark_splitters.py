@@ -0,0 +1,311 @@
+#!/bin/python3
+
+import subprocess, sys, os, json, time, resource, socket
+import argparse
+from argparse import RawTextHelpFormatter
+from datetime import datetime
+from glob import glob
+
+from decompression import open_gzip
+
+# Benchmarks the splitting scripts on a synthetic lane so that changes can be compared.
+#
+# A lane is made with make_synthetic_lane.py (or an existing one is reused), then each
+# splitter is run on it against the Sierra stand-in in sierra_standin/ and the results
+# are written to a JSON file:
+#
+#   reads/s and MB/s (of uncompressed input), wall time, user and system CPU and peak RSS
+#   and, for the python splitter, the seconds spent in each stage from its metrics file
+#
+# A decompression-only pass over the input files is timed first, which is the floor for
+# how fast any of the splitters can go.  Comparing the JSON from two commits shows the
+# change in each number:
+#
+#   ~/illuminaprocessing/benchmark_splitters.py --reads 2000000 --output before.json
+#   (check out the new code)
+#   ~/illuminaprocessing/benchmark_splitters.py --reads 2000000 --output after.json
+#   ~/illuminaprocessing/benchmark_splitters.py --compare before.json after.json
+#
+# Options after -- are passed on to split_barcodes_aviti.py, e.g. -- --max_mismatches 1
+#
+# --workers 1 2 4 8 runs the python splitter once with each number of --workers and prints how
+# much faster each is than one process, to check how the matching scales:
+#
+#   ~/illuminaprocessing/benchmark_splitters.py --reads 2000000 --workers 1 2 4 8
+
+prepath = "/primary/"
+script_folder = os.path.dirname(os.path.abspath(__file__))
+standin_folder = os.path.join(script_folder, "sierra_standin")
+
+splitters = ["python", "perl"]
+
+parser = argparse.ArgumentParser(formatter_class=RawTextHelpFormatter, description = '''Benchmarks the barcode splitting scripts on a synthetic lane''')
+parser.add_argument('--run_folder', type=str, default="", help='Synthetic run folder under /primary. Default: made from the lane options')
+parser.add_argument('--reads', type=int, default=1000000, help='Number of reads in the synthetic lane. Default: 1000000')
+parser.add_argument('--samples', type=int, default=24, help='Number of samples. Default: 24')
+parser.add_argument('--single_index', default=False, action='store_true', help='Single rather than dual indexed lane')
+parser.add_argument('--single_end', default=False, action='store_true', help='Single end rather than paired end lane')
+parser.add_argument('--read_length', type=int, default=150, help='Read length. Default: 150')
+parser.add_argument('--index_length', type=int, default=8, help='Index read length. Default: 8')
+parser.add_argument('--n_rate', type=float, default=0.001, help='Fraction of N bases. Default: 0.001')
+parser.add_argument('--unassigned_fraction', type=float, default=0.05, help='Fraction of reads with unexpected indexes. Default: 0.05')
+parser.add_argument('--splitters', type=str, nargs='+', default=["python"], choices=splitters, help='Splitters to run. Default: python')
+parser.add_argument('--workers', type=int, nargs='+', default=[], help='Run the python splitter with each of these numbers of --workers and report the scaling. Default: once, with the splitter\'s default')
+parser.add_argument('--repeats', type=int, default=1, help='Number of times to run each splitter, the fastest run is kept. Default: 1')
+parser.add_argument('--output', type=str, default="", help='JSON file for the results. Default: benchmark_[commit]_[date].json')
+parser.add_argument('--compare', type=str, nargs=2, default=None, metavar=('OLD', 'NEW'), help='Compare two results files rather than running anything')
+parser.add_argument('splitter_options', nargs='*', help='Options passed on to split_barcodes_aviti.py, after --')
+
+
+def main():
+
+    args = parser.parse_args()
+
+    if args.compare:
+        compare_results(*args.compare)
+        return
+
+    run_folder = args.run_folder or synthetic_run_name(args)
+    print(datetime.now(), flush = True)
+
+    make_lane(args, run_folder)
+
+    results = {
+        "commit": git_commit(),
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "host": socket.gethostname(),
+        "cpus": os.cpu_count(),
+        "run_folder": run_folder,
+        "lane": {
+            "reads": args.reads, "samples": args.samples, "single_index": args.single_index, "single_end": args.single_end,
+            "read_length": args.read_length, "index_length": args.index_length, "n_rate": args.n_rate,
+            "unassigned_fraction": args.unassigned_fraction
+        },
+        "splitter_options": args.splitter_options,
+        "splitters": {}
+    }
+
+    input_files = lane_input_files(run_folder)
+    input_bytes = {}
+
+    results["decompression"] = time_decompression(input_files, input_bytes)
+    results["input_mb"] = sum(input_bytes.values()) / 1e6
+    report("decompression", results["decompression"])
+
+    for splitter in args.splitters:
+        # the python splitter is run once for each number of workers asked for
+        variants = [(splitter, [])]
+        if splitter == "python" and args.workers:
+            variants = [(f"python_w{n}", ["--workers", str(n)]) for n in args.workers]
+
+        for name, options in variants:
+            runs = [run_splitter(splitter, run_folder, args, results, name, options) for _ in range(args.repeats)]
+            best = min(runs, key=lambda run: run["wall_s"])
+            results["splitters"][name] = best
+            report(name, best)
+
+    if len(args.workers) > 1 and "python" in args.splitters:
+        report_scaling(results["splitters"], args.workers)
+
+    output = args.output or f"benchmark_{results['commit'][:8]}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+    with open(output, "w") as fh:
+        json.dump(results, fh, indent=1)
+
+    print(f"\nResults written to {output}")
+
+#----------------------------------------------
+#  the synthetic lane
+#----------------------------------------------
+def synthetic_run_name(args):
+    index = "single" if args.single_index else "dual"
+    ends = "SE" if args.single_end else "PE"
+    return f"synthetic_{args.reads}_{args.samples}_{index}_{ends}{args.read_length}_n{args.n_rate}_u{args.unassigned_fraction}"
+
+
+def make_lane(args, run_folder):
+    """Make the synthetic lane unless it's already there, the same options always give the same files."""
+
+    if os.path.exists(f"{prepath}{run_folder}/sierra_standin.json") and ("perl" not in args.splitters or os.path.exists(f"{prepath}{run_folder}_perl/RunInfo.xml")):
+        print(f"Reusing the synthetic lane in {prepath}{run_folder}", flush = True)
+        return
+
+    command = [sys.executable, os.path.join(script_folder, "make_synthetic_lane.py"),
+               "--reads", str(args.reads), "--samples", str(args.samples),
+               "--read_length", str(args.read_length), "--index_length", str(args.index_length),
+               "--n_rate", str(args.n_rate), "--unassigned_fraction", str(args.unassigned_fraction)]
+
+    if args.single_index:
+        command.append("--single_index")
+    if args.single_end:
+        command.append("--single_end")
+    if "perl" in args.splitters:
+        command.append("--perl")
+
+    command.append(run_folder)
+    subprocess.run(command, check=True)
+
+
+def lane_input_files(run_folder):
+    return sorted(glob(f"{prepath}{run_folder}/Unaligned/Project_External/Sample_lane1/lane1_NoIndex_L001_*.fastq.gz"))
+
+
+def clear_outputs(lane_folder):
+    """Remove the split files from an earlier run, leaving the input files."""
+
+    for filename in glob(f"{lane_folder}/*.fastq.gz"):
+        if "_NoIndex_" not in os.path.basename(filename):
+            os.remove(filename)
+
+#----------------------------------------------
+#  time things
+#----------------------------------------------
+def time_decompression(input_files, input_bytes):
+    """Read every input file through open_gzip, which is all the reading any splitter has to do."""
+
+    # the pipe backend decompresses in child processes
+    start_usage = [resource.getrusage(who) for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+    start = time.perf_counter()
+
+    for filename in input_files:
+        input_bytes[filename] = 0
+        fh = open_gzip(filename)
+        try:
+            while True:
+                block = fh.read(4 * 1024 * 1024)
+                if not block:
+                    break
+                input_bytes[filename] += len(block)
+        finally:
+            fh.close()
+
+    wall = time.perf_counter() - start
+    end_usage = [resource.getrusage(who) for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+
+    return {
+        "wall_s": wall,
+        "user_s": sum(end.ru_utime - start.ru_utime for start, end in zip(start_usage, end_usage)),
+        "sys_s": sum(end.ru_stime - start.ru_stime for start, end in zip(start_usage, end_usage)),
+        "mb_per_s": sum(input_bytes.values()) / 1e6 / wall
+    }
+
+
+def run_splitter(splitter, run_folder, args, results, name, extra_options):
+
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [standin_folder, env.get("PYTHONPATH")]))
+    env["PERL5LIB"] = os.pathsep.join(filter(None, [standin_folder, env.get("PERL5LIB")]))
+    env["PATH"] = os.pathsep.join([os.path.join(standin_folder, "bin"), env["PATH"]])
+    env["SIERRA_STANDIN"] = f"{prepath}{run_folder}/sierra_standin.json"
+
+    if splitter == "python":
+        folder = f"{prepath}{run_folder}"
+        command = [sys.executable, os.path.join(script_folder, "split_barcodes_aviti.py")] + args.splitter_options + extra_options + [run_folder]
+    else:
+        folder = f"{prepath}{run_folder}_perl"
+        command = ["perl", os.path.join(script_folder, "split_barcodes"), "--single_pass", f"{run_folder}_perl"]
+
+    clear_outputs(f"{folder}/Unaligned/Project_External/Sample_lane1")
+    for filename in glob(f"{folder}/Unaligned/Project_External/Sample_lane1/splitting_metrics_L001.*"):
+        os.remove(filename)
+
+    print(f"\nRunning {' '.join(command)}", flush = True)
+    log_filename = f"{folder}/benchmark_{name}.log"
+
+    with open(log_filename, "w") as log:
+        start = time.perf_counter()
+        process = subprocess.Popen(command, cwd=folder, env=env, stdout=log, stderr=subprocess.STDOUT)
+        # the usage from wait4 includes the worker processes the splitter waited for
+        _, status, usage = os.wait4(process.pid, 0)
+        wall = time.perf_counter() - start
+        process.returncode = os.waitstatus_to_exitcode(status)
+
+    if process.returncode != 0:
+        print(f"!! {splitter} splitter failed with exit code {process.returncode}, see {log_filename} !!")
+
+    result = {
+        "command": command,
+        "exit_code": process.returncode,
+        "wall_s": wall,
+        "user_s": usage.ru_utime,
+        "sys_s": usage.ru_stime,
+        "peak_rss_mb": usage.ru_maxrss / 1024,
+        "reads_per_s": args.reads / wall,
+        "mb_per_s": results["input_mb"] / wall
+    }
+
+    # the python splitter's own timings of each stage, from the last line of its metrics
+    metrics_filename = f"{folder}/Unaligned/Project_External/Sample_lane1/splitting_metrics_L001.jsonl"
+    if splitter == "python" and os.path.exists(metrics_filename):
+        with open(metrics_filename) as fh:
+            lines = fh.readlines()
+        if lines:
+            result["stage_seconds"] = json.loads(lines[-1])["stage_seconds"]
+
+    return result
+
+
+def report(name, result):
+    line = f"{name:<14} {result['wall_s']:8.2f}s wall {result['user_s']:8.2f}s user {result['sys_s']:7.2f}s sys {result['mb_per_s']:8.1f} MB/s"
+    if "reads_per_s" in result:
+        line += f" {result['reads_per_s']:10,.0f} reads/s {result['peak_rss_mb']:8.1f} MB peak RSS"
+    print(line, flush = True)
+
+def report_scaling(splitter_results, workers):
+    """Print the speed up of each number of workers over the fewest, and how close that is to linear."""
+
+    fewest = min(workers)
+    base = splitter_results[f"python_w{fewest}"]
+
+    print(f"\n{'workers':>8} {'wall s':>8} {'speed up':>9} {'efficiency':>11}")
+    for n in sorted(workers):
+        result = splitter_results[f"python_w{n}"]
+        speed_up = base["wall_s"] / result["wall_s"]
+        print(f"{n:>8} {result['wall_s']:8.2f} {speed_up:8.2f}x {100 * speed_up * fewest / n:10.0f}%")
+
+#----------------------------------------------
+#  compare two sets of results
+#----------------------------------------------
+def compare_results(old_filename, new_filename):
+
+    with open(old_filename) as fh:
+        old = json.load(fh)
+    with open(new_filename) as fh:
+        new = json.load(fh)
+
+    print(f"old: {old['commit'][:8]} {old['date']} on {old['host']}")
+    print(f"new: {new['commit'][:8]} {new['date']} on {new['host']}")
+
+    if old["lane"] != new["lane"] or old["splitter_options"] != new["splitter_options"]:
+        print("!! The lanes or splitter options are different, so the numbers aren't directly comparable !!")
+
+    stages = {"decompression": (old["decompression"], new["decompression"])}
+    for splitter in old["splitters"]:
+        if splitter in new["splitters"]:
+            stages[splitter] = (old["splitters"][splitter], new["splitters"][splitter])
+
+    print(f"\n{'':<14} {'measure':<14} {'old':>12} {'new':>12} {'change':>8}")
+
+    for name, (old_result, new_result) in stages.items():
+        for measure in ("wall_s", "user_s", "sys_s", "mb_per_s", "reads_per_s", "peak_rss_mb"):
+            if measure in old_result and measure in new_result:
+                print_change(name, measure, old_result[measure], new_result[measure])
+
+        for stage in old_result.get("stage_seconds", {}):
+            if stage in new_result.get("stage_seconds", {}):
+                print_change(name, stage, old_result["stage_seconds"][stage], new_result["stage_seconds"][stage])
+
+
+def print_change(name, measure, old_value, new_value):
+    change = 100 * (new_value - old_value) / max(old_value, 1e-9)
+    print(f"{name:<14} {measure:<14} {old_value:12.2f} {new_value:12.2f} {change:+7.1f}%")
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=script_folder, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+if __name__ == "__main__":
+    main()
@@ -2,17 +2,52 @@
 
 import subprocess
 import os
+import heapq
+import gzip
+import json
+import math
+from statistics import NormalDist
 import mysql.connector
 import argparse
 from argparse import RawTextHelpFormatter
+from collections import Counter
 
-transtable = str.maketrans("GATC","CTAG")
+from decompression import open_gzip
+from fastq_parser import read_matched_batches
+from gzip_index import GzipIndex, get_index, read_matched_windows, indexed_gzip
+from read_structure import parse_read_structure, read_structure_from_options, compile_index_extractor
+from barcode_plot import read_expected_barcodes, barcode_report
+
+transtable = bytes.maketrans(b"ATCG", b"TAGC")
 
 # can be run from anywhere on the pipeline server
 # ~/illuminaprocessing/check_barcodes.py [run_folder] --lane [1/2] > barcode.log
 
 # TODO: Add a note to the log/flag somewhere if seqs have been reverse complemented
 
+# The index reads are counted as they are read, I1 and I2 together, rather than being written out
+# to temporary files and sorted.  Each distinct raw I1/I2 pair is only shortened and reverse
+# complemented once, and the most frequent barcodes are picked out without sorting all of them.
+#
+# The first reads come from the first tiles, which aren't always typical of the whole run.  With
+# --sample_windows K the reads are taken instead from K evenly spaced windows through the files,
+# read at the same time using the gzip_index.py indexes (made here if process_aviti.py hasn't).
+# Without the indexed_gzip package a file written as a single gzip member can only be read from the
+# start, so then the first reads are used after all - reading windows through it would mean
+# decompressing nearly all of it.
+#
+# --auto_orient tries every combination of the splitter's --i1_revcomp, --i2_revcomp, --switch_i1_i2,
+# --i1_trim and --barcode_length_i1/i2 options on the counts of the distinct I1/I2 pairs, so the reads
+# are only read once.  The combinations are ranked by how many reads they would assign to the expected
+# barcodes and written to orientation_check.txt along with the split_barcodes_aviti.py command for each.
+# The barcodes are taken out of the index reads by the splitter's own read structure code, so the
+# split assigns what is reported here (without mismatches).
+#
+# The counts of the distinct raw I1/I2 pairs are kept in raw_index_counts.txt.gz in the lane folder,
+# along with the size and modification time of the index files and the number of reads and windows
+# they came from.  Rerunning with different --i1_revcomp, --barcode_lengthI1, --switch_i1_i2 etc.
+# options uses the saved counts rather than reading the index files again, unless --recount is given.
+
 #n_fastq_lines = 40000000 # 10 million sequences
 
 parser = argparse.ArgumentParser(formatter_class=RawTextHelpFormatter, description = '''Checks the first 10 million barcodes and runs an R script to create a barcode plot.''')
@@ -24,6 +59,13 @@ parser.add_argument('--i2_revcomp', default=False, action='store_true', help='Re
 parser.add_argument('--switch_i1_i2', default=False, action='store_true', help='Swap all I1 seqs for I2 seqs')
 parser.add_argument('--barcode_lengthI1', type=int, default=0, help='If barcode length differs from actual length of sequences in the index file(s).')
 parser.add_argument('--barcode_lengthI2', type=int, default=0, help='If barcode length differs from actual length of sequences in the index file(s).')
+parser.add_argument('--sample_windows', type=int, default=0, help='Take the reads from this many evenly spaced windows through the whole file rather than from the start. Default: 0 (from the start)')
+parser.add_argument('--auto_orient', default=False, action='store_true', help='''Work out the orientation, swap and trimming of the index reads which assigns the most reads to the expected barcodes.
+    The --i1_revcomp, --i2_revcomp, --switch_i1_i2 and --barcode_length options are ignored.''')
+parser.add_argument('--adaptive_precision', type=float, default=0, help='''Stop counting once the percentage of reads for every expected barcode, and the unassigned percentage, is known to within this many percent
+    (e.g. 0.1), checking after 100,000 reads then 200,000, 400,000 and so on up to --n_lines. Not used with --sample_windows. Default: 0, count them all''')
+parser.add_argument('--confidence', type=float, default=0.95, help='Confidence level for --adaptive_precision. Default: 0.95')
+parser.add_argument('--recount', default=False, action='store_true', help='Count the index reads again even if there are saved counts for the same files and number of reads')
 parser.add_argument('--no_sierra_bc', default=False, action='store_true', help='''Do not pull barcodes from Sierra. 
     If this flag is used, a file named expected_barcodes.txt should be present in /Unaligned/Project_External/Sample_laneX in the format bc1,bc2,name''')
 
@@ -38,12 +80,18 @@ n_fastq_lines = int(args.n_lines)
 switch_i1_i2 = args.switch_i1_i2
 bc_length_i1 = int(args.barcode_lengthI1)
 bc_length_i2 = int(args.barcode_lengthI2)
+n_windows = args.sample_windows
+auto_orient = args.auto_orient
+recount = args.recount
+adaptive_precision = args.adaptive_precision / 100
+confidence = args.confidence
+
+counts_cache_name = "raw_index_counts.txt.gz"
 
 n_seqs = int(n_fastq_lines/4)
 
 #print("First flush... ", flush = True)
 #print(f"\n Not flushing... Checking first {n_seqs} reads for expected_barcodes for run folder {run_folder} ")
-print(f"\nChecking first {n_seqs} index reads for expected_barcodes for run folder {run_folder} ", flush = True)
 
 def main():
 
@@ -60,31 +108,130 @@ def main():
             print(err)        
     
     else:
-        bc_count = get_expected_barcodes(run_folder, lane_no, switch_i1_i2)
+        # the orientation check works out whether I1 and I2 need swapping itself
+        bc_count = get_expected_barcodes(run_folder, lane_no, switch_i1_i2 and not auto_orient)
 
-    n_bars_to_check = str(bc_count+10)
+    n_bars_to_check = bc_count+10
 
-    get_barcodes_I1(run_folder, lane_no, I1_revcomp, bc_length_i1)
+    lane_folder = f"/primary/{run_folder}/Unaligned/Project_External/Sample_lane{lane_no}"
+    I1_file = f"{lane_folder}/lane{lane_no}_NoIndex_L00{lane_no}_I1.fastq.gz"
+    I2_file = f"{lane_folder}/lane{lane_no}_NoIndex_L00{lane_no}_I2.fastq.gz"
 
-    I2_file = f"/primary/{run_folder}/Unaligned/Project_External/Sample_lane{lane_no}/lane{lane_no}_NoIndex_L00{lane_no}_I2.fastq.gz"
-    if os.path.exists(I2_file):
-        dual_coded = True
-        get_barcodes_I2(run_folder, lane_no, I2_revcomp, bc_length_i2)
-        sort_top_barcodes(run_folder, n_bars_to_check, dual_coded)
-    else:
+    if not os.path.exists(I2_file):
         print("Single indexed library")
-        dual_coded = False
-        sort_top_barcodes(run_folder, n_bars_to_check, dual_coded)
+        I2_file = None
 
+    # the windows are only worth reading if the files can be read from part way through
+    windows = n_windows
+    indexes = None
+    if windows > 0:
+        try:
+            indexes = window_indexes(I1_file, I2_file)
+        except Exception as err:
+            print(f"\n !! Couldn't index the index reads, using the first {n_seqs} reads instead !!")
+            print(err)
+
+        if indexes is None:
+            windows = 0
+
+    # the adaptive scan checks the fractions of the expected barcodes as it goes
+    adaptive = adaptive_precision > 0 and windows == 0
+
+    if windows > 0:
+        print(f"\nChecking up to {n_seqs} index reads sampled from {windows} windows through the files for expected_barcodes for run folder {run_folder} ", flush = True)
+    elif adaptive:
+        print(f"\nChecking index reads for expected_barcodes for run folder {run_folder} until the barcode fractions are within {args.adaptive_precision}% (up to the first {n_seqs} reads)", flush = True)
+    else:
+        print(f"\nChecking first {n_seqs} index reads for expected_barcodes for run folder {run_folder} ", flush = True)
+
+    settled = None
+    if adaptive:
+        try:
+            expected = read_expected_barcodes(f"{lane_folder}/expected_barcodes.txt")
+            z = NormalDist().inv_cdf((1 + confidence) / 2)
+            settled = lambda counts, n_counted: fractions_settled(counts, n_counted, expected, adaptive_precision, z)
+
+        except Exception as err:
+            print(f"\n !! Couldn't read the expected barcodes, counting the first {n_seqs} reads instead !!")
+            print(err)
+            adaptive = False
+
+    # the raw counts only depend on the files and which reads are counted, not on the other options
+    cache_file = f"{lane_folder}/{counts_cache_name}"
+    cache_key = {"files": [file_fingerprint(I1_file), file_fingerprint(I2_file)], "n_seqs": n_seqs, "sample_windows": windows}
+    if adaptive:
+        cache_key["adaptive"] = [adaptive_precision, confidence]
+    raw_counts = None if recount else load_raw_counts(cache_file, cache_key)
+    saved_counts = None
+
+    if raw_counts is not None:
+        print(f"Using the saved index read counts in {cache_file}", flush = True)
+
+        # where an adaptive scan stopped also depends on the orientation options and the expected
+        # barcodes, so counts which stopped early have to have settled with these ones too
+        n_saved = sum(raw_counts.values())
+        if adaptive and n_saved < n_seqs and not settled(raw_counts, n_saved):
+            print(f"The saved counts of {n_saved} reads haven't settled with these options, carrying on counting", flush = True)
+            saved_counts = raw_counts
+            raw_counts = None
+
+    if raw_counts is None:
+        try:
+            if windows > 0:
+                raw_counts = count_sampled_index_reads(indexes, n_seqs, windows)
+            else:
+                raw_counts = count_index_reads(I1_file, I2_file, n_seqs, settled, saved_counts)
+
+            save_raw_counts(cache_file, cache_key, raw_counts)
+
+        except Exception as err:
+            print("\n !! Couldn't count the index reads !!")
+            print(err)
+            raw_counts = saved_counts if saved_counts is not None else Counter()
+
+    barcode_counts = None
+
+    if auto_orient:
+        barcode_counts = check_orientations(raw_counts, f"{lane_folder}/expected_barcodes.txt", f"{lane_folder}/orientation_check.txt")
+
+    # without the orientation check (or if it couldn't be done) the options given are used
+    if barcode_counts is None:
+        if bc_length_i1 > 0:
+            print(f"Shortening I1 sequences to {bc_length_i1} bases", flush = True)
+        if I2_file is not None and bc_length_i2 > 0:
+            print(f"Shortening I2 sequences to {bc_length_i2} bases", flush = True)
+
+        barcode_counts = transform_counts(raw_counts, I1_revcomp, I2_revcomp, bc_length_i1, bc_length_i2)
+
+    found = top_barcodes(barcode_counts, n_bars_to_check)
+    write_found_barcodes(f"{lane_folder}/found_barcodes.txt", found)
+
+    # the plot's percentages are of the reads actually counted - fewer than n_seqs if the adaptive scan
+    # stopped early, the file was shorter, or the reads were split between windows
+    n_checked = sum(raw_counts.values()) if adaptive or windows > 0 else n_seqs
+
+    # the plot is drawn here from the counts, or by barcode_ggplot.R if matplotlib isn't installed
+    plotted = False
     try:
-        R_cmd = f"Rscript /home/sbsuser/illuminaprocessing/barcode_ggplot.R {run_folder} {n_seqs} {lane_no}"
-        print(f"\n Running plotting script with following command: {R_cmd}", flush = True)
-        subprocess.run(R_cmd, shell=True, executable="/bin/bash")
+        expected = read_expected_barcodes(f"{lane_folder}/expected_barcodes.txt")
+        plotted = barcode_report(lane_folder, lane_no, expected, found, n_checked, windows)
+        if plotted:
+            print(f"\nBarcode plot written to {lane_folder}/barcode_L00{lane_no}_plot.png", flush = True)
 
     except Exception as err:
-        print(f"\n !! Couldn't run barcode plot script barcode_ggplot.R on {run_folder} !!")
+        print(f"\n !! Couldn't draw the barcode plot for {run_folder} !!")
         print(err)
 
+    if not plotted:
+        try:
+            R_cmd = f"Rscript /home/sbsuser/illuminaprocessing/barcode_ggplot.R {run_folder} {n_checked} {lane_no} {windows}"
+            print(f"\n Running plotting script with following command: {R_cmd}", flush = True)
+            subprocess.run(R_cmd, shell=True, executable="/bin/bash")
+
+        except Exception as err:
+            print(f"\n !! Couldn't run barcode plot script barcode_ggplot.R on {run_folder} !!")
+            print(err)
+
     print("\nAll done. \nCheck barcode plot before running the barcode splitting script.\n")
 
  
@@ -92,95 +239,391 @@ def main():
 #---------------------
 # quick barcode check
 #---------------------
-def get_barcodes_I1(run_folder, lane_no, revcomp, bc_length_i1):
+def count_index_reads(I1_file, I2_file, n_seqs, settled=None, raw_counts=None):
+    """Return a Counter of the raw (I1, I2) sequence pairs in the first n_seqs reads, with I2 None for single indexed runs.
+
+    If settled is given it's called as settled(raw_counts, n_counted) after 100,000 reads, then
+    200,000, 400,000 and so on, and counting stops early once it returns True.  Counts already
+    made from the start of the files can be given as raw_counts to carry on from where they stopped.
+    """
+
+    raw_counts = Counter(raw_counts)
+    fhs = [open_gzip(I1_file)]
+    if I2_file is not None:
+        fhs.append(open_gzip(I2_file))
 
     try:
-        os.chdir(f"/primary/{run_folder}/Unaligned/Project_External/Sample_lane{lane_no}/")
+        n_counted = sum(raw_counts.values())
+        next_check = 100000
+        while next_check <= n_counted:
+            next_check *= 2
+
+        for batch in read_matched_batches(fhs, 100000, skip_records=n_counted):
+            sequences_I1 = batch[0][1::4]
+            n_records = min(len(sequences_I1), n_seqs - n_counted)
+
+            if I2_file is not None:
+                raw_counts.update(zip(sequences_I1[:n_records], batch[1][1:4 * n_records:4]))
+            else:
+                raw_counts.update(zip(sequences_I1[:n_records], [None] * n_records))
+
+            n_counted += n_records
+            if n_counted >= n_seqs:
+                if settled is not None:
+                    if settled(raw_counts, n_counted):
+                        print(f"The barcode fractions settled after {n_counted} reads", flush = True)
+                    else:
+                        print(f"The barcode fractions hadn't settled after {n_counted} reads (limit reached)", flush = True)
+                break
+
+            if settled is not None and n_counted >= next_check:
+                if settled(raw_counts, n_counted):
+                    print(f"The barcode fractions settled after {n_counted} reads, stopped counting", flush = True)
+                    break
+                next_check *= 2
 
-        bc_check_cmd = f"zcat lane{lane_no}_NoIndex_L00{lane_no}_I1.fastq.gz | head -n {n_fastq_lines} | awk 'NR % 4 == 2'"
+        else:
+            if settled is not None:
+                print(f"The barcode fractions hadn't settled by the end of the file ({n_counted} reads)", flush = True)
 
-        if bc_length_i1 > 0:
-            print(f"Shortening I1 sequences to {bc_length_i1} bases", flush = True)
-            bc_check_cmd = f"{bc_check_cmd} | cut -c 1-{bc_length_i1}"
+    finally:
+        for fh in fhs:
+            fh.close()
 
-        if revcomp:
-            #bc_check_cmd = f"zcat lane{lane_no}_NoIndex_L00{lane_no}_I1.fastq.gz | head -n {n_fastq_lines} | awk 'NR % 4 == 2' | tr 'ATCG' 'TAGC' | rev > i1_head.txt"
-            bc_check_cmd = f"{bc_check_cmd} | tr 'ATCG' 'TAGC' | rev" 
-        #else:
-        #    bc_check_cmd = f"zcat lane{lane_no}_NoIndex_L00{lane_no}_I1.fastq.gz | head -n {n_fastq_lines} | awk 'NR % 4 == 2' > i1_head.txt"
+    return raw_counts
 
-        bc_check_cmd = f"{bc_check_cmd} > i1_head.txt"
 
-        try:
-            subprocess.run(bc_check_cmd, shell=True, executable="/bin/bash")
-            
-        except Exception as err:
-            print("\n !! Couldn't run barcode checking command !!")
-            print(err)
-            
+def window_indexes(I1_file, I2_file):
+    """Return the gzip indexes of the index files, or None if reading windows from them would mean reading most of each file."""
+
+    indexes = []
+
+    for filename in (I1_file, I2_file):
+        if filename is None:
+            continue
+
+        index = GzipIndex.load(filename)
+
+        # without indexed_gzip, making the index is a pass through the whole file
+        if index is None and indexed_gzip is None:
+            print(f"\n !! {filename} hasn't been indexed and indexed_gzip isn't installed, using the first {n_seqs} reads instead (run gzip_index.py on it first) !!", flush = True)
+            return None
+
+        if index is None:
+            index = get_index(filename)
+
+        if len(index.checkpoints) < 2:
+            print(f"\n !! {filename} can only be read from the start (install indexed_gzip to read it from anywhere), using the first {n_seqs} reads instead !!", flush = True)
+            return None
+
+        indexes.append(index)
+
+    return indexes
+
+
+def count_sampled_index_reads(indexes, n_seqs, n_windows):
+    """Return a Counter of the raw (I1, I2) sequence pairs in n_seqs reads spread over n_windows evenly spaced windows."""
+
+    raw_counts = Counter()
+
+    n_records = min(index.n_records for index in indexes)
+    if len(set(index.n_records for index in indexes)) > 1:
+        print(f"\n !! I1 and I2 have different numbers of reads, only using the first {n_records} !!")
+
+    window_size = min(n_seqs, n_records) // n_windows
+    starts = [k * n_records // n_windows for k in range(n_windows)]
+    print(f"Counting {window_size} reads from each of {n_windows} windows through {n_records} reads", flush = True)
+
+    for batch in read_matched_windows(indexes, starts, window_size):
+        if len(indexes) > 1:
+            raw_counts.update(zip(batch[0][1::4], batch[1][1::4]))
+        else:
+            raw_counts.update(zip(batch[0][1::4], [None] * (len(batch[0]) // 4)))
+
+    return raw_counts
+
+
+def file_fingerprint(filename):
+    if filename is None:
+        return None
+
+    stat = os.stat(filename)
+    return [filename, stat.st_size, stat.st_mtime]
+
+
+def save_raw_counts(cache_file, cache_key, raw_counts):
+    """Write the raw counts as "count I1 I2" lines after a line with the key they were counted with."""
+
+    try:
+        temp_file = f"{cache_file}.tmp"
+        with gzip.open(temp_file, "wb", compresslevel=1) as cache:
+            cache.write(json.dumps(cache_key).encode() + b"\n")
+            for (I1, I2), count in raw_counts.items():
+                cache.write(b"%d %s %s\n" % (count, I1, I2 if I2 is not None else b"-"))
+        os.replace(temp_file, cache_file)
+
     except Exception as err:
-            print("\n !! Couldn't run barcode checking command !!")
-            print(err)
+        print("\n !! Couldn't save the index read counts !!")
+        print(err)
+
+
+def load_raw_counts(cache_file, cache_key):
+    """Return the saved raw counts if they were counted with the same key, otherwise None."""
+
+    try:
+        with gzip.open(cache_file, "rb") as cache:
+            if json.loads(cache.readline()) != cache_key:
+                return None
+
+            raw_counts = Counter()
+            for line in cache:
+                count, I1, I2 = line.split()
+                raw_counts[(I1, I2 if I2 != b"-" else None)] = int(count)
+
+        return raw_counts
+
+    except (OSError, ValueError):
+        return None
+
+
+def transform_index(sequence, revcomp, bc_length):
+    """Shorten the sequence to bc_length (if it's set) then reverse complement it if asked to."""
+
+    if bc_length > 0:
+        sequence = sequence[:bc_length]
+    if revcomp:
+        sequence = sequence.translate(transtable)[::-1]
+
+    return sequence
+
+
+def transform_counts(raw_counts, i1_revcomp, i2_revcomp, bc_length_i1, bc_length_i2):
+    """Return the counts of each barcode (I1 or I1_I2) once the options have been applied to the raw pairs."""
+
+    barcode_counts = Counter()
+
+    for (I1, I2), count in raw_counts.items():
+        barcode = transform_index(I1, i1_revcomp, bc_length_i1)
+        if I2 is not None:
+            barcode += b"_" + transform_index(I2, i2_revcomp, bc_length_i2)
+        barcode_counts[barcode] += count
+
+    return barcode_counts
 
 
 #---------------------
-# quick barcode check
+# orientation check
 #---------------------
-def get_barcodes_I2(run_folder, lane_no, revcomp, bc_length_i2):
+def reverse_complement(sequence):
+    return sequence.translate(transtable)[::-1]
+
+
+def most_common_length(sequence_counts):
+    lengths = Counter()
+    for sequence, count in sequence_counts:
+        lengths[len(sequence)] += count
+
+    return lengths.most_common(1)[0][0]
+
+
+def orientation_options(raw_length_i1, raw_length_i2, length_bc1, length_bc2, double_coded):
+    """Yield a dictionary of splitter options for each distinct way of taking the barcodes out of the index reads.
+
+    Combinations that would give the same barcodes (e.g. trimming the start of a read that is reverse
+    complemented then shortened from the other end) are only given once, with the fewest options.
+    """
+
+    seen = set()
+
+    for switch in ([False, True] if double_coded else [False]):
+        # with the reads swapped, I2 gives the first part of the barcode
+        wanted_i1 = length_bc2 if switch else length_bc1
+        wanted_i2 = length_bc1 if switch else length_bc2
+
+        if raw_length_i1 < wanted_i1 or (double_coded and raw_length_i2 < wanted_i2):
+            continue
+
+        for trim in range(raw_length_i1 - wanted_i1 + 1):
+            for revcomp_i1 in (False, True):
+                for revcomp_i2 in ((False, True) if double_coded else (False,)):
+                    length_i1 = wanted_i1 if raw_length_i1 - trim != wanted_i1 else 0
+                    length_i2 = wanted_i2 if double_coded and raw_length_i2 != wanted_i2 else 0
+
+                    # the part of each raw read used, to spot combinations which do the same thing
+                    if revcomp_i1:
+                        used_i1 = (raw_length_i1 - wanted_i1, True)
+                    else:
+                        used_i1 = (trim, False)
+                    used_i2 = (raw_length_i2 - wanted_i2 if revcomp_i2 else 0, revcomp_i2)
+
+                    if (switch, used_i1, used_i2) in seen:
+                        continue
+                    seen.add((switch, used_i1, used_i2))
+
+                    yield {"i1_trim": trim, "i1_revcomp": revcomp_i1, "i2_revcomp": revcomp_i2, "barcode_length_i1": length_i1,
+                           "barcode_length_i2": length_i2, "switch_i1_i2": switch}
+
+
+def splitter_command(options):
+    """Return the split_barcodes_aviti.py command line for a set of options."""
+
+    command = "nohup ~/illuminaprocessing/split_barcodes_aviti.py"
+    if lane_no != "1":
+        command += f" --lane_number {lane_no}"
+
+    for option, value in options.items():
+        if value is True:
+            command += f" --{option}"
+        elif value:
+            command += f" --{option} {value}"
+
+    return command + f" {run_folder} > barcode_splitting.log &"
+
+
+def expected_codes(expected):
+    """Return the expected barcodes as they're found in the reads, bc1_bc2 or bc1."""
+    return {f"{bc1}_{bc2}".encode() if bc2 else bc1.encode() for bc1, bc2, name in expected}
+
+
+def rank_orientations(raw_counts, expected):
+    """Return (assigned reads, barcodes found, options, extract_index) for every orientation, best first."""
+
+    double_coded = expected[0][1] != ""
+
+    if double_coded and next(iter(raw_counts))[1] is None:
+        raise ValueError("the expected barcodes are dual indexed but there's no I2 file")
+
+    length_bc1 = most_common_length((bc1, 1) for bc1, bc2, name in expected)
+    length_bc2 = most_common_length((bc2, 1) for bc1, bc2, name in expected) if double_coded else 0
+    raw_length_i1 = most_common_length((I1, count) for (I1, I2), count in raw_counts.items())
+    raw_length_i2 = most_common_length((I2, count) for (I1, I2), count in raw_counts.items()) if double_coded else 0
+
+    codes = expected_codes(expected)
+    ranked = []
+
+    for options in orientation_options(raw_length_i1, raw_length_i2, length_bc1, length_bc2, double_coded):
+        structure = read_structure_from_options(options["i1_trim"], options["i1_revcomp"], options["i2_revcomp"], options["barcode_length_i1"],
+                                                options["barcode_length_i2"], False, options["switch_i1_i2"], double_coded, False)
+        extract_index = compile_index_extractor(parse_read_structure(structure), reverse_complement)
+
+        assigned = 0
+        found = set()
+        for (I1, I2), count in raw_counts.items():
+            barcode = extract_index(I1, I2 if I2 is not None else b"")[0]
+            if barcode in codes:
+                assigned += count
+                found.add(barcode)
+
+        # ties go to the combination with the fewest options
+        n_options = sum(1 for value in options.values() if value)
+        ranked.append((-assigned, n_options, len(ranked), assigned, len(found), options, extract_index))
+
+    ranked.sort()
+
+    return [(assigned, n_found, options, extract_index) for _, _, _, assigned, n_found, options, extract_index in ranked]
+
+
+def orientation_counts(raw_counts, extract_index):
+    """Return the barcode counts with the barcodes taken out of the raw pairs by extract_index."""
+
+    barcode_counts = Counter()
+    for (I1, I2), count in raw_counts.items():
+        barcode_counts[extract_index(I1, I2 if I2 is not None else b"")[0]] += count
+
+    return barcode_counts
+
+
+def check_orientations(raw_counts, exp_bc_file, report_file):
+    """Rank every orientation of the index reads by the reads assigned to the expected barcodes.
+
+    Writes the ranking to report_file and returns the barcode counts for the best one, or None
+    if the check couldn't be done.
+    """
 
     try:
-        os.chdir(f"/primary/{run_folder}/Unaligned/Project_External/Sample_lane{lane_no}/")
+        expected = read_expected_barcodes(exp_bc_file)
+        n_expected = len(expected_codes(expected))
+        total = sum(raw_counts.values())
+        ranked = rank_orientations(raw_counts, expected)
 
-        bc_check_cmd = f"zcat lane{lane_no}_NoIndex_L00{lane_no}_I2.fastq.gz | head -n {n_fastq_lines} | awk 'NR % 4 == 2'"
+        with open(report_file, "w") as report:
+            report.write("Rank\tAssigned_reads\tPercent_assigned\tBarcodes_found\tCommand\n")
+            for rank, (assigned, n_found, options, _) in enumerate(ranked, start=1):
+                report.write(f"{rank}\t{assigned}\t{100 * assigned / max(total, 1):.2f}\t{n_found}/{n_expected}\t{splitter_command(options)}\n")
 
-        if bc_length_i2 > 0:
-            print(f"Shortening I2 sequences to {bc_length_i2} bases", flush = True)
-            bc_check_cmd = f"{bc_check_cmd} | cut -c 1-{bc_length_i2}"
+        print(f"\nOrientations of the index reads ranked by the reads assigned to the expected barcodes (all of them are in {report_file}):")
+        for rank, (assigned, n_found, options, _) in enumerate(ranked[:5], start=1):
+            print(f"{rank}. {100 * assigned / max(total, 1):.2f}% assigned, {n_found}/{n_expected} barcodes found: {splitter_command(options)}")
 
-        if revcomp:
-            bc_check_cmd = f"{bc_check_cmd} | tr 'ATCG' 'TAGC' | rev" 
+        best_options, best_extract = ranked[0][2], ranked[0][3]
+        print(f"\nTo split the reads with the best orientation run this from /primary/{run_folder}:\n{splitter_command(best_options)}\n", flush = True)
 
-        bc_check_cmd = f"{bc_check_cmd} > i2_head.txt"
-        
-        #if revcomp:
-        #    bc_check_cmd = f"zcat lane{lane_no}_NoIndex_L00{lane_no}_I2.fastq.gz | head -n {n_fastq_lines}  | awk 'NR % 4 == 2' | tr 'ATCG' 'TAGC' | rev > i2_head.txt"    
-        #else:
-        #    bc_check_cmd = f"zcat lane{lane_no}_NoIndex_L00{lane_no}_I2.fastq.gz | head -n {n_fastq_lines}  | awk 'NR % 4 == 2' > i2_head.txt"    
+        # the found barcodes for the plot are taken out of the reads the same way as the best orientation
+        return orientation_counts(raw_counts, best_extract)
 
-        try:
-            subprocess.run(bc_check_cmd, shell=True, executable="/bin/bash")
-            
-        except Exception as err:
-            print("\n !! Couldn't run barcode checking command !!")
-            print(err)
-            
     except Exception as err:
-        print("\n !! Couldn't run barcode checking command !!")
+        print("\n !! Couldn't check the orientation of the index reads !!")
         print(err)
 
+        return None
+
 
 #---------------------
-# sort top barcodes
+# adaptive scan
 #---------------------
-def sort_top_barcodes(run_folder, n_bars_to_check, dual_coded):
+def interval_half_width(count, n, z):
+    """Return the half width of the Wilson score interval for a proportion count/n."""
+
+    p = count / n
+    return z / (1 + z * z / n) * math.sqrt(p * (1 - p) / n + z * z / (4 * n * n))
+
+
+def fractions_settled(raw_counts, n_counted, expected, precision, z):
+    """Return True if the fraction of reads for every expected barcode, and the unassigned fraction, is known to within precision."""
+
+    if n_counted == 0:
+        return False
 
     try:
-        os.chdir(f"/primary/{run_folder}/Unaligned/Project_External/Sample_lane{lane_no}/")
+        barcode_counts = orientation_counts(raw_counts, rank_orientations(raw_counts, expected)[0][3]) if auto_orient else None
+    except (ValueError, IndexError):
+        barcode_counts = None
 
-        if dual_coded:
-            bc_sort_cmd = f"paste -d '_' i1_head.txt i2_head.txt | sort | uniq -c | sort -k 1 -n -r | head -n {n_bars_to_check} | sed 's/^\s*//' > found_barcodes.txt"
-        else:
-            bc_sort_cmd = f"sort i1_head.txt | uniq -c | sort -k 1 -n -r | head -n {n_bars_to_check} | sed 's/^\s*//' > found_barcodes.txt"
+    if barcode_counts is None:
+        barcode_counts = transform_counts(raw_counts, I1_revcomp, I2_revcomp, bc_length_i1, bc_length_i2)
+
+    counts = [barcode_counts.get(code, 0) for code in expected_codes(expected)]
+    counts.append(n_counted - sum(counts))
+
+    widest = max(interval_half_width(count, n_counted, z) for count in counts)
+    print(f"After {n_counted} reads the barcode fractions are within {100 * widest:.3f}%", flush = True)
+
+    return widest <= precision
+
+
+#---------------------
+# sort top barcodes
+#---------------------
+def top_barcodes(barcode_counts, n_bars_to_check):
+    """Return (barcode, count) for the n_bars_to_check most frequent barcodes.
+
+    Barcodes with the same count are in reverse order, as sort -k 1 -n -r used to give.
+    """
+
+    top = heapq.nlargest(n_bars_to_check, barcode_counts.items(), key=lambda item: (item[1], item[0]))
+    return [(barcode.decode(), count) for barcode, count in top]
+
+
+def write_found_barcodes(found_file, found_barcodes):
+    """Write the found barcodes as "count barcode" lines."""
+
+    try:
+        with open(found_file, "w") as found:
+            for barcode, count in found_barcodes:
+                found.write(f"{count} {barcode}\n")
 
-        try:
-            subprocess.run(bc_sort_cmd, shell=True, executable="/bin/bash")
-            
-        except Exception as err:
-            print("\n !! Couldn't run barcode sorting command !!")
-            print(err)
-            
     except Exception as err:
-        print("\n !! Couldn't run barcode sorting command !!")
+        print("\n !! Couldn't write the found barcodes !!")
         print(err)
 
 # This writes out the expected barcodes to a text file and returns the number of expected barcodes.
@@ -311,7 +311,7 @@ def check_unwanted_qc(file,files):
 
 
 def check_unassigned(file,files):
-    if "_NoCode_" in file and file.endswith(".fastq.gz"):
+    if "_NoCode_" in file and (file.endswith(".fastq.gz") or file.endswith("_index_table.gz")):
         print(files[file], file=delfh)
         stats["Unassigned"][0] += 1
         stats["Unassigned"][1] += files[file].stat().st_size
@@ -320,7 +320,7 @@ def check_unassigned(file,files):
     return 0
 
 def check_unsplit(file,files):
-    if "_NoIndex_" in file and file.endswith(".fastq.gz"):
+    if "_NoIndex_" in file and (file.endswith(".fastq.gz") or file.endswith(".fastq.gz.gzidx.json") or file.endswith(".fastq.gz.gzidx")):
         print(files[file], file=delfh)
         stats["Unsplit"][0] += 1
         stats["Unsplit"][1] += files[file].stat().st_size
@@ -5,7 +5,9 @@
 # Just pass the filename as the first argument to the script
 
 import sys
-import gzip
+
+from fastq_parser import read_fastq_batches
+from decompression import open_gzip
 
 def main():
     filenames = sys.argv[1:]
@@ -15,22 +17,20 @@ def main():
     for filename in filenames:
         print("Reading",filename, flush=True, file=sys.stderr)
         count = 0
-        with gzip.open(filename, "rt", encoding="UTF-8") as fh:
-            for line in fh:
-                x = fh.readline()
-                x = fh.readline()
-                x = fh.readline()
-
-                barcodes = line.strip().split(":")[-1]
+        with open_gzip(filename) as fh:
+            for lines in read_fastq_batches(fh, 100000):
+                # only the header line of each record is needed
+                for header in lines[0::4]:
+                    barcodes = header.strip().split(b":")[-1]
 
-                if not barcodes in seen_barcodes:
-                    seen_barcodes[barcodes] = 0
+                    if not barcodes in seen_barcodes:
+                        seen_barcodes[barcodes] = 0
 
-                seen_barcodes[barcodes] += 1
+                    seen_barcodes[barcodes] += 1
 
-                count += 1
-                if count % 1000000 == 0:
-                    print ("Processed",int(count/1000000),"million", flush=True, file=sys.stderr)
+                    count += 1
+                    if count % 1000000 == 0:
+                        print ("Processed",int(count/1000000),"million", flush=True, file=sys.stderr)
 
                 # if count % 10000000 == 0:
                 #     break
@@ -44,7 +44,7 @@ def main():
         if i==100:
             break
 
-        print(i,b,seen_barcodes[b])
+        print(i,b.decode(),seen_barcodes[b])
 
 
 
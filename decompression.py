@@ -0,0 +1,209 @@
+#!/bin/python3
+
+# Fast reading of gzipped FASTQ files for the python splitting and counting scripts.
+#
+# Inflating the input files is the most expensive part of splitting, so files are
+# opened through open_gzip() which uses the fastest decompressor available:
+#
+#   isal     - the python-isal bindings to Intel's ISA-L
+#   zlib-ng  - the python-zlib-ng bindings
+#   pipe     - a separate pigz, igzip or gzip process writing to a pipe
+#   python   - the standard library gzip module
+#
+# Whichever is used, the decompression runs in its own thread or process so it
+# gets ahead of the code using the data.  The python fallback does this with a
+# PrefetchReader, which is fine as zlib releases the GIL while it inflates.
+#
+# The returned objects only need to support read() and close().  Like a raw file,
+# read(size) may return fewer than size bytes - b"" means the end of the file.
+# A PrefetchReader also adds up the time its thread spends decompressing in
+# busy_seconds.
+
+import gzip
+import queue
+import shutil
+import subprocess
+import threading
+import time
+
+try:
+    from isal import igzip, igzip_threaded
+except ImportError:
+    igzip = None
+    igzip_threaded = None
+
+try:
+    from zlib_ng import gzip_ng_threaded
+except ImportError:
+    gzip_ng_threaded = None
+
+backends = ["isal", "zlib-ng", "pipe", "python"]
+
+block_size = 4 * 1024 * 1024   # decompressed bytes per block handed over by a prefetch thread
+queue_size = 4                 # blocks a prefetch thread can get ahead by
+
+pipe_commands = [["pigz", "-dc"], ["igzip", "-dc"], ["gzip", "-dc"]]
+
+
+def pipe_command():
+    """Return the first external decompressor command which is installed, or None."""
+
+    for command in pipe_commands:
+        if shutil.which(command[0]):
+            return command
+
+    return None
+
+
+def available_backends():
+    """Return the names of the backends which can be used here, fastest first."""
+
+    available = []
+
+    if igzip is not None:
+        available.append("isal")
+    if gzip_ng_threaded is not None:
+        available.append("zlib-ng")
+    if pipe_command() is not None:
+        available.append("pipe")
+    available.append("python")
+
+    return available
+
+
+def choose_backend(backend="auto"):
+    """Return the backend to use for the requested name, raising ValueError if it isn't available."""
+
+    available = available_backends()
+
+    if backend == "auto":
+        return available[0]
+
+    if backend not in available:
+        raise ValueError(f"decompression backend '{backend}' is not available here (available: {', '.join(available)})")
+
+    return backend
+
+
+def open_gzip(filename, backend="auto"):
+    """Open a gzipped file for reading as bytes with the given backend."""
+
+    backend = choose_backend(backend)
+
+    if backend == "isal":
+        if igzip_threaded is not None:
+            return igzip_threaded.open(filename, "rb", threads=1)
+        return PrefetchReader(igzip.open(filename, "rb"))
+
+    if backend == "zlib-ng":
+        return gzip_ng_threaded.open(filename, "rb", threads=1)
+
+    if backend == "pipe":
+        return PipeReader(filename, pipe_command())
+
+    return PrefetchReader(gzip.open(filename, "rb"))
+
+
+class PrefetchReader:
+    """Read a file in a background thread, keeping up to queue_size blocks ready."""
+
+    def __init__(self, fh, block_size=block_size, queue_size=queue_size):
+        self.fh = fh
+        self.block_size = block_size
+        self.blocks = queue.Queue(maxsize=queue_size)
+        self.stopped = threading.Event()
+        self.eof = False
+        self.leftover = b""   # the rest of a block bigger than the last read asked for
+        self.busy_seconds = 0.0
+        self.thread = threading.Thread(target=self._fill, daemon=True)
+        self.thread.start()
+
+    def _fill(self):
+        try:
+            while not self.stopped.is_set():
+                start = time.perf_counter()
+                block = self.fh.read(self.block_size)
+                self.busy_seconds += time.perf_counter() - start
+                self._put(block)
+                if not block:
+                    break
+        except Exception as err:
+            # passed on to be raised in the reading thread
+            self._put(err)
+
+    def _put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.blocks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def read(self, size=-1):
+        if self.eof:
+            return b""
+
+        if size == 0:
+            return b""
+
+        if self.leftover:
+            block = self.leftover
+            self.leftover = b""
+        else:
+            block = self.blocks.get()
+
+        if isinstance(block, Exception):
+            self.eof = True
+            raise block
+
+        if not block:
+            self.eof = True
+            return b""
+
+        if 0 < size < len(block):
+            self.leftover = block[size:]
+            block = block[:size]
+
+        return block
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+        self.fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class PipeReader:
+    """Read the output of an external decompressor, raising an error if it fails."""
+
+    def __init__(self, filename, command):
+        self.filename = filename
+        self.process = subprocess.Popen(command + [filename], stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=block_size)
+
+    def read(self, size=-1):
+        data = self.process.stdout.read(size)
+
+        if not data:
+            error = self.process.stderr.read()
+            if self.process.wait() != 0:
+                raise OSError(f"decompressing {self.filename} failed: {error.decode(errors='replace').strip()}")
+
+        return data
+
+    def close(self):
+        self.process.stdout.close()
+        if self.process.poll() is None:
+            self.process.terminate()
+        self.process.wait()
+        self.process.stderr.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
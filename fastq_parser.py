@@ -0,0 +1,276 @@
+#!/bin/python3
+
+# Shared FASTQ reading for the python splitting and barcode counting scripts.
+#
+# Rather than calling readline() four times per record, the decompressed file
+# is read in large blocks and each block is split into lines in one go.  Only
+# complete records are handed out - anything left over at the end of a block
+# (part of a record, or part of a line) is carried over and joined on to the
+# start of the next block.
+#
+# The lines for a batch of records are returned as a single list, so line 4n
+# is the header of record n, 4n+1 is the sequence, 4n+2 is the '+' line and
+# 4n+3 is the quality.  Newlines are removed.  Callers can take columns out
+# of a batch with slices, e.g. lines[1::4] for all of the sequences.
+#
+# read_threaded_batches() does the same as read_matched_batches() but gives each
+# file its own thread, which reads and parses batches ahead into a bounded queue.
+#
+# Each FastqReader adds up the time it spends waiting for data from its file
+# (read_seconds) and splitting it into lines (parse_seconds) for the splitter's
+# metrics.
+
+import queue
+import threading
+import time
+
+block_size = 4 * 1024 * 1024
+
+
+class FastqReader:
+    """Read complete FASTQ records from a binary file handle in large blocks."""
+
+    def __init__(self, fh, block_size=block_size):
+        self.fh = fh
+        self.block_size = block_size
+        self.lines = []      # complete lines which haven't been handed out yet
+        self.partial = b""   # an incomplete line from the end of the last block
+        self.eof = False
+        self.read_seconds = 0.0
+        self.parse_seconds = 0.0
+
+    def read_records(self, n_records):
+        """Return the lines of the next n_records records (fewer at the end of the file)."""
+
+        n_lines = 4 * n_records
+
+        while len(self.lines) < n_lines and not self.eof:
+            self._read_block()
+
+        batch = self.lines[:n_lines]
+        del self.lines[:n_lines]
+
+        return batch
+
+    def skip_records(self, n_records):
+        """Read past the next n_records records, e.g. to pick up where an earlier run stopped."""
+
+        while n_records > 0:
+            step = min(n_records, 100000)
+
+            if len(self.read_records(step)) < 4 * step:
+                raise ValueError("FASTQ file has fewer records than are being skipped")
+
+            n_records -= step
+
+    def _read_block(self):
+        start = time.perf_counter()
+        block = self.fh.read(self.block_size)
+        read_end = time.perf_counter()
+        self.read_seconds += read_end - start
+
+        if not block:
+            self.eof = True
+
+            # The last line of the file may not have a newline
+            if self.partial:
+                self.lines.append(self.partial)
+                self.partial = b""
+
+            if len(self.lines) % 4 != 0:
+                raise ValueError(f"FASTQ file ends part way through a record ({len(self.lines) % 4} trailing lines)")
+
+            return
+
+        new_lines = (self.partial + block).split(b"\n")
+        self.partial = new_lines.pop()
+        self.lines.extend(new_lines)
+        self.parse_seconds += time.perf_counter() - read_end
+
+
+def read_fastq_batches(fh, n_records, block_size=block_size):
+    """Yield lists of lines holding up to n_records complete records until the file is exhausted."""
+
+    reader = FastqReader(fh, block_size)
+
+    while True:
+        batch = reader.read_records(n_records)
+
+        if not batch:
+            break
+
+        yield batch
+
+
+def read_matched_batches(fhs, n_records, block_size=block_size, skip_records=0):
+    """Yield a tuple of line lists, one per file handle, for the next n_records records of each file.
+
+    The first skip_records records of every file are skipped.  The first file
+    drives the reading.  File handles given as None give None in each tuple.
+    If one of the other files runs out first its lines are padded with empty
+    entries, as readline() would have given, so that ID checks in the caller
+    pick up the problem.
+    """
+
+    readers = [FastqReader(fh, block_size) if fh is not None else None for fh in fhs]
+
+    for reader in readers:
+        if reader is not None:
+            reader.skip_records(skip_records)
+
+    while True:
+        first_lines = readers[0].read_records(n_records)
+
+        if not first_lines:
+            break
+
+        batch = [first_lines]
+
+        for reader in readers[1:]:
+            if reader is None:
+                batch.append(None)
+                continue
+
+            lines = reader.read_records(n_records)
+            if len(lines) < len(first_lines):
+                lines.extend([b""] * (len(first_lines) - len(lines)))
+            batch.append(lines)
+
+        yield tuple(batch)
+
+
+class BatchReaderThread:
+    """Read batches of records from one file in a background thread, up to queue_size batches ahead."""
+
+    def __init__(self, fh, n_records, queue_size, block_size=block_size, skip_records=0):
+        self.reader = FastqReader(fh, block_size)
+        self.n_records = n_records
+        self.skip_records = skip_records
+        self.batches = queue.Queue(maxsize=queue_size)
+        self.stopped = threading.Event()
+        self.finished = False
+        self.thread = threading.Thread(target=self._fill, daemon=True)
+        self.thread.start()
+
+    def _fill(self):
+        try:
+            self.reader.skip_records(self.skip_records)
+
+            while not self.stopped.is_set():
+                batch = self.reader.read_records(self.n_records)
+                self._put(batch)
+                if not batch:
+                    break
+        except Exception as err:
+            # passed on to be raised in the reading thread
+            self._put(err)
+
+    def _put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.batches.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def get(self):
+        """Return the lines of the next batch, or an empty list once the file is finished."""
+
+        if self.finished:
+            return []
+
+        batch = self.batches.get()
+
+        if isinstance(batch, Exception):
+            self.finished = True
+            raise batch
+
+        if not batch:
+            self.finished = True
+
+        return batch
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+def read_threaded_batches(fhs, n_records, queue_size=4, block_size=block_size, skip_records=0):
+    """Return an iterator over the same batches as read_matched_batches, with each file read by its own thread.
+
+    Each thread keeps up to queue_size batches ready, so the memory used is bounded
+    at roughly queue_size batches per file.  The iterator has to be closed to stop
+    the threads.
+    """
+
+    return ThreadedBatches(fhs, n_records, queue_size, block_size, skip_records)
+
+
+class ThreadedBatches:
+    """Matched batches from a BatchReaderThread per file - see read_threaded_batches()."""
+
+    def __init__(self, fhs, n_records, queue_size, block_size, skip_records):
+        self.streams = [BatchReaderThread(fh, n_records, queue_size, block_size, skip_records) if fh is not None else None for fh in fhs]
+
+    def __iter__(self):
+        streams = self.streams
+
+        while True:
+            first_lines = streams[0].get()
+
+            if not first_lines:
+                break
+
+            batch = [first_lines]
+
+            for stream in streams[1:]:
+                if stream is None:
+                    batch.append(None)
+                    continue
+
+                lines = stream.get()
+                if len(lines) < len(first_lines):
+                    lines.extend([b""] * (len(first_lines) - len(lines)))
+                batch.append(lines)
+
+            yield tuple(batch)
+
+    def queue_depths(self):
+        """Return the number of batches waiting in the queue of each file (None for missing files)."""
+        return [stream.batches.qsize() if stream is not None else None for stream in self.streams]
+
+    def readers(self):
+        return [stream.reader if stream is not None else None for stream in self.streams]
+
+    def close(self):
+        for stream in self.streams:
+            if stream is not None:
+                stream.stop()
+
+
+def short_id(header):
+    """Return the read ID from a header line, without any /1 or /2 read number."""
+
+    read_id = header.split(b" ")[0]
+
+    if read_id.endswith((b"/1", b"/2", b"/3", b"/4")):
+        read_id = read_id[:-2]
+
+    return read_id
+
+
+def out_of_step(batch):
+    """Return the position in batch of the first file whose IDs don't match the first file, or None.
+
+    Only the first and last records of the batch are compared, which is enough to
+    notice a file which has dropped or gained records.
+    """
+
+    first_lines = batch[0]
+    first_ids = (short_id(first_lines[0]), short_id(first_lines[-4]))
+
+    for n, lines in enumerate(batch[1:], start=1):
+        if lines is not None and (short_id(lines[0]), short_id(lines[-4])) != first_ids:
+            return n
+
+    return None
@@ -0,0 +1,449 @@
+#!/bin/python3
+
+import os, sys, json, zlib
+import queue
+import threading
+import argparse
+from argparse import RawTextHelpFormatter
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+try:
+    import indexed_gzip
+except ImportError:
+    indexed_gzip = None
+
+from fastq_parser import FastqReader
+
+# Random access into gzipped FASTQ files.
+#
+# Reading from the middle of a gzip file normally means decompressing everything
+# before it.  An index is made with one pass over the file, recording a checkpoint
+# every spacing bytes of decompressed data (32 MiB by default), each with the
+# decompressed offset of the next record and its record number.  After that any
+# records can be read by starting at the checkpoint before them:
+#
+#   index = get_index("lane1_NoIndex_L001_I1.fastq.gz")
+#   lines = index.read_records(5000000, 5010000)    # records 5,000,000 to 5,009,999
+#   start, end = index.checkpoint_records(3)        # the records between checkpoints 3 and 4
+#
+# read_matched_windows() reads windows from several places in matched files (such as I1 and I2)
+# at the same time, which is how check_barcodes.py --sample_windows takes reads from the whole run.
+#
+# The index is saved next to the file as [file].gzidx.json and used again by later
+# tools as long as the file hasn't changed.  It is made when process_aviti.py copies
+# the index reads to /primary, or otherwise the first time it's needed.
+#
+# With the indexed_gzip package the checkpoints can be anywhere in the file, and its
+# own index is saved alongside as [file].gzidx.  Without it, python's zlib can only
+# start decompressing at the start of a gzip member, so checkpoints are put at the
+# first member start after each spacing.  Files written in blocks (such as the split
+# files, or bgzip) have plenty of members, but a file which is a single gzip member
+# only gets a checkpoint at the start and reading from it is no quicker than reading
+# through - it still works, just slowly.
+
+# ~/illuminaprocessing/gzip_index.py --processes 4 /primary/[run_folder]/Unaligned/Project_External/Sample_lane1/lane1_NoIndex_L001_I*.fastq.gz
+
+default_spacing = 32 * 1024 * 1024
+read_size = 4 * 1024 * 1024
+index_version = 1
+
+
+class GzipIndex:
+    """Checkpoints into a gzipped FASTQ file.
+
+    Each checkpoint is [record offset, record number, member offset, member start] - the
+    decompressed offset of a record and its number, and for the zlib backend the compressed
+    offset of the gzip member it's in and the decompressed offset that member starts at.
+    """
+
+    def __init__(self, filename, backend, spacing, n_records, checkpoints, size, mtime):
+        self.filename = filename
+        self.backend = backend
+        self.spacing = spacing
+        self.n_records = n_records
+        self.checkpoints = checkpoints
+        self.size = size
+        self.mtime = mtime
+
+    #----------------------------------------------
+    #  reading records
+    #----------------------------------------------
+    def checkpoint_before(self, record):
+        """Return the last checkpoint at or before the given record number."""
+
+        chosen = self.checkpoints[0]
+        for checkpoint in self.checkpoints:
+            if checkpoint[1] > record:
+                break
+            chosen = checkpoint
+
+        return chosen
+
+    def open_at(self, checkpoint):
+        """Return a file object giving the decompressed data from the checkpoint's record offset."""
+
+        record_offset, record_number, member_offset, member_start = checkpoint
+
+        if self.backend == "indexed_gzip":
+            fh = indexed_gzip.IndexedGzipFile(self.filename, index_file=index_filename(self.filename, "gzidx"))
+            fh.seek(record_offset)
+            return fh
+
+        fh = MemberReader(self.filename, member_offset)
+        fh.skip(record_offset - member_start)
+        return fh
+
+    def read_records(self, start, end):
+        """Return the lines of records start to end - 1, as fastq_parser gives them."""
+
+        end = min(end, self.n_records)
+        if start >= end:
+            return []
+
+        checkpoint = self.checkpoint_before(start)
+        fh = self.open_at(checkpoint)
+
+        try:
+            reader = FastqReader(fh, read_size)
+            reader.skip_records(start - checkpoint[1])
+            return reader.read_records(end - start)
+        finally:
+            fh.close()
+
+    def checkpoint_records(self, k):
+        """Return (first record, end record) for the records from checkpoint k up to the next one."""
+
+        start = self.checkpoints[k][1]
+        end = self.checkpoints[k + 1][1] if k + 1 < len(self.checkpoints) else self.n_records
+        return start, end
+
+    #----------------------------------------------
+    #  saving and loading
+    #----------------------------------------------
+    def save(self):
+        data = {
+            "version": index_version, "backend": self.backend, "spacing": self.spacing, "n_records": self.n_records,
+            "size": self.size, "mtime": self.mtime, "checkpoints": self.checkpoints
+        }
+
+        temp_filename = f"{index_filename(self.filename)}.tmp"
+        with open(temp_filename, "w") as fh:
+            json.dump(data, fh)
+        os.replace(temp_filename, index_filename(self.filename))
+
+    @classmethod
+    def load(cls, filename):
+        """Return the saved index for filename, or None if there isn't one or the file has changed since."""
+
+        try:
+            with open(index_filename(filename)) as fh:
+                data = json.load(fh)
+        except (OSError, ValueError):
+            return None
+
+        stat = os.stat(filename)
+
+        if data.get("version") != index_version or data["size"] != stat.st_size or data["mtime"] != stat.st_mtime:
+            return None
+        if data["backend"] == "indexed_gzip" and (indexed_gzip is None or not os.path.exists(index_filename(filename, "gzidx"))):
+            return None
+
+        return cls(filename, data["backend"], data["spacing"], data["n_records"], data["checkpoints"], data["size"], data["mtime"])
+
+
+def index_filename(filename, suffix="gzidx.json"):
+    return f"{filename}.{suffix}"
+
+#----------------------------------------------
+#  reading windows from several files at once
+#----------------------------------------------
+def read_matched_windows(indexes, starts, n_records, batch_size=100000, threads=4):
+    """Yield the matched batches (one list of lines per file, as read_matched_batches gives) of n_records records from each start.
+
+    The indexes are for files with the same records in the same order, e.g. I1 and I2.
+    Windows which start from the same checkpoints are read one after the other in a single
+    pass, and windows from different checkpoints are read by up to threads threads at once,
+    so the batches don't come in order.  With a single checkpoint this is one read through
+    the files, stopping after the last window.
+    """
+
+    groups = {}
+    for start in sorted(starts):
+        checkpoints = tuple(tuple(index.checkpoint_before(start)) for index in indexes)
+        groups.setdefault(checkpoints, []).append(start)
+
+    batches = queue.Queue(maxsize=2 * threads)
+    stopped = threading.Event()
+    finished = object()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def read_group(checkpoints, group_starts):
+        fhs = []
+        try:
+            readers = []
+            for index, checkpoint in zip(indexes, checkpoints):
+                fhs.append(index.open_at(list(checkpoint)))
+                readers.append(FastqReader(fhs[-1], read_size))
+
+            positions = [checkpoint[1] for checkpoint in checkpoints]
+
+            for start in group_starts:
+                for n, reader in enumerate(readers):
+                    if start > positions[n]:
+                        reader.skip_records(start - positions[n])
+                        positions[n] = start
+
+                # a window which overlaps the one before only gets the records after it
+                end = min(start + n_records, min(index.n_records for index in indexes))
+                while positions[0] < end and not stopped.is_set():
+                    step = min(batch_size, end - positions[0])
+                    put([reader.read_records(step) for reader in readers])
+                    positions = [position + step for position in positions]
+
+            put(finished)
+
+        except Exception as err:
+            # passed on to be raised in the reading thread
+            put(err)
+
+        finally:
+            for fh in fhs:
+                fh.close()
+
+    executor = ThreadPoolExecutor(max_workers=threads)
+    for checkpoints, group_starts in groups.items():
+        executor.submit(read_group, checkpoints, group_starts)
+
+    try:
+        n_finished = 0
+        while n_finished < len(groups):
+            item = batches.get()
+            if item is finished:
+                n_finished += 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield item
+
+    finally:
+        stopped.set()
+        executor.shutdown()
+
+
+#----------------------------------------------
+#  making an index
+#----------------------------------------------
+def get_index(filename, spacing=default_spacing):
+    """Return the index for filename, making it (and trying to save it) if there isn't an up to date one."""
+
+    index = GzipIndex.load(filename)
+
+    if index is None:
+        index = build_index(filename, spacing)
+        try:
+            index.save()
+        except OSError as err:
+            print(f"Couldn't save the index for {filename}, it will be made again next time: {err}", file=sys.stderr)
+
+    return index
+
+
+def build_index(filename, spacing=default_spacing):
+    """Read through filename once, recording a checkpoint at a record start about every spacing bytes."""
+
+    stat = os.stat(filename)
+    scanner = RecordScanner()
+
+    if indexed_gzip is not None:
+        backend = "indexed_gzip"
+        fh = indexed_gzip.IndexedGzipFile(filename, spacing=spacing)
+        try:
+            while True:
+                data = fh.read(read_size)
+                if not data:
+                    break
+                # indexed_gzip can seek anywhere, so any record start will do
+                if scanner.offset >= scanner.checkpoints[-1][0] + spacing:
+                    scanner.want_checkpoint()
+                scanner.scan(data)
+            fh.export_index(index_filename(filename, "gzidx"))
+        finally:
+            fh.close()
+
+    else:
+        backend = "zlib"
+        for member_offset, member_start, data in read_members(filename):
+            # zlib can only start from a member, so wait for one which starts after the spacing
+            if member_start is not None and member_start >= scanner.checkpoints[-1][0] + spacing:
+                scanner.want_checkpoint(member_offset, member_start)
+            scanner.scan(data)
+
+    return GzipIndex(filename, backend, spacing, scanner.finish(), scanner.checkpoints, stat.st_size, stat.st_mtime)
+
+
+class RecordScanner:
+    """Follow the lines of the decompressed data, noting the next record start when a checkpoint is wanted."""
+
+    def __init__(self):
+        self.offset = 0                      # decompressed bytes seen
+        self.n_lines = 0                     # newlines seen
+        self.line_start = True               # whether the next byte starts a line
+        self.checkpoints = [[0, 0, 0, 0]]    # the start of the file is always a checkpoint
+        self.wanted = None                   # (member offset, member start) while waiting for a record start
+
+    def want_checkpoint(self, member_offset=None, member_start=None):
+        # if one is already waiting, starting from its (earlier) member still works
+        if self.wanted is None:
+            self.wanted = (member_offset, member_start)
+
+    def scan(self, data):
+        if self.wanted is not None and data:
+            self._find_record_start(data)
+
+        if data:
+            self.n_lines += data.count(b"\n")
+            self.offset += len(data)
+            self.line_start = data.endswith(b"\n")
+
+    def _find_record_start(self, data):
+        # a record starts after every fourth line
+        if self.line_start and self.n_lines % 4 == 0:
+            self._add_checkpoint(self.offset, self.n_lines // 4)
+            return
+
+        lines = self.n_lines
+        position = data.find(b"\n")
+
+        while position != -1 and position + 1 < len(data):
+            lines += 1
+            if lines % 4 == 0:
+                self._add_checkpoint(self.offset + position + 1, lines // 4)
+                return
+            position = data.find(b"\n", position + 1)
+
+    def _add_checkpoint(self, offset, record):
+        self.checkpoints.append([offset, record, *self.wanted])
+        self.wanted = None
+
+    def finish(self):
+        """Return the number of records."""
+
+        # the last line may not have a newline
+        n_lines = self.n_lines if self.line_start else self.n_lines + 1
+        if n_lines % 4 != 0:
+            raise ValueError(f"FASTQ file ends part way through a record ({n_lines % 4} trailing lines)")
+
+        return n_lines // 4
+
+
+def read_members(filename):
+    """Yield (member offset, member start, data) for the decompressed data of each gzip member.
+
+    member offset and member start (the compressed and decompressed offsets the member starts
+    at) are only given with the first data from each member, and are None after that.
+    """
+
+    with open(filename, "rb") as fh:
+        decompressor = zlib.decompressobj(31)
+        member_offset = 0        # compressed offset of the current member
+        fed = 0                  # compressed bytes given to the current member so far
+        uncompressed = 0
+        new_member = True
+        data = b""
+
+        while True:
+            if not data:
+                data = fh.read(read_size)
+                if not data:
+                    break
+
+            output = decompressor.decompress(data)
+            start = uncompressed if new_member else None
+            if output or new_member:
+                yield (member_offset if new_member else None), start, output
+                new_member = False
+            uncompressed += len(output)
+
+            if decompressor.eof:
+                used = len(data) - len(decompressor.unused_data)
+                member_offset += fed + used
+                fed = 0
+                data = decompressor.unused_data
+                decompressor = zlib.decompressobj(31)
+                new_member = True
+
+                # some files are padded with zeros after the last member
+                if data.strip(b"\0") == b"" and not fh.peek(1):
+                    break
+            else:
+                fed += len(data)
+                data = b""
+
+
+class MemberReader:
+    """Read the decompressed data of a multi-member gzip file from the member at a compressed offset."""
+
+    def __init__(self, filename, member_offset):
+        self.fh = open(filename, "rb")
+        self.fh.seek(member_offset)
+        self.decompressor = zlib.decompressobj(31)
+        self.leftover = b""
+
+    def read(self, size=-1):
+        while True:
+            if self.decompressor.eof:
+                unused = self.decompressor.unused_data
+                self.decompressor = zlib.decompressobj(31)
+                if unused.strip(b"\0"):
+                    data = unused
+                else:
+                    data = self.fh.read(read_size)
+                    if not data.strip(b"\0"):
+                        return b""
+            else:
+                data = self.decompressor.unconsumed_tail or self.fh.read(read_size)
+                if not data:
+                    return b""
+
+            output = self.decompressor.decompress(data, size if size > 0 else 0)
+            if output:
+                return output
+
+    def skip(self, n_bytes):
+        while n_bytes > 0:
+            data = self.read(min(n_bytes, read_size))
+            if not data:
+                raise ValueError("gzip file is shorter than its index")
+            n_bytes -= len(data)
+
+    def close(self):
+        self.fh.close()
+
+
+def build_and_report(filename, spacing):
+    index = get_index(filename, spacing)
+    return f"{filename}: {index.n_records:,} records, {len(index.checkpoints)} checkpoint(s) ({index.backend})"
+
+
+def main():
+
+    parser = argparse.ArgumentParser(formatter_class=RawTextHelpFormatter, description = '''Makes random access indexes for gzipped fastq files, if they don't already have an up to date one''')
+    parser.add_argument('files', type=str, nargs='+', help='gzipped fastq files')
+    parser.add_argument('--spacing_mb', type=int, default=default_spacing // (1024 * 1024), help=f'MiB of decompressed data between checkpoints, 16 to 64 works well. Default: {default_spacing // (1024 * 1024)}')
+    parser.add_argument('--processes', type=int, default=1, help='Number of files to index at the same time. Default: 1')
+    args = parser.parse_args()
+
+    with ProcessPoolExecutor(max_workers=args.processes) as executor:
+        for report in executor.map(build_and_report, args.files, [args.spacing_mb * 1024 * 1024] * len(args.files)):
+            print(report, flush = True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,249 @@
+#!/bin/python3
+
+# In-process gzip output for the splitting scripts.
+#
+# Each output file collects what is written to it in a buffer.  When the buffer
+# is full it is handed to a shared pool of threads which compress it into a
+# complete gzip member (zlib releases the GIL while it compresses, so the
+# threads really do run in parallel).  Compressed members are written to the
+# file in the order they were submitted, so the file is just a series of
+# concatenated gzip members - this is standard gzip and zcat, gzip, python
+# and all of the usual aligners read it as one stream.
+#
+# With hundreds of samples the buffers could add up to a lot of memory, so the
+# pool keeps track of how much is buffered across all of the files.  If that
+# goes over memory_limit the file with the biggest buffer is compressed early,
+# one file per write until it's back under the limit.
+#
+# Because every member is complete, a file can be cut back to the end of any
+# member and still be valid gzip.  seal() writes out everything written so far
+# and returns the size of the file, and a GzipWriter opened with that size
+# as resume_size carries on from there - this is how checkpointed splits are
+# restarted.
+#
+# A ShardedGzipWriter rolls over to a new numbered file (_001, _002, ... as
+# bcl2fastq names its chunks) every records_per_shard FASTQ records, so that
+# big samples can be processed in parallel downstream.
+#
+# The pool adds up the time spent compressing (across all of its threads),
+# waiting for compression to catch up and writing compressed blocks to the
+# files, for the splitter's metrics.
+
+import os
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+buffer_size = 1024 * 1024           # uncompressed bytes collected before compressing a block
+memory_limit = 256 * 1024 * 1024    # uncompressed bytes buffered across all of the files
+
+
+def compress_member(data, level):
+    """Compress data into a single complete gzip member."""
+    return zlib.compress(data, level, wbits=31)
+
+
+class CompressorPool:
+    """A fixed set of compression threads shared by all of the output files."""
+
+    def __init__(self, threads, level=4, memory_limit=memory_limit):
+        self.level = level
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.max_in_flight = threads * 4   # limits the memory held by blocks waiting to be written
+        self.in_flight = deque()
+        self.memory_limit = memory_limit
+        self.buffered = 0                  # bytes in the buffers of all of the writers
+        self.writers = []
+        self.compress_seconds = 0.0
+        self.wait_seconds = 0.0
+        self.write_seconds = 0.0
+        self.timing_lock = threading.Lock()
+
+    def compress(self, data):
+        start = time.perf_counter()
+        member = compress_member(data, self.level)
+        elapsed = time.perf_counter() - start
+
+        with self.timing_lock:
+            self.compress_seconds += elapsed
+
+        return member
+
+    def submit(self, writer, data):
+        future = self.executor.submit(self.compress, data)
+        self.in_flight.append((writer, future))
+
+        # If compression is falling behind then wait for the oldest block
+        while len(self.in_flight) > self.max_in_flight:
+            oldest_writer, oldest_future = self.in_flight.popleft()
+            start = time.perf_counter()
+            oldest_future.result()
+            self.wait_seconds += time.perf_counter() - start
+            oldest_writer.write_completed()
+
+        return future
+
+    def flush_largest(self):
+        """Compress the biggest buffer, to bring the total buffered back towards the memory limit.
+
+        Only one buffer is flushed per call - if the total is still over the limit
+        the next write calls this again - so each call is a single pass over the
+        writers rather than a sort of all of them.
+        """
+
+        largest = max(self.writers, key=lambda writer: writer.buffered, default=None)
+
+        if largest is not None and largest.buffered > 0:
+            largest.flush_buffer()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+        self.in_flight.clear()
+
+
+class GzipWriter:
+    """A write-only gzip file whose compression is done by a CompressorPool."""
+
+    def __init__(self, filename, pool, buffer_size=buffer_size, resume_size=None):
+        self.filename = filename
+        self.pool = pool
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.buffered = 0
+        self.pending = deque()   # compression futures in the order they have to be written
+        self.submitted = False
+        pool.writers.append(self)
+
+        if resume_size is None:
+            self.fh = open(filename, "wb")
+        else:
+            # throw away anything written after the last seal()
+            self.fh = open(filename, "r+b")
+            self.fh.truncate(resume_size)
+            self.fh.seek(resume_size)
+            self.submitted = resume_size > 0
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        self.pool.buffered += len(data)
+
+        if self.buffered >= self.buffer_size:
+            self.flush_buffer()
+        elif self.pool.buffered > self.pool.memory_limit:
+            self.pool.flush_largest()
+
+    def flush_buffer(self):
+        if self.buffer:
+            self.pending.append(self.pool.submit(self, b"".join(self.buffer)))
+            self.pool.buffered -= self.buffered
+            self.buffer = []
+            self.buffered = 0
+            self.submitted = True
+
+        self.write_completed()
+
+    def write_completed(self, wait=False):
+        """Write out compressed blocks from the front of the queue which have finished."""
+        while self.pending and (wait or self.pending[0].done()):
+            start = time.perf_counter()
+            member = self.pending.popleft().result()
+            written = time.perf_counter()
+            self.fh.write(member)
+            self.pool.wait_seconds += written - start
+            self.pool.write_seconds += time.perf_counter() - written
+
+    def seal(self):
+        """Compress and write everything written so far, and return the size of the file."""
+        self.flush_buffer()
+        self.write_completed(wait=True)
+        start = time.perf_counter()
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+        self.pool.write_seconds += time.perf_counter() - start
+
+        return self.fh.tell()
+
+    def close(self):
+        self.flush_buffer()
+        self.write_completed(wait=True)
+
+        # A sample with no reads still needs to be a valid (empty) gzip file
+        if not self.submitted:
+            self.fh.write(compress_member(b"", self.pool.level))
+
+        self.fh.close()
+        self.pool.writers.remove(self)
+
+
+class ShardedGzipWriter:
+    """Write FASTQ records to a series of GzipWriters with at most records_per_shard records each.
+
+    filename ends .fastq.gz, and the shards are filename with _001, _002 and so on before the .fastq.gz.
+    When resuming, resume_records is the number of records written before the checkpoint, which says
+    which shard to carry on with, and resume_sizes has the sizes of the files at the checkpoint.
+    """
+
+    def __init__(self, filename, pool, records_per_shard, buffer_size=buffer_size, resume_records=0, resume_sizes=None):
+        self.base_filename = filename[:-len(".fastq.gz")]
+        self.pool = pool
+        self.records_per_shard = records_per_shard
+        self.buffer_size = buffer_size
+
+        if resume_records > 0:
+            # a full last shard stays open until there's another record for the next one
+            self.shard = (resume_records - 1) // records_per_shard + 1
+            self.shard_records = resume_records - (self.shard - 1) * records_per_shard
+        else:
+            self.shard = 1
+            self.shard_records = 0
+
+        shard_filename = self.shard_filename(self.shard)
+        self.writer = GzipWriter(shard_filename, pool, buffer_size, (resume_sizes or {}).get(shard_filename))
+
+    def shard_filename(self, shard):
+        return f"{self.base_filename}_{shard:03d}.fastq.gz"
+
+    @property
+    def filename(self):
+        return self.writer.filename
+
+    def write(self, data):
+        n_records = data.count(b"\n") // 4
+
+        while self.shard_records + n_records > self.records_per_shard:
+            room = self.records_per_shard - self.shard_records
+
+            if room > 0:
+                end = record_end(data, room)
+                self.writer.write(data[:end])
+                data = data[end:]
+                n_records -= room
+
+            self.writer.close()
+            self.shard += 1
+            self.shard_records = 0
+            self.writer = GzipWriter(self.shard_filename(self.shard), self.pool, self.buffer_size)
+
+        if data:
+            self.writer.write(data)
+            self.shard_records += n_records
+
+    def seal(self):
+        """Seal the current shard (earlier ones are already closed) and return its size."""
+        return self.writer.seal()
+
+    def close(self):
+        self.writer.close()
+
+
+def record_end(data, n_records):
+    """Return the position just after the first n_records FASTQ records in data."""
+
+    position = -1
+    for _ in range(4 * n_records):
+        position = data.index(b"\n", position + 1)
+
+    return position + 1
@@ -0,0 +1,187 @@
+#!/bin/python3
+
+import os, sys, gzip, json, random
+import argparse
+from argparse import RawTextHelpFormatter
+
+# Makes a run folder of synthetic, unsplit fastq files for benchmarking the splitting scripts.
+#
+# The files are laid out the way split_barcodes_aviti.py expects them
+#
+#   /primary/[run_folder]/Unaligned/Project_External/Sample_lane1/lane1_NoIndex_L001_{R1,R2,I1,I2}.fastq.gz
+#
+# and, with --perl, a second run folder [run_folder]_perl is made for the perl split_barcodes,
+# with a RunInfo.xml and links to the same files named by read number (R1 = read 1, R2 = I1,
+# R3 = I2, R4 = read 2).
+#
+# The expected barcodes are written to sierra_standin.json in the run folder - see sierra_standin/README.md
+#
+# Index reads are just the barcode (so no trimming or reverse complementing is needed), and the
+# barcodes are at least 3 mismatches apart.
+
+# ~/illuminaprocessing/make_synthetic_lane.py --reads 10000000 --samples 96 --perl synthetic_96_dual
+
+prepath = "/primary/"
+lane_number = "1"
+lane_id = 4321
+
+parser = argparse.ArgumentParser(formatter_class=RawTextHelpFormatter, description = '''Makes synthetic unsplit fastq files for benchmarking''')
+parser.add_argument('run_folder', type=str, help='run folder name to create under /primary')
+parser.add_argument('--reads', type=int, default=1000000, help='Number of reads. Default: 1000000')
+parser.add_argument('--samples', type=int, default=24, help='Number of samples (barcodes). Default: 24')
+parser.add_argument('--single_index', default=False, action='store_true', help='Only make an I1 file')
+parser.add_argument('--single_end', default=False, action='store_true', help='Only make an R1 file')
+parser.add_argument('--read_length', type=int, default=150, help='Length of R1 and R2. Default: 150')
+parser.add_argument('--index_length', type=int, default=8, help='Length of the barcodes and index reads. Default: 8')
+parser.add_argument('--n_rate', type=float, default=0.001, help='Fraction of bases which are N. Default: 0.001')
+parser.add_argument('--unassigned_fraction', type=float, default=0.05, help='Fraction of reads with random index sequences. Default: 0.05')
+parser.add_argument('--compress_level', type=int, default=6, help='gzip level of the fastq files. Default: 6')
+parser.add_argument('--seed', type=int, default=1, help='Random seed, the same options and seed always give the same files. Default: 1')
+parser.add_argument('--perl', default=False, action='store_true', help='Also make a run folder laid out for the perl split_barcodes')
+
+reads_per_chunk = 10000
+
+
+def main():
+
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    lane_folder = f"{prepath}{args.run_folder}/Unaligned/Project_External/Sample_lane{lane_number}"
+    os.makedirs(lane_folder, exist_ok=True)
+
+    barcodes = make_barcodes(rng, args.samples, args.index_length, 3, 2 if not args.single_index else 1)
+
+    reads = ["R1", "I1"]
+    if not args.single_index:
+        reads.append("I2")
+    if not args.single_end:
+        reads.append("R2")
+
+    files = {read: f"{lane_folder}/lane{lane_number}_NoIndex_L00{lane_number}_{read}.fastq.gz" for read in reads}
+
+    write_fastqs(rng, files, barcodes, args)
+
+    sierra = {
+        "instrument": "AVITI",
+        "lanes": {lane_number: {"lane_id": lane_id, "sample_name": "synthetic", "barcodes": [
+            [bc[0], bc[1] if len(bc) > 1 else "", f"sample_{n + 1}"] for n, bc in enumerate(barcodes)
+        ]}}
+    }
+    sierra_file = f"{prepath}{args.run_folder}/sierra_standin.json"
+    runs = {args.run_folder: sierra}
+
+    if args.perl:
+        runs[f"{args.run_folder}_perl"] = sierra
+        make_perl_run_folder(args, files)
+
+    with open(sierra_file, "w") as fh:
+        json.dump({"runs": runs}, fh, indent=1)
+
+    print(f"Made {args.reads:,} reads for {args.samples} samples in {lane_folder}")
+    print(f"Sierra stand-in data is in {sierra_file}")
+
+#----------------------------------------------
+#  pick barcodes which are well separated
+#----------------------------------------------
+def make_barcodes(rng, n_samples, length, min_distance, n_indexes):
+
+    barcodes = []
+
+    while len(barcodes) < n_samples:
+        candidate = tuple("".join(rng.choice("ACGT") for _ in range(length)) for _ in range(n_indexes))
+
+        if all(all(hamming(a, b) >= min_distance for a, b in zip(candidate, existing)) for existing in barcodes):
+            barcodes.append(candidate)
+
+    return barcodes
+
+
+def hamming(a, b):
+    return sum(x != y for x, y in zip(a, b))
+
+#----------------------------------------------
+#  write the fastq files
+#----------------------------------------------
+def base_table(n_rate):
+    """A bytes.translate table turning random bytes into bases, with about n_rate of them N."""
+
+    n_cutoff = round(256 * n_rate)
+    return bytes(ord("N") if value < n_cutoff else b"ACGT"[value % 4] for value in range(256))
+
+
+def write_fastqs(rng, files, barcodes, args):
+
+    table = base_table(args.n_rate)
+    read_quality = b"I" * args.read_length
+    index_quality = b"I" * args.index_length
+
+    fhs = {read: gzip.open(filename, "wb", compresslevel=args.compress_level) for read, filename in files.items()}
+
+    try:
+        for chunk_start in range(0, args.reads, reads_per_chunk):
+            chunk = {read: [] for read in fhs}
+
+            for n in range(chunk_start, min(chunk_start + reads_per_chunk, args.reads)):
+                read_id = f"@SYNTH:1:FC0001:1:{1101 + n // 1000000}:{n % 1000000}:{n % 977}".encode()
+
+                if rng.random() < args.unassigned_fraction:
+                    indexes = [rng.randbytes(args.index_length).translate(table) for _ in barcodes[0]]
+                else:
+                    indexes = [bc.encode() for bc in rng.choice(barcodes)]
+
+                # sequencing errors in the index reads
+                indexes = [mask_ns(rng, index, args.n_rate) for index in indexes]
+
+                chunk["R1"].append(b"%s 1:N:0:1\n%s\n+\n%s\n" % (read_id, rng.randbytes(args.read_length).translate(table), read_quality))
+                chunk["I1"].append(b"%s 1:N:0:1\n%s\n+\n%s\n" % (read_id, indexes[0], index_quality))
+
+                if "I2" in chunk:
+                    chunk["I2"].append(b"%s 1:N:0:1\n%s\n+\n%s\n" % (read_id, indexes[1], index_quality))
+                if "R2" in chunk:
+                    chunk["R2"].append(b"%s 2:N:0:1\n%s\n+\n%s\n" % (read_id, rng.randbytes(args.read_length).translate(table), read_quality))
+
+            for read, records in chunk.items():
+                fhs[read].write(b"".join(records))
+
+    finally:
+        for fh in fhs.values():
+            fh.close()
+
+
+def mask_ns(rng, sequence, n_rate):
+    if n_rate > 0 and rng.random() < n_rate * len(sequence):
+        position = rng.randrange(len(sequence))
+        sequence = sequence[:position] + b"N" + sequence[position + 1:]
+
+    return sequence
+
+#----------------------------------------------
+#  the same data laid out for the perl split_barcodes
+#----------------------------------------------
+def make_perl_run_folder(args, files):
+
+    run_folder = f"{prepath}{args.run_folder}_perl"
+    lane_folder = f"{run_folder}/Unaligned/Project_External/Sample_lane{lane_number}"
+    os.makedirs(lane_folder, exist_ok=True)
+
+    # split_barcodes finds the files by read number from RunInfo.xml
+    read_order = [read for read in ("R1", "I1", "I2", "R2") if read in files]
+
+    with open(f"{run_folder}/RunInfo.xml", "w") as info:
+        info.write("<RunInfo>\n<Reads>\n")
+        for number, read in enumerate(read_order, start=1):
+            indexed = "Y" if read.startswith("I") else "N"
+            cycles = args.index_length if indexed == "Y" else args.read_length
+            info.write(f'<Read Number="{number}" NumCycles="{cycles}" IsIndexedRead="{indexed}" />\n')
+        info.write("</Reads>\n</RunInfo>\n")
+
+    for number, read in enumerate(read_order, start=1):
+        link = f"{lane_folder}/lane{lane_number}_NoIndex_L00{lane_number}_R{number}.fastq.gz"
+        if os.path.lexists(link):
+            os.remove(link)
+        os.symlink(files[read], link)
+
+
+if __name__ == "__main__":
+    main()
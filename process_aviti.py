@@ -6,6 +6,11 @@ import mysql.connector
 import argparse
 from argparse import RawTextHelpFormatter
 
+try:
+    import indexed_gzip
+except ImportError:
+    indexed_gzip = None
+
 # TODO: The barcode checking code has been copied from here to check_barcodes.py, so we should remove the code from here and call that.
 
 # currently needs to be run from /data/AV240405
@@ -25,6 +30,7 @@ parser.add_argument('run_folder', type=str, default="", help='run folder name')
 parser.add_argument('--ignore_R2', default=False, action='store_true', help='To only use R1 cycles. Default [False]')
 parser.add_argument('--filter_mask_R2', default=False, action='store_true', help='Do not use R2 cycles to determine if a read passes the filter. Default [False]')
 parser.add_argument('--split_lanes', default=False, action='store_true', help='If lane1 and lane2 need to be kept separate. Cannot currently be used with --ignore_R2. Default [False]')
+parser.add_argument('--sample_windows', type=int, default=100, help='Check barcodes from this many windows through the index files rather than the first reads, 0 for the first reads. Needs the indexed_gzip package, without it the first reads are used. Default [100]')
 parser.add_argument('--no_trim', default=False, action='store_true', help='Do not remove the final base. By default, the final cycle is not used. Default [False]')
 
 args=parser.parse_args()
@@ -34,6 +40,13 @@ ignore_R2 = args.ignore_R2
 filter_mask_R2 = args.filter_mask_R2
 split_lanes = args.split_lanes
 no_trim = args.no_trim
+sample_windows = args.sample_windows
+
+# without indexed_gzip the I1/I2 files can only be read from the start, so indexing them would be
+# a wasted pass and reading windows through them would mean decompressing nearly all of them
+if sample_windows > 0 and indexed_gzip is None:
+    print("indexed_gzip isn't installed, so the barcode check will use the first reads rather than windows through the files")
+    sample_windows = 0
 
 def main():
 
@@ -54,14 +67,17 @@ def main():
     cp_to_primary(run_folder)
     print(f"fastq files have been copied to /primary/{run_folder}....")
 
+    # index the index reads so they can be read from anywhere, here and in later steps
+    if sample_windows > 0:
+        index_fastqs(run_folder)
 
     print("Now running barcode check...")
 
-    barcode_cmd = f"/home/sbsuser/illuminaprocessing/check_barcodes.py {run_folder}"
+    barcode_cmd = f"/home/sbsuser/illuminaprocessing/check_barcodes.py --sample_windows {sample_windows} {run_folder}"
     subprocess.run(barcode_cmd , shell=True, executable="/bin/bash")
 
     if split_lanes: 
-        barcode_cmd = f"/home/sbsuser/illuminaprocessing/check_barcodes.py --lane 2 {run_folder}"
+        barcode_cmd = f"/home/sbsuser/illuminaprocessing/check_barcodes.py --sample_windows {sample_windows} --lane 2 {run_folder}"
         subprocess.run(barcode_cmd , shell=True, executable="/bin/bash")
 
 
@@ -178,6 +194,23 @@ def cp_to_primary(run_folder):
         exit()
 
 
+#------------------------------------
+# random access indexes for the I1/I2
+#------------------------------------
+def index_fastqs(run_folder):
+
+    try:
+        os.chdir(f"/primary/{run_folder}")
+        index_cmd = f"/home/sbsuser/illuminaprocessing/gzip_index.py --processes 4 Unaligned/Project_External/Sample_lane*/lane*_NoIndex_L00*_I*.fastq.gz"
+        print(f"\nIndexing the index read files with: {index_cmd}\n", flush = True)
+        subprocess.run(index_cmd, shell=True, executable="/bin/bash")
+
+    except Exception as err:
+        # not fatal, check_barcodes.py will make the indexes if they're not there
+        print(f"\n !! Couldn't index the fastq files in /primary/{run_folder} !!")
+        print(err)
+
+
 #---------------------
 # quick barcode check
 #---------------------
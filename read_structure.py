@@ -0,0 +1,264 @@
+#!/bin/python3
+
+# Read structures for the python splitting script.
+#
+# A read structure says what each part of each read is, e.g.
+#
+#   I1:3S~8B*M I2:~8B R1:*T R2:*T
+#
+# Each read is named, followed by a list of segments which are a length (or * for
+# the rest of the read) and a type:
+#
+#   S - skipped
+#   B - sample barcode
+#   M - UMI, added to the read ID after the barcode
+#   T - template, the bases that are written out (R1 and R2 only)
+#
+# ~ reverse complements the rest of the read, so 3S~8B*M means drop the first 3
+# bases, reverse complement what's left, then take 8 bases of barcode and the rest
+# as the UMI.  Where there are two index reads the barcode is made by joining them
+# with '_' in the order they're given, so 'I2:8B I1:8B' swaps I1 and I2.
+#
+# The structure is compiled once into python functions that only do what this
+# structure needs, so none of the per-read option checks are left in the loop.
+
+import re
+
+index_reads = ("I1", "I2")
+template_reads = ("R1", "R2")
+
+segment_pattern = re.compile(r"(~)|(\d+|\*)([SBMT])")
+
+
+def parse_read_structure(spec):
+    """Return a dictionary of read name to a list of segments for a read structure string.
+
+    Segments are (length, type) with a length of None for '*', or ("~", None).
+    Raises ValueError if the structure doesn't make sense.
+    """
+
+    structure = {}
+
+    for read_spec in spec.split():
+        read, _, segments_spec = read_spec.partition(":")
+
+        if read not in index_reads + template_reads:
+            raise ValueError(f"unknown read '{read}' in read structure '{spec}'")
+        if read in structure:
+            raise ValueError(f"{read} is given more than once in read structure '{spec}'")
+
+        segments = []
+        position = 0
+
+        for match in segment_pattern.finditer(segments_spec):
+            if match.start() != position:
+                break
+            position = match.end()
+
+            if match.group(1):
+                segments.append(("~", None))
+            else:
+                length = None if match.group(2) == "*" else int(match.group(2))
+                segments.append((length, match.group(3)))
+
+        if position != len(segments_spec) or not segments:
+            raise ValueError(f"couldn't understand '{read_spec}' in read structure '{spec}'")
+
+        for n, (length, segment_type) in enumerate(segments):
+            if length is None and segment_type is not None and n != len(segments) - 1:
+                raise ValueError(f"'*' has to be the last segment of {read} in read structure '{spec}'")
+            if read in template_reads and segment_type not in ("S", "T"):
+                raise ValueError(f"{read} can only have S and T segments in read structure '{spec}'")
+            if read in index_reads and segment_type == "T":
+                raise ValueError(f"{read} can't have a T segment in read structure '{spec}'")
+
+        if read in index_reads and not any(segment_type == "B" for length, segment_type in segments):
+            raise ValueError(f"{read} needs a B segment in read structure '{spec}'")
+
+        structure[read] = segments
+
+    if "R1" not in structure or "I1" not in structure:
+        raise ValueError(f"read structure '{spec}' needs at least R1 and I1")
+
+    return structure
+
+
+def read_structure_from_options(i1_trim, i1_revcomp, i2_revcomp, barcode_length_i1, barcode_length_i2, i1_umi, switch_i1_i2, double_coded, paired_end):
+    """Return the read structure string equivalent to the splitter's individual options."""
+
+    i1 = ""
+    if i1_trim > 0:
+        i1 += f"{i1_trim}S"
+    if i1_revcomp:
+        i1 += "~"
+
+    if barcode_length_i1 > 0:
+        i1 += f"{barcode_length_i1}B" + ("*M" if i1_umi else "*S")
+    else:
+        i1 += "*B"
+
+    reads = [f"I1:{i1}"]
+
+    if double_coded:
+        i2 = "~" if i2_revcomp else ""
+        i2 += f"{barcode_length_i2}B*S" if barcode_length_i2 > 0 else "*B"
+
+        if switch_i1_i2:
+            reads.insert(0, f"I2:{i2}")
+        else:
+            reads.append(f"I2:{i2}")
+
+    reads.append("R1:*T")
+    if paired_end:
+        reads.append("R2:*T")
+
+    return " ".join(reads)
+
+
+def segment_code(read, source, segments):
+    """Return the lines of code which take the segments out of the sequence in variable source."""
+
+    lines = []
+    parts = {"B": [], "M": [], "T": []}
+    position = 0
+    current = source
+
+    for length, segment_type in segments:
+        if length == "~":
+            lines.append(f"    {read}_rc = reverse_complement({current}[{position}:])")
+            current = f"{read}_rc"
+            position = 0
+            continue
+
+        end = "" if length is None else position + length
+
+        if segment_type != "S":
+            parts[segment_type].append(f"{current}[{position}:{end}]")
+
+        if length is not None:
+            position += length
+
+    return lines, parts
+
+
+def compile_index_extractor(structure, reverse_complement):
+    """Return a function (raw_I1, raw_I2) -> (barcode, I1 barcode, I2 barcode, UMI).
+
+    The barcode has the index barcodes joined in the order of the structure, and the
+    UMI is None if the structure doesn't have one.  reverse_complement is the function
+    used for '~'.
+    """
+
+    lines = ["def extract_index(raw_I1, raw_I2):"]
+    barcodes = {}
+    umis = []
+
+    for read in structure:
+        if read not in index_reads:
+            continue
+
+        read_lines, parts = segment_code(read, f"raw_{read}", structure[read])
+        lines.extend(read_lines)
+        lines.append(f"    barcode_{read} = {' + '.join(parts['B'])}")
+        barcodes[read] = f"barcode_{read}"
+        umis.extend(parts["M"])
+
+    barcode = ' + b"_" + '.join(barcodes.values())
+    umi = " + ".join(umis) if umis else "None"
+
+    lines.append(f"    return {barcode}, {barcodes['I1']}, {barcodes.get('I2', 'None')}, {umi}")
+
+    return compile_function("\n".join(lines), "extract_index", reverse_complement=reverse_complement)
+
+
+def compile_record_assigner(structure, index_table=False):
+    """Return a function which assigns every record in a batch to a sample.
+
+    The function is called as assign_records(lines_R1, lines_R2, lines_I1, lines_I2, resolve, out_R1, out_R2, unassigned_counts)
+    with the line lists from fastq_parser, resolve((raw_I1, raw_I2)) giving (key, read ID tag, I1 barcode,
+    I2 barcode, rescued) as in split_barcodes_aviti.py, and the output dictionaries of lists to extend.
+    unassigned_counts is a dictionary which counts the barcodes of the unassigned reads, joined with '_'
+    in the order of the structure like the expected barcodes.  It returns (n_reads, assigned, unassigned,
+    rescued, id_mismatch) and stops after the first record whose R1 and I1 IDs don't match.
+
+    With index_table the raw index sequences of unassigned reads are collected as (raw I1, raw I2)
+    pairs in out_R1["unassigned_index"] rather than as I1 and I2 fastq records.
+    """
+
+    reads = ["R1"] + [read for read in ("R2", "I1", "I2") if read in structure]
+    record_vars = []
+    slices = []
+
+    for read in reads:
+        seq = f"raw_{read}" if read in index_reads else f"seq_{read}"
+        record_vars.extend([f"readID_{read}", seq, f"line3_{read}", f"qual_{read}"])
+        slices.extend(f"lines_{read}[{n}::4]" for n in range(4))
+
+    lines = [
+        "def assign_records(lines_R1, lines_R2, lines_I1, lines_I2, resolve, out_R1, out_R2, unassigned_counts):",
+        "    n_reads = 0",
+        "    assigned = 0",
+        "    unassigned = 0",
+        "    rescued_count = 0",
+        "    id_mismatch = False",
+        f"    for {', '.join(record_vars)} in zip({', '.join(slices)}):",
+        f"        key, header_tag, seq_I1, seq_I2, rescued = resolve((raw_I1, {'raw_I2' if 'I2' in structure else 'None'}))",
+    ]
+
+    # trimming of the template reads applies to the sequence and quality alike
+    for read in template_reads:
+        if read in structure:
+            read_lines, parts = segment_code(read, f"seq_{read}", structure[read])
+            if parts["T"] != [f"seq_{read}[0:]"]:
+                template = " + ".join(parts["T"]) or "b''"
+                lines.append(f"        seq_{read} = {template}")
+                lines.append(f"        qual_{read} = {template.replace(f'seq_{read}', f'qual_{read}')}")
+
+    lines.extend([
+        "        if key is not None:",
+        "            assigned += 1",
+        "            if rescued:",
+        "                rescued_count += 1",
+    ])
+
+    for read, out in (("R1", "out_R1"), ("R2", "out_R2")):
+        if read in structure:
+            lines.append(f"            {out}.setdefault(key, []).extend((readID_{read}, header_tag, seq_{read}, b\"\\n\", line3_{read}, b\"\\n\", qual_{read}, b\"\\n\"))")
+
+    unassigned_barcode = ' + b"_" + '.join(f"seq_{read}" for read in structure if read in index_reads)
+
+    lines.extend([
+        "        else:",
+        "            unassigned += 1",
+        f"            unassigned_barcode = {unassigned_barcode}",
+        "            unassigned_counts[unassigned_barcode] = unassigned_counts.get(unassigned_barcode, 0) + 1",
+        "            out_R1.setdefault(\"unassigned\", []).extend((readID_R1, b\"\\n\", seq_R1, b\"\\n\", line3_R1, b\"\\n\", qual_R1, b\"\\n\"))",
+    ])
+
+    if index_table:
+        lines.append(f"            out_R1.setdefault(\"unassigned_index\", []).append((raw_I1, {'raw_I2' if 'I2' in structure else 'None'}))")
+    else:
+        lines.append("            out_R1.setdefault(\"unassigned_I1\", []).extend((readID_I1, b\"\\n\", seq_I1, b\"\\n\", line3_I1, b\"\\n\", qual_I1, b\"\\n\"))")
+
+    if "I2" in structure and not index_table:
+        lines.append("            out_R1.setdefault(\"unassigned_I2\", []).extend((readID_I2, b\"\\n\", seq_I2, b\"\\n\", line3_I2, b\"\\n\", qual_I2, b\"\\n\"))")
+    if "R2" in structure:
+        lines.append("            out_R2.setdefault(\"unassigned\", []).extend((readID_R2, b\"\\n\", seq_R2, b\"\\n\", line3_R2, b\"\\n\", qual_R2, b\"\\n\"))")
+
+    lines.extend([
+        "        n_reads += 1",
+        "        if readID_R1.split(b\" \")[0] != readID_I1.split(b\" \")[0]:",
+        "            id_mismatch = True",
+        "            break",
+        "    return n_reads, assigned, unassigned, rescued_count, id_mismatch",
+    ])
+
+    return compile_function("\n".join(lines), "assign_records")
+
+
+def compile_function(source, name, **namespace):
+    exec(compile(source, f"<read structure {name}>", "exec"), namespace)
+    function = namespace[name]
+    function.source = source   # kept for debugging
+
+    return function
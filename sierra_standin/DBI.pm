@@ -0,0 +1,58 @@
+package DBI;
+
+# Stand-in for DBI which answers split_barcodes' Sierra queries from the
+# JSON file named in $SIERRA_STANDIN - see README.md
+
+use strict;
+use warnings;
+use JSON::PP;
+
+sub connect {
+    open( my $fh, '<', $ENV{SIERRA_STANDIN} ) or die "Can't read $ENV{SIERRA_STANDIN}: $!";
+    local $/;
+    my $sierra = decode_json(<$fh>);
+    close $fh;
+
+    return bless { sierra => $sierra }, 'DBI::db';
+}
+
+package DBI::db;
+
+sub selectrow_array {
+    my ( $self, $query, $attr, @params ) = @_;
+
+    my $run = $self->{sierra}->{runs}->{ $params[0] } or return ();
+
+    if ( $query =~ /instrument/ ) {
+        return ( $run->{instrument} );
+    }
+
+    my $lane = $run->{lanes}->{ $params[1] } or return ();
+    return ( $lane->{lane_id}, $lane->{sample_name} );
+}
+
+sub prepare {
+    my ( $self, $query ) = @_;
+    return bless { sierra => $self->{sierra}, rows => [] }, 'DBI::st';
+}
+
+sub errstr { return "" }
+
+package DBI::st;
+
+sub execute {
+    my ( $self, $run_folder, $lane_number ) = @_;
+
+    my $lane = $self->{sierra}->{runs}->{$run_folder}->{lanes}->{$lane_number};
+    $self->{rows} = $lane ? [ map { [@$_] } @{ $lane->{barcodes} } ] : [];
+
+    return 1;
+}
+
+sub fetchrow_array {
+    my ($self) = @_;
+    my $row = shift @{ $self->{rows} } or return ();
+    return @$row;
+}
+
+1;
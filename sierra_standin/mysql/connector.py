@@ -0,0 +1,49 @@
+# Stand-in for mysql.connector which answers the splitting scripts' Sierra queries
+# from the JSON file named in $SIERRA_STANDIN - see ../README.md
+
+import json
+import os
+import re
+
+
+def connect(**kwargs):
+    with open(os.environ["SIERRA_STANDIN"]) as fh:
+        return Connection(json.load(fh))
+
+
+class Connection:
+
+    def __init__(self, sierra):
+        self.sierra = sierra
+
+    def cursor(self):
+        return Cursor(self.sierra)
+
+    def close(self):
+        pass
+
+
+class Cursor:
+
+    def __init__(self, sierra):
+        self.sierra = sierra
+        self.rows = []
+
+    def execute(self, query, params=None):
+        run_folder = re.search(r"run_folder_name\s*=\s*'([^']*)'", query).group(1)
+        lane_number = re.search(r"lane_number\s*=\s*'(\d+)'", query).group(1)
+        lane = self.sierra["runs"][run_folder]["lanes"][lane_number]
+
+        if "5_prime_barcode" in query:
+            self.rows = [(bc1, bc2, name, lane["lane_id"]) for bc1, bc2, name in lane["barcodes"]]
+        else:
+            self.rows = [(lane["lane_id"],) for barcode in lane["barcodes"]]
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def fetchall(self):
+        return list(self.rows)
+
+    def close(self):
+        pass
@@ -1,6 +1,7 @@
 #!/bin/python3
 
-import subprocess, sys, gzip, os, re
+import os, re
+import multiprocessing
 import mysql.connector
 
 from glob import glob
@@ -10,8 +11,21 @@ import argparse
 from argparse import RawTextHelpFormatter
 from datetime import datetime
 import traceback
-
-transtable = str.maketrans("GATC","CTAG")
+import time
+from collections import deque
+
+from fastq_parser import read_threaded_batches, out_of_step
+from gzip_writer import CompressorPool, GzipWriter, ShardedGzipWriter
+from decompression import backends, choose_backend, open_gzip
+from barcode_matching import MismatchIndex, ResolutionCache
+from barcode_distances import BarcodeDistances
+from split_checkpoint import save_checkpoint, load_checkpoint, remove_checkpoint
+from read_structure import parse_read_structure, read_structure_from_options, compile_index_extractor, compile_record_assigner
+from split_metrics import SplitMetrics
+from barcode_sketch import SpaceSaving
+from unassigned_index_table import encode_block
+
+transtable = bytes.maketrans(b"GATC", b"CTAG")
 
 # line 121 - change for processing a full file vs first few lines
 
@@ -26,8 +40,34 @@ transtable = str.maketrans("GATC","CTAG")
 
 # nohup ~/illuminaprocessing/split_barcodes_aviti.py --i1_umi --barcode_length 8 20250618_AV240405_AV_A_PG6247_PE75_18062025 > barcode_splitting.log &
 
+# Matching can be spread over several processes with --workers, the output files are the same as a single process run
+# nohup ~/illuminaprocessing/split_barcodes_aviti.py --workers 16 --i1_trim 3 --i1_revcomp --i2_revcomp 20250618_AV240405_AV_B_ET6249_SE75_18062025 > barcode_splitting.log &
+# Only the matching is spread over the workers.  Every batch is pickled to a worker and its output pickled back, and
+# the reading, parsing, buffering and output go through the main process, so --workers only helps when matching is the
+# slow stage (e.g. --max_mismatches 2 on a big plate) and there are spare cores - see benchmark_splitters.py --workers.
+
+# A checkpoint is written every --checkpoint_reads reads.  If a split dies part way through, run the same command again
+# with --resume added and it will carry on from the last checkpoint rather than starting again.
+
+# Progress and the time spent in each stage (decompressing, parsing, matching, buffering, compressing and writing) are
+# written every --metrics_interval seconds to splitting_metrics_L00N.jsonl and a Prometheus textfile - see split_metrics.py
+
+# The most frequent barcodes of the unassigned reads are counted as they go past and written to barcode_assignments_unassigned.txt
+# (named after --log_filename), so there's no need to go back through the NoCode index files to see what went wrong.
+
+# With --unassigned_index_table the index reads of unassigned reads go into a compact laneN_NoCode_L00N_index_table.gz
+# rather than NoCode I1 and I2 fastq files - see unassigned_index_table.py, which can turn it back into fastq.
+
+# With --shard_reads N each sample is written to numbered files of N reads (..._L001_R1_001.fastq.gz, ..._L001_R1_002.fastq.gz, ...)
+# so that big samples can be trimmed and aligned in parallel.  The unassigned reads are still written to a single file.
+
 fhsR1 = {}           # storing the filehandles for all output files - dictionary of filehandles where key is sample barcode
 fhsR2 = {}
+resume_sizes = {}    # output file sizes to cut back to when resuming from a checkpoint
+resume_records = {}  # records written to each sample before the checkpoint, for picking up the right shard
+split_settings = {}  # matching options for assign_batch - set in each worker process
+reads_per_batch = 10000
+unassigned_report_rows = 500   # most frequent unassigned barcodes listed in the report
 #paired_end = False
 double_coded = False
 #prepath = "/bi/scratch/run_processing/"
@@ -47,6 +87,25 @@ parser.add_argument('--i2_revcomp', default=False, action='store_true', help='Re
 parser.add_argument('--barcode_length_i1', type=int, default=0, help='If barcode length differs from actual length of sequences in the index file(s). This defaults to the length of the expected barcodes.')
 parser.add_argument('--barcode_length_i2', type=int, default=0, help='If barcode length differs from actual length of sequences in the index file(s). This defaults to the length of the expected barcodes.')
 parser.add_argument('--switch_i1_i2', default=False, action='store_true', help='Swap all I1 seqs for I2 seqs')
+parser.add_argument('--read_structure', type=str, default="", help='''[Optional] Layout of the reads, used instead of the I1/I2 options above, e.g. "I1:3S~8B*M I2:~8B R1:*T R2:*T".
+S is skipped, B barcode, M UMI and T template bases, each given a length or * for the rest of the read.
+~ reverse complements the rest of the read.  See read_structure.py''')
+parser.add_argument('--max_mismatches', type=int, default=0, choices=[0, 1, 2], help='Number of mismatches (including N) allowed in each index read when assigning reads to samples. Default: 0')
+parser.add_argument('--cache_size', type=int, default=100000, help='Maximum number of distinct index sequences whose sample assignment is remembered. Default: 100000')
+parser.add_argument('--output_buffer_mb', type=int, default=1, choices=[1, 2, 3, 4], help='MiB of reads collected for each output file before it is compressed and written. Default: 1')
+parser.add_argument('--output_memory_mb', type=int, default=256, help='Most MiB of reads buffered across all of the output files, the biggest buffers are written first when it is reached. Default: 256')
+parser.add_argument('--decompressor', type=str, default="auto", choices=["auto"] + backends, help='How to decompress the input files. Default: auto, the fastest one available')
+parser.add_argument('--compress_threads', type=int, default=4, help='Number of threads used to gzip the output files. Default: 4')
+parser.add_argument('--log_filename', type=str, default="barcode_assignments.txt", help='Name of the file the assignment summary is written to. Default: barcode_assignments.txt')
+parser.add_argument('--shard_reads', type=int, default=0, help='Split the output for each sample into numbered files of this many reads. Default: 0, one file per sample')
+parser.add_argument('--unassigned_index_table', default=False, action='store_true', help='Write the index reads of unassigned reads to a compact table (laneN_NoCode_L00N_index_table.gz) instead of NoCode I1 and I2 fastq files')
+parser.add_argument('--unassigned_sketch_size', type=int, default=10000, help='Number of distinct unassigned barcodes tracked for the unassigned barcode report. 0 turns the report off. Default: 10000')
+parser.add_argument('--checkpoint_reads', type=int, default=10000000, help='Write a checkpoint every n reads so that the split can be restarted with --resume. 0 turns checkpoints off. Default: 10000000')
+parser.add_argument('--resume', default=False, action='store_true', help='Carry on from the last checkpoint of an earlier split of this lane with the same options')
+parser.add_argument('--queue_batches', type=int, default=4, help='Number of batches of 10000 reads each input file can be read ahead by. Default: 4')
+parser.add_argument('--workers', type=int, default=1, help='Number of processes used to match barcodes. Output is identical to a single process run. Default: 1')
+parser.add_argument('--metrics_interval', type=int, default=30, help='Seconds between writing the progress and stage timing metrics. 0 turns the metrics off. Default: 30')
+parser.add_argument('--prometheus_file', type=str, default="", help='Prometheus textfile for the metrics, e.g. in the node_exporter textfile directory. Default: splitting_metrics_L00N.prom next to the split files')
 
 args=parser.parse_args()
 
@@ -61,17 +120,45 @@ i1_umi = args.i1_umi
 lane_number = args.lane_number  # the short lane number i.e. 1 or 2
 sample_sheet = args.sample_sheet
 switch_i1_i2 = args.switch_i1_i2
+workers = args.workers
+queue_batches = args.queue_batches
+compress_threads = args.compress_threads
+output_buffer_size = args.output_buffer_mb * 1024 * 1024
+output_memory_limit = args.output_memory_mb * 1024 * 1024
+
+try:
+    decompressor = choose_backend(args.decompressor)
+except ValueError as err:
+    print(f"!! {err}, exiting... !!\n")
+    exit(1)
+
+max_mismatches = args.max_mismatches
+cache_size = args.cache_size
+read_structure = args.read_structure
+log_filename = args.log_filename
+unassigned_sketch_size = args.unassigned_sketch_size
+unassigned_index_table = args.unassigned_index_table
+shard_reads = args.shard_reads
+unassigned_report_filename = "{0}_unassigned{1}".format(*os.path.splitext(log_filename))
+checkpoint_reads = args.checkpoint_reads
+resume = args.resume
+metrics_interval = args.metrics_interval
+prometheus_file = args.prometheus_file
 
 path_from_run_folder = f"Unaligned/Project_External/Sample_lane{lane_number}/"
 
+compressor_pool = None  # the threads compressing the output files - started in main(), not when worker processes import this
+
 
 def main():
+    global compressor_pool
 
     print(datetime.now(), flush = True)
+
+    compressor_pool = CompressorPool(compress_threads, level=4, memory_limit=output_memory_limit)
     
     file_location = f"{prepath}{run_folder}/{path_from_run_folder}"
    
-    log_filename = "barcode_assignments.txt"
     fhsR1["log"] = open(log_filename, mode = "w")
 
     try:
@@ -121,6 +208,49 @@ def split_fastqs(file_location, expected_barcodes, double_coded, barcode_length_
     else:
         paired_end = False   
 
+    # all of the I1/I2 options come down to a read structure, which is compiled into the matching code
+    structure_spec = read_structure
+    if structure_spec == "":
+        structure_spec = read_structure_from_options(I1_trim, I1_revcomp, I2_revcomp, barcode_length_i1, barcode_length_i2, i1_umi, switch_i1_i2, double_coded, paired_end)
+
+    try:
+        structure = parse_read_structure(structure_spec)
+    except ValueError as err:
+        print(f"!! {err}, exiting... !!\n")
+        exit(1)
+
+    if ("I2" in structure) != double_coded or ("R2" in structure) != paired_end:
+        print(f"!! The read structure '{structure_spec}' doesn't match the library (double coded: {double_coded}, paired end: {paired_end}), exiting... !!\n")
+        exit(1)
+
+    print(f"Read structure is {structure_spec}", flush = True)
+
+    # anything which changes which file a read goes to has to match for a checkpoint to be used
+    checkpoint_file = f"{path_from_run_folder}splitting_checkpoint_L00{lane_number}.json"
+    run_details = {
+        "inputs": [R1, R2, I1, I2 if double_coded else None],
+        "expected_barcodes": expected_barcodes,
+        "options": [structure_spec, max_mismatches, unassigned_index_table, shard_reads]
+    }
+    state = None
+
+    if resume:
+        try:
+            state = load_checkpoint(checkpoint_file, run_details)
+        except ValueError as err:
+            print(f"!! Can't resume: {err}, exiting... !!\n")
+            exit(1)
+
+        if state is None:
+            print(f"No checkpoint found at {checkpoint_file}, starting from the beginning", flush = True)
+        else:
+            print(f"Resuming from the checkpoint after {state['reads']:,} reads", flush = True)
+            resume_sizes.update(state["outputs"])
+            resume_records.update(state["records"])
+
+    if shard_reads > 0:
+        print(f"Writing each sample in files of {shard_reads:,} reads", flush = True)
+
     for key in expected_barcodes:
 
         new_filenameR1 = f"lane{lane_id}_{key}_{expected_barcodes[key]}_L00{lane_number}_R1.fastq.gz"
@@ -133,12 +263,17 @@ def split_fastqs(file_location, expected_barcodes, double_coded, barcode_length_
     # also open an unassigned file
     new_filenameR1 = f"lane{lane_number}_NoCode_L00{lane_number}_R1.fastq.gz"
     open_filehandlesR1(new_filenameR1, "unassigned", path_from_run_folder)
-    new_filenameI1 = f"lane{lane_number}_NoCode_L00{lane_number}_I1.fastq.gz"
-    open_filehandlesR1(new_filenameI1, "unassigned_I1", path_from_run_folder)
 
-    if double_coded:
-        new_filenameI2 = f"lane{lane_number}_NoCode_L00{lane_number}_I2.fastq.gz"
-        open_filehandlesR1(new_filenameI2, "unassigned_I2", path_from_run_folder)    
+    if unassigned_index_table:
+        new_filename_index = f"lane{lane_number}_NoCode_L00{lane_number}_index_table.gz"
+        open_filehandlesR1(new_filename_index, "unassigned_index", path_from_run_folder)
+    else:
+        new_filenameI1 = f"lane{lane_number}_NoCode_L00{lane_number}_I1.fastq.gz"
+        open_filehandlesR1(new_filenameI1, "unassigned_I1", path_from_run_folder)
+
+        if double_coded:
+            new_filenameI2 = f"lane{lane_number}_NoCode_L00{lane_number}_I2.fastq.gz"
+            open_filehandlesR1(new_filenameI2, "unassigned_I2", path_from_run_folder)    
 
     if paired_end:
         new_filenameR2 = f"lane{lane_number}_NoCode_L00{lane_number}_R2.fastq.gz"
@@ -146,158 +281,186 @@ def split_fastqs(file_location, expected_barcodes, double_coded, barcode_length_
 
     print("opened all the file handles", flush = True)
 
-    r1 = gzip.open(R1, "rt", encoding="utf8")
-    i1 = gzip.open(I1, "rt", encoding="utf8")
+    print(f"Decompressing the input files with the {decompressor} backend", flush = True)
+
+    # reads are kept as bytes all the way through to the output files
+    r1 = open_gzip(R1, decompressor)
+    i1 = open_gzip(I1, decompressor)
+    r2 = None
+    i2 = None
 
     if paired_end:
-        r2 = gzip.open(R2, "rt", encoding="utf8")
+        r2 = open_gzip(R2, decompressor)
 
     if double_coded:
-        i2 = gzip.open(I2, "rt", encoding="utf8")
+        i2 = open_gzip(I2, decompressor)
+
+    # everything the matching needs, so that it can be handed to worker processes
+    # expected barcodes are looked up as bytes, giving the key used for the output files
+    settings = {
+        "sample_keys": {key.encode(): key for key in expected_barcodes},
+        "read_structure": structure,
+        "mismatch_index": None,
+        "cache_size": cache_size,
+        "index_table": unassigned_index_table
+    }
+
+    # check the expected barcodes are far enough apart for the mismatches allowed
+    distances = BarcodeDistances(expected_barcodes)
+    distance_report = distances.report(max_mismatches)
+    if max_mismatches > distances.safe_mismatches():
+        distance_report.append(f"!! --max_mismatches {max_mismatches} is more than these barcodes can safely allow, some reads could be assigned to the wrong sample !!")
+    print("\n" + "\n".join(distance_report) + "\n", flush = True)
+    fhsR1["log"].write("\n" + "\n".join(distance_report) + "\n")
+
+    if max_mismatches > 0:
+        settings["mismatch_index"] = MismatchIndex(settings["sample_keys"].keys(), max_mismatches)
+        collisions = settings["mismatch_index"].collision_report()
+        collision_msg = f"\nAllowing {max_mismatches} mismatch(es) per index read, {len(collisions)} ambiguous sequence(s) will not be rescued\n"
+        print(collision_msg, flush = True)
+        fhsR1["log"].write(collision_msg)
+        for line in collisions:
+            print(line)
+            fhsR1["log"].write(line + "\n")
+
+    batches = None
+    metrics = None
 
     try:
-		# unpaired_count = 0 # count the number of R2 barcodes that don't match R1
         line_count = 0
-        barcode = ""
         unassigned_count = 0
         assigned_count = 0
+        rescued_count = 0
+        cache_hits = 0
+        cache_misses = 0
+        record_counts = {}
+        unassigned_sketch = SpaceSaving(unassigned_sketch_size) if unassigned_sketch_size > 0 else None
+
+        if state is not None:
+            line_count = state["reads"]
+            assigned_count = state["assigned"]
+            unassigned_count = state["unassigned"]
+            rescued_count = state["rescued"]
+            record_counts = state["records"]
+            if unassigned_sketch is not None and "unassigned_sketch" in state:
+                unassigned_sketch.load_state(state["unassigned_sketch"])
+
+        # each input file is decompressed and parsed by its own thread
+        batches = read_threaded_batches((r1, r2, i1, i2), reads_per_batch, queue_batches, skip_records=line_count)
+
+        metrics = SplitMetrics(
+            f"{path_from_run_folder}splitting_metrics_L00{lane_number}.jsonl",
+            prometheus_file or f"{path_from_run_folder}splitting_metrics_L00{lane_number}.prom",
+            metrics_interval,
+            {"run": run_folder, "lane": lane_number},
+            start_reads=line_count
+        )
+        metrics.watch(batches, (r1, r2, i1, i2), compressor_pool)
+        sample_names = dict(expected_barcodes)
+        sample_names["unassigned"] = "unassigned"
 
-        while True:
-
-            if line_count % 1000000 == 0:
-                print("Read",(line_count/1000000),"million entries", flush = True)
-
-        #while line_count <= 400: 
-            readID_R1  = r1.readline().strip()
-            seq_R1     = r1.readline()
-            line3_R1   = r1.readline()
-            qual_R1    = r1.readline()
-
-            shortID_R1 = readID_R1.split(" ")[0]
-			
-            if not qual_R1:
-                break
-			
-            if paired_end:
-                readID_R2  = r2.readline().strip()
-                seq_R2     = r2.readline()
-                line3_R2   = r2.readline()
-                qual_R2    = r2.readline()
-                #shortID_R2 = readID_R2.split(" ")[0]
-
-            readID_I1  = i1.readline()
-            seq_I1     = i1.readline().strip()
-            line3_I1   = i1.readline()
-            qual_I1    = i1.readline()
-            shortID_I1 = readID_I1.split(" ")[0].strip()
-
-            if I1_trim > 0:
-                seq_I1 = seq_I1[I1_trim:]
-
-            if I1_revcomp:
-                seq_I1 = reverse_complement(seq_I1)
-
-            if i1_umi and barcode_length_i1 > 0:
-                full_seq_I1 = seq_I1
-                seq_I1 = seq_I1[0:barcode_length_i1]
-                umi = full_seq_I1[barcode_length_i1:]
-                #print(f"umi = {umi}")
-                #readID_R1 += f':{umi}'
-                #print(f"readID_R1 = {readID_R1}")
-            elif barcode_length_i1 > 0:
-                seq_I1 = seq_I1[0:barcode_length_i1]
-
-            if double_coded:
-                readID_I2  = i2.readline()
-                seq_I2     = i2.readline().strip()
-                line3_I2   = i2.readline()
-                qual_I2    = i2.readline()
-                #shortID_I2 = readID_I2.split(" ")[0].strip()
-
-                if I2_revcomp:
-                    seq_I2 = reverse_complement(seq_I2)
-
-                if barcode_length_i2 > 0:
-                    seq_I2 = seq_I2[0:barcode_length_i2]
-
-                if switch_i1_i2:
-                    barcode = f"{seq_I2}_{seq_I1}"
-                else:
-                    barcode = f"{seq_I1}_{seq_I2}"
-            
-            else:
-                barcode = seq_I1
+        if workers > 1:
+            print(f"Matching barcodes with {workers} worker processes", flush = True)
+            results = assign_batches_parallel(batches, settings, workers)
+        else:
+            init_split_settings(settings)
+            results = map(assign_batch, batches)
 
-            if barcode in expected_barcodes.keys():
-                assigned_count +=1
-                #print(f"Found it! {barcode} has the name {expected_barcodes[barcode]}")
-                readID_R1 = f"{readID_R1} {barcode}"
+        waiting_since = time.perf_counter()
 
-                if i1_umi and barcode_length_i1 > 0:
-                    readID_R1 += f':{umi}'
+        for result in results:
 
-                fhsR1[barcode].stdin.write(readID_R1+"\n")
-                fhsR1[barcode].stdin.write(seq_R1)
-                fhsR1[barcode].stdin.write(line3_R1)
-                fhsR1[barcode].stdin.write(qual_R1)
+            # when matching in this process the wait for a batch includes matching it
+            waited = time.perf_counter() - waiting_since
+            metrics.add("batch_wait", waited - result["match_seconds"] if workers == 1 else waited)
+            metrics.add("match", result["match_seconds"])
 
-                if paired_end:
-                    readID_R2 = f"{readID_R2} {barcode}"
+            if line_count // 1000000 != (line_count + result["n_reads"]) // 1000000:
+                print("Read",((line_count + result["n_reads"]) // 1000000),"million entries", flush = True)
 
-                    # I think we're still just checking whether barcode_length_i1 has been passed in because it should go with --i1_umi
-                    if i1_umi and barcode_length_i1 > 0:
-                        readID_R2 += f':{umi}'
+            # the pool's own timings cover waiting for compression and writing
+            buffer_start = time.perf_counter()
+            pool_seconds = compressor_pool.wait_seconds + compressor_pool.write_seconds
+            write_batch(result)
+            pool_seconds = compressor_pool.wait_seconds + compressor_pool.write_seconds - pool_seconds
+            metrics.add("buffer", time.perf_counter() - buffer_start - pool_seconds)
 
-                    fhsR2[barcode].stdin.write(readID_R2+"\n")
-                    fhsR2[barcode].stdin.write(seq_R2)
-                    fhsR2[barcode].stdin.write(line3_R2)
-                    fhsR2[barcode].stdin.write(qual_R2)
+            line_count += result["n_reads"]
+            assigned_count += result["assigned"]
+            unassigned_count += result["unassigned"]
+            rescued_count += result["rescued"]
+            cache_hits += result["cache_hits"]
+            cache_misses += result["cache_misses"]
 
-            else:
-                #print(f"Couldn't find this {barcode}")
-                unassigned_count +=1
-
-                fhsR1["unassigned"].stdin.write(readID_R1+"\n")
-                fhsR1["unassigned"].stdin.write(seq_R1)
-                fhsR1["unassigned"].stdin.write(line3_R1)
-                fhsR1["unassigned"].stdin.write(qual_R1)
-
-                fhsR1["unassigned_I1"].stdin.write(readID_I1)
-                fhsR1["unassigned_I1"].stdin.write(seq_I1+"\n")
-                fhsR1["unassigned_I1"].stdin.write(line3_I1)
-                fhsR1["unassigned_I1"].stdin.write(qual_I1)
-
-                if double_coded:
-                    fhsR1["unassigned_I2"].stdin.write(readID_I2)
-                    fhsR1["unassigned_I2"].stdin.write(seq_I2+"\n")
-                    fhsR1["unassigned_I2"].stdin.write(line3_I2)
-                    fhsR1["unassigned_I2"].stdin.write(qual_I2)
-
-                if paired_end:
-                    fhsR2["unassigned"].stdin.write(readID_R2+"\n")
-                    fhsR2["unassigned"].stdin.write(seq_R2)
-                    fhsR2["unassigned"].stdin.write(line3_R2)
-                    fhsR2["unassigned"].stdin.write(qual_R2)
-                    
-
-            line_count += 1
+            for key, count in result["records"].items():
+                record_counts[key] = record_counts.get(key, 0) + count
+
+            if unassigned_sketch is not None:
+                for barcode, count in result["unassigned_barcodes"].items():
+                    unassigned_sketch.update(barcode, count)
 
         #     # I don't think that we should need to check this
-            if shortID_R1 != shortID_I1:
+            if result["out_of_step"]:
+                err_msg = f"\n!! {result['out_of_step']} IDs are out of step with R1 in the reads after read {line_count}, exiting... !!\n"
+                print(err_msg)
+                fhsR1["log"].write(err_msg)
+                close_filehandles()
+                exit()
+
+            if result["id_mismatch"]:
                 err_msg = f"\n!! IDs do not match for read {line_count}, exiting... !!\n"
                 print(err_msg)
                 fhsR1["log"].write(err_msg)
+                close_filehandles()
                 exit()
 
+            if checkpoint_reads > 0 and (line_count - result["n_reads"]) // checkpoint_reads != line_count // checkpoint_reads:
+                state = {
+                    "reads": line_count,
+                    "assigned": assigned_count,
+                    "unassigned": unassigned_count,
+                    "rescued": rescued_count,
+                    "records": record_counts,
+                    "outputs": seal_filehandles()
+                }
+                if unassigned_sketch is not None:
+                    state["unassigned_sketch"] = unassigned_sketch.to_state()
+                save_checkpoint(checkpoint_file, run_details, state)
+
+            if metrics_interval > 0:
+                metrics.update(line_count, assigned_count, unassigned_count, sample_read_counts(record_counts, sample_names))
+
+            waiting_since = time.perf_counter()
+
         total_reads = assigned_count + unassigned_count
+        print(f"Index resolution cache hit rate: {100*cache_hits/max(cache_hits + cache_misses, 1):.2f}% ({cache_misses:,} distinct lookups)", flush = True)
         assigned_percentage = 100*(assigned_count/total_reads)
         unassigned_percentage = 100*(unassigned_count/total_reads)
         assigned_msg = f"\nAssigned reads:   {assigned_count:,} ({assigned_percentage:.1f}%)"
         unassigned_msg = f"\nUnassigned reads: {unassigned_count:,} ({unassigned_percentage:.1f}%)\n"         
         fhsR1["log"].write(assigned_msg)
+
+        if max_mismatches > 0:
+            rescued_percentage = 100*(rescued_count/total_reads)
+            fhsR1["log"].write(f"\n  of which rescued with up to {max_mismatches} mismatch(es): {rescued_count:,} ({rescued_percentage:.1f}%)")
+
         fhsR1["log"].write(unassigned_msg)
 
+        if unassigned_sketch is not None:
+            write_unassigned_report(unassigned_sketch, expected_barcodes)
+            print(f"Most frequent unassigned barcodes written to {unassigned_report_filename}", flush = True)
+
+        # the split finished so there's nothing to resume
+        remove_checkpoint(checkpoint_file)
+
+        if metrics_interval > 0:
+            metrics.write(line_count, assigned_count, unassigned_count, sample_read_counts(record_counts, sample_names), final=True)
+
     finally:
+        if metrics is not None:
+            metrics.close()
+        if batches is not None:
+            batches.close()
         r1.close()
         i1.close()
         if paired_end:
@@ -305,28 +468,207 @@ def split_fastqs(file_location, expected_barcodes, double_coded, barcode_length_
         if double_coded:
             i2.close() 
 
+#----------------------------------------------
+#  report the most frequent unassigned barcodes
+#----------------------------------------------
+def write_unassigned_report(sketch, expected_barcodes):
+    """Write the barcodes the unassigned reads had, most frequent first, with the closest expected barcode."""
+
+    with open(unassigned_report_filename, mode = "w") as report:
+        report.write(f"# Most frequent barcodes of the {sketch.total:,} unassigned reads in lane {lane_number}\n")
+        report.write(f"# Counted with a sketch of {sketch.capacity:,} barcodes, so each count is at most Max_overcount above the true count\n")
+        report.write(f"# and every barcode with more than {sketch.guaranteed_threshold():,} reads is listed\n")
+        report.write("Rank\tBarcode\tCount\tMax_overcount\tPercent_unassigned\tClosest_expected\tClosest_sample\tMismatches\n")
+
+        for rank, (barcode, count, overcount) in enumerate(sketch.top(unassigned_report_rows), start=1):
+            barcode = barcode.decode()
+            closest, mismatches = closest_expected_barcode(barcode, expected_barcodes)
+            percentage = 100*count/max(sketch.total, 1)
+            sample = expected_barcodes[closest] if closest else ""
+            report.write(f"{rank}\t{barcode}\t{count}\t{overcount}\t{percentage:.2f}\t{closest}\t{sample}\t{mismatches}\n")
+
+def closest_expected_barcode(barcode, expected_barcodes):
+    """Return the expected barcode of the same length with the fewest mismatches and the number of mismatches, or ("", "")."""
+
+    closest = ""
+    fewest = ""
+
+    for expected in expected_barcodes:
+        if len(expected) == len(barcode):
+            mismatches = sum(a != b for a, b in zip(expected, barcode))
+            if fewest == "" or mismatches < fewest:
+                closest = expected
+                fewest = mismatches
+
+    return closest, fewest
+
+def sample_read_counts(record_counts, sample_names):
+    """Return the reads written so far for each sample name, and for unassigned reads."""
+    return {name: record_counts.get(key, 0) for key, name in sample_names.items()}
+
+#----------------------------------------------
+#  match batches in worker processes
+#----------------------------------------------
+def assign_batches_parallel(batches, settings, workers):
+    """Yield the results of assign_batch in input order, keeping a bounded number of batches in flight.
+
+    The workers are started from a forkserver rather than forked from this process, which by
+    now has reader and compressor threads running.
+    """
+
+    context = multiprocessing.get_context("forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn")
+
+    with context.Pool(workers, initializer=init_split_settings, initargs=(settings,)) as pool:
+        pending = deque()
+
+        for batch in batches:
+            pending.append(pool.apply_async(assign_batch, (batch,)))
+
+            if len(pending) >= workers * 2:
+                yield pending.popleft().get()
+
+        while pending:
+            yield pending.popleft().get()
+
+def init_split_settings(settings):
+    split_settings.update(settings)
+    split_settings["extract_index"] = compile_index_extractor(settings["read_structure"], reverse_complement)
+    split_settings["assign_records"] = compile_record_assigner(settings["read_structure"], settings["index_table"])
+    split_settings["cache"] = ResolutionCache(resolve_index, settings["cache_size"])
+
+#----------------------------------------------
+#  work out the sample for a pair of index reads
+#----------------------------------------------
+def resolve_index(raw_I1, raw_I2):
+    """Return (sample key, read ID tag, I1 barcode, I2 barcode, rescued) for the raw index sequences.
+
+    The sample key is None for unassigned reads.  This only depends on the raw
+    sequences, so the results are cached - see ResolutionCache.
+    """
+
+    sample_keys = split_settings["sample_keys"]
+    mismatch_index = split_settings["mismatch_index"]
+
+    # the barcode has the index reads in the order given by the read structure
+    barcode, seq_I1, seq_I2, umi = split_settings["extract_index"](raw_I1, raw_I2)
+    rescued = False
+
+    key = sample_keys.get(barcode)
+
+    # try to rescue reads with sequencing errors in the index reads
+    if key is None and mismatch_index is not None:
+        corrected = mismatch_index.correct(*barcode.split(b"_"))
+
+        # the corrected indexes still have to be a combination we were expecting
+        if corrected is not None:
+            key = sample_keys.get(corrected)
+            rescued = key is not None
+
+    # the barcode (and UMI) are added to the end of the read ID for R1 and R2
+    if umi is not None:
+        header_tag = b" " + barcode + b":" + umi + b"\n"
+    else:
+        header_tag = b" " + barcode + b"\n"
+
+    return key, header_tag, seq_I1, seq_I2, rescued
+
+#----------------------------------------------
+#  assign a batch of reads to samples
+#----------------------------------------------
+def assign_batch(batch):
+    """Work out the sample for each record in the batch and build the text for each output file.
+
+    The per-record loop is compiled from the read structure (see read_structure.py).  It
+    stops after the first record whose R1 and I1 IDs don't match so that the caller writes
+    exactly what the serial splitter would have written before exiting.
+    """
+
+    start = time.perf_counter()
+    cache = split_settings["cache"]
+
+    out_R1 = {}
+    out_R2 = {}
+    unassigned_counts = {}
+    hits_before = cache.hits
+    misses_before = cache.misses
+
+    lines_R1, lines_R2, lines_I1, lines_I2 = batch
+
+    # R1 and I1 are checked read by read below, R2 and I2 at the ends of the batch
+    stream = out_of_step((lines_R1, lines_R2, None, lines_I2))
+
+    if stream is not None:
+        return {"R1": {}, "R2": {}, "n_reads": 0, "assigned": 0, "unassigned": 0, "rescued": 0, "cache_hits": 0, "cache_misses": 0,
+                "records": {}, "unassigned_barcodes": {}, "id_mismatch": False, "out_of_step": ("R1", "R2", "I1", "I2")[stream],
+                "match_seconds": time.perf_counter() - start}
+
+    n_reads, assigned_count, unassigned_count, rescued_count, id_mismatch = split_settings["assign_records"](
+        lines_R1, lines_R2, lines_I1, lines_I2, cache.get, out_R1, out_R2, unassigned_counts)
+
+    # the index reads of unassigned reads are a block of the index table rather than fastq text
+    index_pairs = out_R1.pop("unassigned_index", None)
+    text_R1 = {key: b"".join(lines) for key, lines in out_R1.items()}
+
+    if index_pairs:
+        text_R1["unassigned_index"] = encode_block(index_pairs)
+
+    return {
+        "R1": text_R1,
+        "R2": {key: b"".join(lines) for key, lines in out_R2.items()},
+        "n_reads": n_reads,
+        "assigned": assigned_count,
+        "unassigned": unassigned_count,
+        "rescued": rescued_count,
+        "cache_hits": cache.hits - hits_before,
+        "cache_misses": cache.misses - misses_before,
+        "records": {key: len(lines) // 8 for key, lines in out_R1.items()},
+        "unassigned_barcodes": unassigned_counts,
+        "id_mismatch": id_mismatch,
+        "out_of_step": None,
+        "match_seconds": time.perf_counter() - start
+    }
+
+def write_batch(result):
+    for key, text in result["R1"].items():
+        fhsR1[key].write(text)
+    for key, text in result["R2"].items():
+        fhsR2[key].write(text)
+
 def open_filehandlesR1(fname, sample_level_barcode, path_from_run_folder):
 	#print (f"Opening filehandle for {sample_level_barcode} and {fname}")
     outfile = f"{path_from_run_folder}{fname}"
-#    fhsR1[sample_level_barcode] = gzip.open (outfile,mode='wb',compresslevel=3)
-    fhsR1[sample_level_barcode] = subprocess.Popen(f"/usr/bin/gzip -4 > {outfile}",encoding="utf8", stdin=subprocess.PIPE, shell=True)
+    # compressed in-process by the shared compressor pool rather than a gzip process per file
+    fhsR1[sample_level_barcode] = open_writer(outfile, sample_level_barcode)
 def open_filehandlesR2(fname, sample_level_barcode, path_from_run_folder):
 	#print (f"Opening filehandle for {sample_level_barcode} and {fname}")
     outfile = f"{path_from_run_folder}{fname}"
-    #fhsR2[sample_level_barcode] = gzip.open(outfile,mode='wb',compresslevel=3)
-    fhsR2[sample_level_barcode] = subprocess.Popen(f"/usr/bin/gzip -4 > {outfile}",encoding="utf8", stdin=subprocess.PIPE, shell=True)
+    fhsR2[sample_level_barcode] = open_writer(outfile, sample_level_barcode)
+
+def open_writer(outfile, sample_level_barcode):
+    if shard_reads > 0 and not sample_level_barcode.startswith("unassigned"):
+        return ShardedGzipWriter(outfile, compressor_pool, shard_reads, output_buffer_size,
+                                 resume_records=resume_records.get(sample_level_barcode, 0), resume_sizes=resume_sizes)
+
+    return GzipWriter(outfile, compressor_pool, output_buffer_size, resume_size=resume_sizes.get(outfile))
+
+def seal_filehandles():
+    """Write out everything split so far, returning the size of each output file for a checkpoint."""
+    sizes = {}
+    for fhs in (fhsR1, fhsR2):
+        for name, fh in fhs.items():
+            if name != "log":
+                sizes[fh.filename] = fh.seal()
+    return sizes
 
 def close_filehandles():
     for name in fhsR1.keys():
-        if name == "log":
-            fhsR1[name].close()
-        else:
-            fhsR1[name].stdin.close() 
+        fhsR1[name].close()
     for name in fhsR2.keys():
-        if name == "log":
-            fhsR2[name].close()
-        else:
-            fhsR2[name].stdin.close() 
+        fhsR2[name].close()
+    fhsR1.clear()
+    fhsR2.clear()
+    if compressor_pool is not None:
+        compressor_pool.shutdown()
 
 
 def reverse_complement(dna_seq):
@@ -391,6 +733,8 @@ def get_expected_barcodes_sample_sheet(run_folder, lane_number, sample_sheet):
 
 
                 print(f"\nsample_name = {sample_name}")    
+                if barcode_seq in barcode_dict:
+                    print(f"!! {barcode_seq} is given for both {barcode_dict[barcode_seq]} and {sample_name}, only {sample_name} will be kept !!")
                 barcode_dict[barcode_seq] = sample_name
                 count += 1
 
@@ -474,6 +818,8 @@ def get_expected_barcodes(run_folder, lane_number):
             else:
                 barcode_seq = bc1
                 
+            if barcode_seq in barcode_dict:
+                print(f"!! {barcode_seq} is given for both {barcode_dict[barcode_seq]} and {sample_name}, only {sample_name} will be kept !!")
             barcode_dict[barcode_seq] = sample_name
             count += 1
 
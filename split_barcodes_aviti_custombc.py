@@ -10,6 +10,12 @@ import argparse
 from argparse import RawTextHelpFormatter
 from datetime import datetime
 
+from fastq_parser import read_matched_batches
+from gzip_writer import CompressorPool, GzipWriter
+from decompression import backends, choose_backend, open_gzip
+
+transtable = bytes.maketrans(b"ATCGN", b"TAGCN")
+
 # passing in the lane number worked in that the splitting worked, but the naming went a bit wrong
 # we ended up with the big lane number after L00 instead of 1 or 2
 # lane8891_AGAGTAGC_TACGCCTT_Library7_sample11_L008891_R1.fastq.gz - should have been L001
@@ -38,6 +44,7 @@ from datetime import datetime
 
 fhsR1 = {}           # storing the filehandles for all output files - dictionary of filehandles where key is sample barcode
 fhsR2 = {}
+reads_per_batch = 10000
 #paired_end = False
 double_coded = False
 #prepath = "/bi/scratch/run_processing/"
@@ -55,6 +62,8 @@ parser.add_argument('--i1_trim', type=int, default=0, help='Trim first n bases f
 parser.add_argument('--i1_revcomp', default=False, action='store_true', help='Reverse complement the I1 sequence')
 parser.add_argument('--i2_revcomp', default=False, action='store_true', help='Reverse complement the I2 sequence')
 parser.add_argument('--barcode_length', type=int, default=0, help='If barcode length differs from actual length of sequences in the index file(s)')
+parser.add_argument('--decompressor', type=str, default="auto", choices=["auto"] + backends, help='How to decompress the input files. Default: auto, the fastest one available')
+parser.add_argument('--compress_threads', type=int, default=4, help='Number of threads used to gzip the output files. Default: 4')
 
 args=parser.parse_args()
 
@@ -67,9 +76,19 @@ barcode_length = args.barcode_length
 i1_umi = args.i1_umi
 lane_number = args.lane_number
 sample_sheet = args.sample_sheet
+compress_threads = args.compress_threads
+
+try:
+    decompressor = choose_backend(args.decompressor)
+except ValueError as err:
+    print(f"!! {err}, exiting... !!\n")
+    exit(1)
+
 
 path_from_run_folder = f"Unaligned/Project_External/Sample_lane{lane_number}/"
 
+compressor_pool = CompressorPool(compress_threads, level=3)
+
 
 def main():
 
@@ -150,119 +169,112 @@ def split_fastqs(file_location, expected_barcodes, double_coded, barcode_length,
 
     print(f"opened all the file handles")
 
-    r1 = gzip.open(R1)
-    i1 = gzip.open(I1)
+    print(f"Decompressing the input files with the {decompressor} backend", flush = True)
+
+    # reads are kept as bytes all the way through to the output files
+    r1 = open_gzip(R1, decompressor)
+    i1 = open_gzip(I1, decompressor)
 
     if paired_end:
-        r2 = gzip.open(R2)
+        r2 = open_gzip(R2, decompressor)
 
     if double_coded:
-        i2 = gzip.open(I2)
+        i2 = open_gzip(I2, decompressor)
+
+    # expected barcodes are looked up as bytes, giving the key used for the output files
+    sample_keys = {key.encode(): key for key in expected_barcodes}
 
     try:
 		# unpaired_count = 0 # count the number of R2 barcodes that don't match R1
         line_count = 0
-        barcode = ""
+        barcode = b""
         unassigned_count = 0
         assigned_count = 0
 
-        while True:
-        #while line_count <= 400: 
-            readID_R1  = r1.readline().decode().strip()
-            seq_R1     = r1.readline().decode().strip()
-            line3_R1   = r1.readline().decode().strip()
-            qual_R1    = r1.readline().decode().strip()
-
-            shortID_R1 = readID_R1.split(" ")[0]
-			
-            if not qual_R1:
-                break
-			
-            if paired_end:
-                readID_R2  = r2.readline().decode().strip()
-                seq_R2     = r2.readline().decode().strip()
-                line3_R2   = r2.readline().decode().strip()
-                qual_R2    = r2.readline().decode().strip()
-                #shortID_R2 = readID_R2.split(" ")[0]
-
-            readID_I1  = i1.readline().decode().strip()
-            seq_I1     = i1.readline().decode().strip()
-            line3_I1   = i1.readline().decode().strip()
-            qual_I1    = i1.readline().decode().strip()
-            shortID_I1 = readID_I1.split(" ")[0]
-
-            if I1_trim > 0:
-                seq_I1 = seq_I1[I1_trim:]
-
-            if I1_revcomp:
-                seq_I1 = reverse_complement(seq_I1)
-
-            if i1_umi and barcode_length > 0:
-                full_seq_I1 = seq_I1
-                seq_I1 = seq_I1[0:barcode_length]
-                umi = full_seq_I1[barcode_length:]
-                #print(f"umi = {umi}")
-                #readID_R1 += f':{umi}'
-                #print(f"readID_R1 = {readID_R1}")
-            elif barcode_length > 0:
-                seq_I1 = seq_I1[0:barcode_length]
-
-            if double_coded:
-                readID_I2  = i2.readline().decode().strip()
-                seq_I2     = i2.readline().decode().strip()
-                line3_I2   = i2.readline().decode().strip()
-                qual_I2    = i2.readline().decode().strip()
-                shortID_I2 = readID_I2.split(" ")[0]
-
-                if I2_revcomp:
-                    seq_I2 = reverse_complement(seq_I2)
-
-                barcode = f"{seq_I1}_{seq_I2}"
-            
-            else:
-                barcode = seq_I1
+        batches = read_matched_batches((r1, r2 if paired_end else None, i1, i2 if double_coded else None), reads_per_batch)
 
-            if barcode in expected_barcodes.keys():
-                assigned_count +=1
-                #print(f"Found it!! {barcode} has the name {expected_barcodes[barcode]}")
-                readID_R1 = f"{readID_R1} {barcode}"
+        for lines_R1, lines_R2, lines_I1, lines_I2 in batches:
+            for n in range(0, len(lines_R1), 4):
+                readID_R1, seq_R1, line3_R1, qual_R1 = lines_R1[n:n+4]
+
+                shortID_R1 = readID_R1.split(b" ")[0]
+
+                if paired_end:
+                    readID_R2, seq_R2, line3_R2, qual_R2 = lines_R2[n:n+4]
+                    #shortID_R2 = readID_R2.split(b" ")[0]
+
+                readID_I1, seq_I1, line3_I1, qual_I1 = lines_I1[n:n+4]
+                shortID_I1 = readID_I1.split(b" ")[0]
+
+                if I1_trim > 0:
+                    seq_I1 = seq_I1[I1_trim:]
+
+                if I1_revcomp:
+                    seq_I1 = reverse_complement(seq_I1)
 
                 if i1_umi and barcode_length > 0:
-                    readID_R1 += f':{umi}'
+                    full_seq_I1 = seq_I1
+                    seq_I1 = seq_I1[0:barcode_length]
+                    umi = full_seq_I1[barcode_length:]
+                elif barcode_length > 0:
+                    seq_I1 = seq_I1[0:barcode_length]
 
-                # this one's quicker - is it because we're not writing out so many times?
-                fhsR1[barcode].write (("\n".join([readID_R1, seq_R1, line3_R1, qual_R1]) + "\n").encode())
+                if double_coded:
+                    readID_I2, seq_I2, line3_I2, qual_I2 = lines_I2[n:n+4]
+                    shortID_I2 = readID_I2.split(b" ")[0]
 
+                    if I2_revcomp:
+                        seq_I2 = reverse_complement(seq_I2)
 
-                if paired_end:
-                    readID_R2 = f"{readID_R2} {barcode}"
+                    barcode = seq_I1 + b"_" + seq_I2
+            
+                else:
+                    barcode = seq_I1
+
+                key = sample_keys.get(barcode)
+
+                if key is not None:
+                    assigned_count +=1
+                    #print(f"Found it!! {barcode} has the name {expected_barcodes[key]}")
+                    readID_R1 = readID_R1 + b" " + barcode
 
                     if i1_umi and barcode_length > 0:
-                        readID_R2 += f':{umi}'
+                        readID_R1 += b":" + umi
 
-                    fhsR2[barcode].write (("\n".join([readID_R2, seq_R2, line3_R2, qual_R2]) + "\n").encode())
+                    # this one's quicker - is it because we're not writing out so many times?
+                    fhsR1[key].write(b"\n".join([readID_R1, seq_R1, line3_R1, qual_R1]) + b"\n")
 
-            else:
-                #print(f"Couldn't find this {barcode}")
-                unassigned_count +=1
-                fhsR1["unassigned"].write (("\n".join([readID_R1, seq_R1, line3_R1, qual_R1]) + "\n").encode())
-                fhsR1["unassigned_I1"].write (("\n".join([readID_I1, seq_I1, line3_I1, qual_I1]) + "\n").encode())
 
-                if double_coded:
-                    fhsR1["unassigned_I2"].write (("\n".join([readID_I2, seq_I2, line3_I2, qual_I2]) + "\n").encode())
+                    if paired_end:
+                        readID_R2 = readID_R2 + b" " + barcode
 
-                if paired_end:
-                    fhsR2["unassigned"].write (("\n".join([readID_R2, seq_R2, line3_R2, qual_R2]) + "\n").encode())
+                        if i1_umi and barcode_length > 0:
+                            readID_R2 += b":" + umi
 
+                        fhsR2[key].write(b"\n".join([readID_R2, seq_R2, line3_R2, qual_R2]) + b"\n")
+
+                else:
+                    #print(f"Couldn't find this {barcode}")
+                    unassigned_count +=1
+                    fhsR1["unassigned"].write(b"\n".join([readID_R1, seq_R1, line3_R1, qual_R1]) + b"\n")
+                    fhsR1["unassigned_I1"].write(b"\n".join([readID_I1, seq_I1, line3_I1, qual_I1]) + b"\n")
 
-            line_count += 1
+                    if double_coded:
+                        fhsR1["unassigned_I2"].write(b"\n".join([readID_I2, seq_I2, line3_I2, qual_I2]) + b"\n")
 
-        #     # I don't think that we should need to check this
-            if shortID_R1 != shortID_I1:
-                err_msg = f"\n!! IDs do not match for read {line_count}, exiting... !!\n"
-                print(err_msg)
-                fhsR1["log"].write(err_msg)
-                exit()
+                    if paired_end:
+                        fhsR2["unassigned"].write(b"\n".join([readID_R2, seq_R2, line3_R2, qual_R2]) + b"\n")
+
+
+                line_count += 1
+
+            #     # I don't think that we should need to check this
+                if shortID_R1 != shortID_I1:
+                    err_msg = f"\n!! IDs do not match for read {line_count}, exiting... !!\n"
+                    print(err_msg)
+                    fhsR1["log"].write(err_msg)
+                    close_filehandles()
+                    exit()
 
         total_reads = assigned_count + unassigned_count
         assigned_percentage = 100*(assigned_count/total_reads)
@@ -283,36 +295,36 @@ def split_fastqs(file_location, expected_barcodes, double_coded, barcode_length,
 def open_filehandlesR1(fname, sample_level_barcode, path_from_run_folder):
 	#print (f"Opening filehandle for {sample_level_barcode} and {fname}")
     outfile = f"{path_from_run_folder}{fname}"
-    fhsR1[sample_level_barcode] = gzip.open (outfile,mode='wb',compresslevel=3)
+    # compressed in-process by the shared compressor pool
+    fhsR1[sample_level_barcode] = GzipWriter(outfile, compressor_pool)
 
 def open_filehandlesR2(fname, sample_level_barcode, path_from_run_folder):
 	#print (f"Opening filehandle for {sample_level_barcode} and {fname}")
     outfile = f"{path_from_run_folder}{fname}"
-    fhsR2[sample_level_barcode] = gzip.open(outfile,mode='wb',compresslevel=3)
+    fhsR2[sample_level_barcode] = GzipWriter(outfile, compressor_pool)
 
 def close_filehandles():
 	for name in fhsR1.keys():
 		fhsR1[name].close() 
 	for name in fhsR2.keys():
 		fhsR2[name].close() 
+	fhsR1.clear()
+	fhsR2.clear()
+	compressor_pool.shutdown()
 
 
-# from chat gpt - check this
 def reverse_complement(dna_seq):
-    """Return the reverse complement of a DNA sequence."""
-    # Create a mapping of each nucleotide to its complement
-    complement = {'A': 'T', 'T': 'A', 'C': 'G', 'G': 'C', 'N': 'N'}
-    
+    """Return the reverse complement of a DNA sequence held as bytes."""
+
     # Convert the sequence to uppercase to handle mixed case input
     dna_seq = dna_seq.upper()
-    
-    # Compute the complement and then reverse it
-    try:
-        rev_comp = ''.join(complement[base] for base in reversed(dna_seq))
-    except KeyError as e:
-        raise ValueError(f"Invalid nucleotide found in sequence: {e}")
 
-    return rev_comp
+    # Anything left after deleting the valid bases isn't a nucleotide we know about
+    invalid = dna_seq.translate(None, b"ATCGN")
+    if invalid:
+        raise ValueError(f"Invalid nucleotide found in sequence: {invalid[:1].decode()!r}")
+
+    return dna_seq.translate(transtable)[::-1]
 
 #---------------------------------------------------
 # remove any unwanted characters from sample names
@@ -0,0 +1,187 @@
+#!/bin/python3
+
+import subprocess, sys, os, re
+import argparse
+from argparse import RawTextHelpFormatter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from glob import glob
+
+# Runs split_barcodes_aviti.py on every lane of a run folder at the same time, rather
+# than starting each --lane_number by hand.  Any options which aren't listed below are
+# passed straight through to split_barcodes_aviti.py for every lane.
+#
+# The CPUs are shared out between the lanes which are running at once - each lane gets
+# a share for its matching workers and compression threads.  --max_lanes limits how many
+# lanes are read and written at the same time, so it's the I/O budget.
+#
+# Each lane writes its own barcode_assignments_L00N.txt and barcode_splitting_L00N.log in
+# the run folder, and the assigned/unassigned counts for all lanes are collected into
+# barcode_assignments_all_lanes.txt at the end.
+
+# nohup ~/illuminaprocessing/split_barcodes_aviti_lanes.py --cpus 32 --max_lanes 4 --i1_trim 3 --i1_revcomp --i2_revcomp 20250618_AV240405_AV_B_ET6249_SE75_18062025 > barcode_splitting.log &
+
+prepath = "/primary/"
+splitter = os.path.join(os.path.dirname(os.path.abspath(__file__)), "split_barcodes_aviti.py")
+
+parser = argparse.ArgumentParser(formatter_class=RawTextHelpFormatter, description = '''For demultiplexing all of the lanes in a run folder at once.\nOther options are passed on to split_barcodes_aviti.py''')
+parser.add_argument('run_folder', type=str, default="", help='run folder name')
+parser.add_argument('--lanes', type=str, nargs='+', default=[], help='Lane numbers to split. Default: every Sample_laneN folder in the run folder')
+parser.add_argument('--cpus', type=int, default=os.cpu_count(), help='Total number of CPUs to use across all of the lanes. Default: all of them')
+parser.add_argument('--max_lanes', type=int, default=4, help='Maximum number of lanes to split at the same time. Default: 4')
+
+# The run folder has to come last (as it does for split_barcodes_aviti.py).  It's moved to the
+# front so that it isn't confused with the values of options we're passing through.
+args, splitter_options = parser.parse_known_args(sys.argv[-1:] + sys.argv[1:-1])
+
+run_folder = args.run_folder
+cpus = args.cpus
+max_lanes = args.max_lanes
+lanes = args.lanes
+
+summary_filename = "barcode_assignments_all_lanes.txt"
+
+
+def main():
+
+    print(datetime.now(), flush = True)
+
+    run_location = f"{prepath}{run_folder}"
+    os.chdir(run_location)   # split_barcodes_aviti.py works relative to the run folder
+
+    lane_numbers = lanes if lanes else find_lanes()
+
+    if not lane_numbers:
+        print(f"!! Couldn't find any Sample_lane folders in {run_location}, exiting... !!\n")
+        exit()
+
+    running_lanes = max(1, min(max_lanes, len(lane_numbers)))
+    workers, compress_threads = share_cpus(cpus, running_lanes)
+
+    print(f"Splitting lanes {', '.join(lane_numbers)} with up to {running_lanes} running at a time", flush = True)
+    print(f"Each lane gets {workers} matching worker(s) and {compress_threads} compression thread(s)", flush = True)
+
+    with ThreadPoolExecutor(max_workers=running_lanes) as executor:
+        results = list(executor.map(lambda lane: split_lane(lane, workers, compress_threads), lane_numbers))
+
+    write_summary(results)
+    print(datetime.now())
+
+#----------------------------------------------
+#  find the lanes in the run folder
+#----------------------------------------------
+def find_lanes():
+
+    lane_numbers = []
+
+    for lane_path in glob("Unaligned/Project_External/Sample_lane*"):
+        match = re.search(r"Sample_lane(\d+)$", lane_path)
+        if match:
+            lane_numbers.append(match.group(1))
+        else:
+            print(f"Couldn't extract a lane number from {lane_path}")
+
+    return sorted(lane_numbers, key=int)
+
+#----------------------------------------------
+#  share the CPUs out between the running lanes
+#----------------------------------------------
+def share_cpus(cpus, running_lanes):
+    """Return the (workers, compress_threads) for each lane.
+
+    Options given explicitly for split_barcodes_aviti.py are left alone.
+    """
+
+    lane_cpus = max(2, cpus // running_lanes)
+
+    # the main process of each lane reads and decompresses the input, so roughly
+    # half of the share goes on matching and half on compressing the output
+    workers = max(1, lane_cpus // 2)
+    compress_threads = max(1, lane_cpus - workers)
+
+    return workers, compress_threads
+
+#----------------------------------------------
+#  split one lane
+#----------------------------------------------
+def split_lane(lane_number, workers, compress_threads):
+
+    log_filename = f"barcode_assignments_L00{lane_number}.txt"
+    stdout_filename = f"barcode_splitting_L00{lane_number}.log"
+
+    command = [sys.executable, splitter, "--lane_number", lane_number, "--log_filename", log_filename]
+
+    if not any(option.startswith("--workers") for option in splitter_options):
+        command.extend(["--workers", str(workers)])
+    if not any(option.startswith("--compress_threads") for option in splitter_options):
+        command.extend(["--compress_threads", str(compress_threads)])
+
+    command.extend(splitter_options)
+    command.append(run_folder)
+
+    print(f"Starting lane {lane_number}: {' '.join(command)}", flush = True)
+    start = datetime.now()
+
+    with open(stdout_filename, mode = "w") as stdout_fh:
+        exit_code = subprocess.run(command, stdout=stdout_fh, stderr=subprocess.STDOUT).returncode
+
+    elapsed = datetime.now() - start
+    print(f"Finished lane {lane_number} in {elapsed} (exit code {exit_code})", flush = True)
+
+    return lane_number, exit_code, elapsed, log_filename
+
+#----------------------------------------------
+#  collect the counts from each lane
+#----------------------------------------------
+def read_lane_counts(log_filename):
+    """Return the assigned and unassigned read counts from a lane's assignment log, or None."""
+
+    counts = {}
+
+    try:
+        with open(log_filename) as log:
+            for line in log:
+                match = re.match(r"(Assigned|Unassigned) reads:\s+([\d,]+)", line)
+                if match:
+                    counts[match.group(1)] = int(match.group(2).replace(",", ""))
+    except FileNotFoundError:
+        return None
+
+    if len(counts) != 2:
+        return None
+
+    return counts["Assigned"], counts["Unassigned"]
+
+
+def write_summary(results):
+
+    total_assigned = 0
+    total_unassigned = 0
+
+    with open(summary_filename, mode = "w") as summary:
+        summary.write("Lane\tStatus\tAssigned\tUnassigned\tAssigned %\tTime\n")
+
+        for lane_number, exit_code, elapsed, log_filename in results:
+            counts = read_lane_counts(log_filename)
+
+            if exit_code != 0 or counts is None:
+                print(f"!! Lane {lane_number} did not finish, see barcode_splitting_L00{lane_number}.log !!")
+                summary.write(f"{lane_number}\tFAILED\t\t\t\t{elapsed}\n")
+                continue
+
+            assigned, unassigned = counts
+            total_assigned += assigned
+            total_unassigned += unassigned
+            assigned_percentage = 100*(assigned/max(assigned + unassigned, 1))
+            summary.write(f"{lane_number}\tOK\t{assigned}\t{unassigned}\t{assigned_percentage:.1f}\t{elapsed}\n")
+
+        total_percentage = 100*(total_assigned/max(total_assigned + total_unassigned, 1))
+        summary.write(f"All\t\t{total_assigned}\t{total_unassigned}\t{total_percentage:.1f}\t\n")
+
+    print(f"\nAssigned reads:   {total_assigned:,} ({total_percentage:.1f}%)")
+    print(f"Unassigned reads: {total_unassigned:,}")
+    print(f"Summary for all lanes written to {summary_filename}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+#!/bin/python3
+
+# Checkpoints for the python splitting scripts.
+#
+# Every so often the splitter seals all of its output files (see GzipWriter.seal)
+# and saves how many reads it has been through, the running counts and the size
+# of each output file.  Restarting with --resume cuts each output file back to
+# the size in the checkpoint, skips the reads which were already split, and
+# carries on from there.
+#
+# The run details (input files, expected barcodes and matching options) are
+# saved too, and a checkpoint is only used if they're the same for the new run.
+
+import json
+import os
+
+
+def save_checkpoint(filename, run_details, state):
+    """Save the state of the split, replacing any earlier checkpoint in one step."""
+
+    temp_filename = f"{filename}.tmp"
+
+    with open(temp_filename, "w") as fh:
+        json.dump({"run_details": run_details, **state}, fh, indent=1)
+        fh.flush()
+        os.fsync(fh.fileno())
+
+    os.replace(temp_filename, filename)
+
+
+def load_checkpoint(filename, run_details):
+    """Return the saved state, or None if there is no checkpoint.
+
+    Raises ValueError if the checkpoint was written for a different run.
+    """
+
+    if not os.path.exists(filename):
+        return None
+
+    with open(filename) as fh:
+        state = json.load(fh)
+
+    # round trip through json so that tuples and lists compare the same
+    if state.pop("run_details") != json.loads(json.dumps(run_details)):
+        raise ValueError(f"checkpoint {filename} is from a run with different input files, barcodes or options")
+
+    return state
+
+
+def remove_checkpoint(filename):
+    if os.path.exists(filename):
+        os.remove(filename)
@@ -0,0 +1,197 @@
+#!/bin/python3
+
+# Progress metrics for the python splitting script.
+#
+# Every --metrics_interval seconds the splitter adds a line to a JSON-lines file
+# and rewrites a Prometheus textfile (in the format node_exporter's textfile
+# collector reads) saying where the time has gone so far:
+#
+#   decompress     - inflating the input files, summed over the files (not known for the pipe backend)
+#   input_wait     - reader threads waiting for decompressed data
+#   parse          - splitting the decompressed data into records
+#   batch_wait     - the main process waiting for the next batch of reads to be matched
+#   match          - assigning reads to samples, summed over the worker processes
+#   buffer         - collecting the assigned reads into the output buffers
+#   compress       - deflating the output files, summed over the compression threads
+#   compress_wait  - waiting for compression to catch up
+#   write          - writing compressed blocks to the output files
+#
+# along with reads/s, how full the queues between the stages are and the reads
+# written to each sample so far.  As the stages run at the same time, their times
+# add up to more than the elapsed time.  A split is bound on inflating the input
+# when decompress is close to the elapsed time for one of the files, bound on
+# deflating when compress is close to the elapsed time * --compress_threads, and
+# a big input_wait or write with little CPU time means it's waiting on /primary.
+
+import json
+import os
+import time
+from datetime import datetime
+
+stage_names = ["decompress", "input_wait", "parse", "batch_wait", "match", "buffer", "compress", "compress_wait", "write"]
+input_names = ["R1", "R2", "I1", "I2"]   # in the order the splitter reads them
+
+metric_prefix = "barcode_split"
+
+
+class SplitMetrics:
+    """Collects the timings of each stage of a split and writes them out periodically."""
+
+    def __init__(self, jsonl_filename, prometheus_filename, interval, labels, start_reads=0):
+        """labels (e.g. run and lane) are added to every Prometheus metric.
+
+        start_reads is the number of reads already split when resuming from a checkpoint,
+        which don't count towards the rates.  The JSON-lines file is added to in that case.
+        """
+
+        self.jsonl_filename = jsonl_filename
+        self.prometheus_filename = prometheus_filename
+        self.interval = interval
+        self.labels = labels
+        self.stage_seconds = dict.fromkeys(stage_names, 0.0)
+        self.start = time.perf_counter()
+        self.last_time = self.start
+        self.last_reads = start_reads
+        self.start_reads = start_reads
+        self.batches = None
+        self.inputs = []
+        self.pool = None
+        self.jsonl = None   # opened when the metrics are first written
+
+    def watch(self, batches, inputs, pool):
+        """Give the batch reader, input file handles and CompressorPool whose timings are reported."""
+
+        self.batches = batches
+        self.inputs = inputs
+        self.pool = pool
+
+    def add(self, stage, seconds):
+        self.stage_seconds[stage] += seconds
+
+    def update(self, reads, assigned, unassigned, sample_counts):
+        """Write the metrics if it's been at least interval seconds since they were last written."""
+
+        if time.perf_counter() - self.last_time >= self.interval:
+            self.write(reads, assigned, unassigned, sample_counts)
+
+    def write(self, reads, assigned, unassigned, sample_counts, final=False):
+        snapshot = self.snapshot(reads, assigned, unassigned, sample_counts, final)
+
+        if self.jsonl is None:
+            self.jsonl = open(self.jsonl_filename, "a" if self.start_reads > 0 else "w")
+
+        self.jsonl.write(json.dumps(snapshot) + "\n")
+        self.jsonl.flush()
+
+        if self.prometheus_filename:
+            write_prometheus(self.prometheus_filename, snapshot, self.labels)
+
+    def snapshot(self, reads, assigned, unassigned, sample_counts, final):
+        now = time.perf_counter()
+        elapsed = now - self.start
+        stages = self.collect_stage_seconds()
+
+        snapshot = {
+            "time": datetime.now().isoformat(timespec="seconds"),
+            "elapsed_s": round(elapsed, 3),
+            "final": final,
+            "reads": reads,
+            "assigned": assigned,
+            "unassigned": unassigned,
+            "reads_per_s": round((reads - self.last_reads) / max(now - self.last_time, 1e-9), 1),
+            "mean_reads_per_s": round((reads - self.start_reads) / max(elapsed, 1e-9), 1),
+            "stage_seconds": {stage: round(seconds, 3) for stage, seconds in stages.items()},
+            "queue_depths": self.collect_queue_depths(),
+            "output_buffered_bytes": self.pool.buffered if self.pool is not None else 0,
+            "samples": dict(sample_counts)
+        }
+
+        self.last_time = now
+        self.last_reads = reads
+
+        return snapshot
+
+    def collect_stage_seconds(self):
+        stages = dict(self.stage_seconds)
+
+        if self.batches is not None:
+            for reader in self.batches.readers():
+                if reader is not None:
+                    stages["input_wait"] += reader.read_seconds
+                    stages["parse"] += reader.parse_seconds
+
+        for fh in self.inputs:
+            stages["decompress"] += getattr(fh, "busy_seconds", 0.0)
+
+        if self.pool is not None:
+            stages["compress"] += self.pool.compress_seconds
+            stages["compress_wait"] += self.pool.wait_seconds
+            stages["write"] += self.pool.write_seconds
+
+        return stages
+
+    def collect_queue_depths(self):
+        """Return the number of items waiting between the stages - full queues are ahead of a slow stage."""
+
+        depths = {}
+
+        if self.batches is not None:
+            for name, depth in zip(input_names, self.batches.queue_depths()):
+                if depth is not None:
+                    depths[f"parsed_{name}"] = depth
+
+        for name, fh in zip(input_names, self.inputs):
+            if hasattr(fh, "blocks"):
+                depths[f"decompressed_{name}"] = fh.blocks.qsize()
+
+        if self.pool is not None:
+            depths["compressing"] = len(self.pool.in_flight)
+
+        return depths
+
+    def close(self):
+        if self.jsonl is not None:
+            self.jsonl.close()
+
+
+#----------------------------------------------
+#  Prometheus textfile
+#----------------------------------------------
+def prometheus_labels(labels):
+    escaped = []
+    for name, value in labels.items():
+        value = str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        escaped.append(f'{name}="{value}"')
+
+    return "{" + ",".join(escaped) + "}"
+
+
+def write_prometheus(filename, snapshot, labels):
+    """Rewrite the textfile in one go so that a scrape never sees half of it."""
+
+    lines = []
+
+    def metric(name, metric_type, help_text, values):
+        lines.append(f"# HELP {metric_prefix}_{name} {help_text}")
+        lines.append(f"# TYPE {metric_prefix}_{name} {metric_type}")
+        for extra_labels, value in values:
+            lines.append(f"{metric_prefix}_{name}{prometheus_labels({**labels, **extra_labels})} {value}")
+
+    metric("reads_total", "counter", "Reads split so far.", [({}, snapshot["reads"])])
+    metric("assigned_reads_total", "counter", "Reads assigned to a sample so far.", [({}, snapshot["assigned"])])
+    metric("unassigned_reads_total", "counter", "Reads not assigned to any sample so far.", [({}, snapshot["unassigned"])])
+    metric("reads_per_second", "gauge", "Reads split per second since the last update.", [({}, snapshot["reads_per_s"])])
+    metric("elapsed_seconds", "gauge", "Seconds since the split started.", [({}, snapshot["elapsed_s"])])
+    metric("finished", "gauge", "1 once the split has finished.", [({}, int(snapshot["final"]))])
+    metric("stage_seconds_total", "counter", "Seconds spent in each stage, summed over threads and processes.",
+           [({"stage": stage}, seconds) for stage, seconds in snapshot["stage_seconds"].items()])
+    metric("queue_depth", "gauge", "Items waiting in each queue between the stages.",
+           [({"queue": queue}, depth) for queue, depth in snapshot["queue_depths"].items()])
+    metric("output_buffered_bytes", "gauge", "Uncompressed bytes waiting in the output buffers.", [({}, snapshot["output_buffered_bytes"])])
+    metric("sample_reads_total", "counter", "Reads written for each sample so far.",
+           [({"sample": sample}, count) for sample, count in snapshot["samples"].items()])
+
+    temp_filename = f"{filename}.tmp"
+    with open(temp_filename, "w") as fh:
+        fh.write("\n".join(lines) + "\n")
+    os.replace(temp_filename, filename)
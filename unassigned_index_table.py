@@ -0,0 +1,197 @@
+#!/bin/python3
+
+import sys, gzip, struct
+import argparse
+from argparse import RawTextHelpFormatter
+from array import array
+
+from decompression import open_gzip
+from fastq_parser import read_fastq_batches
+
+# A compact table of the index reads of unassigned reads.
+#
+# With --unassigned_index_table, split_barcodes_aviti.py writes laneN_NoCode_L00N_index_table.gz
+# rather than the NoCode I1 and I2 fastq files.  It only has the raw index sequences, stored a
+# column at a time for each batch of reads:
+#
+#   header   - "NCIX", then the number of distinct (I1, I2) pairs in the batch, the number of reads,
+#              and the lengths of the I1 and I2 columns (little endian unsigned 32 bit integers)
+#   I1       - the distinct I1 sequences, separated by newlines
+#   I2       - the distinct I2 sequences, separated by newlines (empty for single index runs)
+#   counts   - the number of reads with each pair (unsigned 32 bit integers)
+#   rows     - the pair for each read in the order of the NoCode R1 file (unsigned 32 bit integers)
+#
+# and the whole file is gzipped.  The rows mean it can be turned back into fastq - the read IDs
+# are taken from the NoCode R1 file, but the qualities aren't kept so they are all written as '#'.
+#
+# Total reads for each (I1, I2) pair, most frequent first:
+#   ~/illuminaprocessing/unassigned_index_table.py lane1_NoCode_L001_index_table.gz > unassigned_indexes.txt
+#
+# Back to lane1_NoCode_L001_I1.fastq.gz (and I2) in the same folder:
+#   ~/illuminaprocessing/unassigned_index_table.py --fastq lane1_NoCode_L001_R1.fastq.gz lane1_NoCode_L001_index_table.gz
+
+header = struct.Struct("<4sIIII")
+magic = b"NCIX"
+table_suffix = "_index_table.gz"
+
+parser = argparse.ArgumentParser(formatter_class=RawTextHelpFormatter, description = '''Summarises an unassigned index table, or turns it back into fastq files''')
+parser.add_argument('table', type=str, help='laneN_NoCode_L00N_index_table.gz file written by split_barcodes_aviti.py')
+parser.add_argument('--fastq', type=str, default="", help='NoCode R1 fastq file to take the read IDs from, writing the I1 (and I2) fastq files next to the table')
+parser.add_argument('--top', type=int, default=0, help='Only list the n most frequent pairs. Default: all of them')
+
+
+def uint32_bytes(values):
+    column = array("I", values)
+    if sys.byteorder != "little":
+        column.byteswap()
+    return column.tobytes()
+
+
+def uint32_values(data):
+    column = array("I")
+    column.frombytes(data)
+    if sys.byteorder != "little":
+        column.byteswap()
+    return column
+
+
+def encode_block(pairs):
+    """Return the table block for a list of (raw I1, raw I2) pairs, with raw I2 None for single index runs."""
+
+    rows_by_pair = {}
+    rows = []
+    counts = []
+
+    for pair in pairs:
+        row = rows_by_pair.get(pair)
+        if row is None:
+            row = len(counts)
+            rows_by_pair[pair] = row
+            counts.append(0)
+        counts[row] += 1
+        rows.append(row)
+
+    i1_column = b"\n".join(i1 for i1, i2 in rows_by_pair)
+    i2_column = b"\n".join(i2 for i1, i2 in rows_by_pair) if pairs[0][1] is not None else b""
+
+    return b"".join([
+        header.pack(magic, len(counts), len(rows), len(i1_column), len(i2_column)),
+        i1_column,
+        i2_column,
+        uint32_bytes(counts),
+        uint32_bytes(rows)
+    ])
+
+
+def read_exactly(fh, size):
+    data = b""
+    while len(data) < size:
+        chunk = fh.read(size - len(data))
+        if not chunk:
+            raise ValueError("index table ends part way through a block")
+        data += chunk
+    return data
+
+
+def read_blocks(fh):
+    """Yield (I1 sequences, I2 sequences or None, counts, rows) for each block of an open table."""
+
+    while True:
+        start = fh.read(header.size)
+        if not start:
+            return
+
+        block_magic, n_pairs, n_reads, i1_length, i2_length = header.unpack(start + read_exactly(fh, header.size - len(start)))
+        if block_magic != magic:
+            raise ValueError("not an unassigned index table, or it's corrupt")
+
+        i1 = read_exactly(fh, i1_length).split(b"\n")
+        i2 = read_exactly(fh, i2_length).split(b"\n") if i2_length else None
+        counts = uint32_values(read_exactly(fh, 4 * n_pairs))
+        rows = uint32_values(read_exactly(fh, 4 * n_reads))
+
+        yield i1, i2, counts, rows
+
+
+def total_counts(filename):
+    """Return a dictionary of (I1, I2) to the number of reads across the whole table."""
+
+    totals = {}
+
+    with open_gzip(filename) as fh:
+        for i1, i2, counts, rows in read_blocks(fh):
+            for n, count in enumerate(counts):
+                pair = (i1[n], i2[n] if i2 is not None else b"")
+                totals[pair] = totals.get(pair, 0) + count
+
+    return totals
+
+
+def write_fastqs(filename, r1_filename):
+    """Rebuild the NoCode I1 (and I2) fastq files from the table and the read IDs in the NoCode R1 file."""
+
+    prefix = filename[:-len(table_suffix)]
+    outputs = None
+    r1 = open_gzip(r1_filename)
+    r1_batches = read_fastq_batches(r1, 10000)
+    r1_lines = []
+
+    try:
+        with open_gzip(filename) as fh:
+            for i1, i2, counts, rows in read_blocks(fh):
+                if outputs is None:
+                    outputs = [gzip.open(f"{prefix}_I1.fastq.gz", "wb", compresslevel=4)]
+                    if i2 is not None:
+                        outputs.append(gzip.open(f"{prefix}_I2.fastq.gz", "wb", compresslevel=4))
+
+                # the rows follow the R1 file, which is read in batches of its own
+                while len(r1_lines) < 4 * len(rows):
+                    batch = next(r1_batches, None)
+                    if batch is None:
+                        raise ValueError(f"{r1_filename} has fewer reads than the index table")
+                    r1_lines.extend(batch)
+
+                headers = r1_lines[0:4 * len(rows):4]
+                del r1_lines[:4 * len(rows)]
+
+                for out, column in zip(outputs, (i1, i2)):
+                    records = []
+                    for read_header, row in zip(headers, rows):
+                        sequence = column[row]
+                        records.append(b"%s\n%s\n+\n%s\n" % (read_header, sequence, b"#" * len(sequence)))
+                    out.write(b"".join(records))
+
+        if r1_lines or next(r1_batches, None) is not None:
+            raise ValueError(f"{r1_filename} has more reads than the index table")
+
+    finally:
+        r1.close()
+        for out in outputs or []:
+            out.close()
+
+    return [out.name for out in outputs or []]
+
+
+def main():
+
+    args = parser.parse_args()
+
+    if not args.table.endswith(table_suffix):
+        print(f"!! {args.table} doesn't look like an unassigned index table (expected a name ending {table_suffix}), exiting... !!\n")
+        exit(1)
+
+    if args.fastq:
+        for filename in write_fastqs(args.table, args.fastq):
+            print(f"Written {filename}")
+        return
+
+    totals = total_counts(args.table)
+    ranked = sorted(totals.items(), key=lambda pair_count: (-pair_count[1], pair_count[0]))
+
+    print("I1\tI2\tCount")
+    for (i1, i2), count in ranked[:args.top or None]:
+        print(f"{i1.decode()}\t{i2.decode()}\t{count}")
+
+
+if __name__ == "__main__":
+    main()